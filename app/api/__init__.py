@@ -1,4 +1,5 @@
 from fastapi import APIRouter
+from app.api.endpoints import admin
 from app.api.endpoints import sse
 from app.api.endpoints import auth
 from app.api.endpoints import chat
@@ -11,4 +12,5 @@ api_router.include_router(auth.router, prefix="/auth", tags=["auth"])
 api_router.include_router(chat.router, prefix="/chat", tags=["chat"])
 api_router.include_router(base.router, prefix="/base", tags=["base"])
 api_router.include_router(sse.router, prefix="/sse", tags=["chat"])
-api_router.include_router(config.router, prefix="/config", tags=["config"])
\ No newline at end of file
+api_router.include_router(config.router, prefix="/config", tags=["config"])
+api_router.include_router(admin.router, prefix="/admin", tags=["admin"])
\ No newline at end of file
@@ -0,0 +1,131 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from aiokafka.errors import KafkaError
+from app.core.logging import logger
+from app.core.security import get_current_user, verify_admin
+from app.db.mongo import MongoDB, get_mongo
+from app.db.redis import redis
+from app.db.ultils import format_page_response
+from app.models.knowledge_base import PageResponse
+from app.models.user import User
+from app.rag.reindex import cancel_reindex, start_reindex
+from app.rag.utils import init_task_progress, update_task_progress
+from app.utils.kafka_producer import (
+    KAFKA_ATTEMPTS_HEADER,
+    KAFKA_ERROR_HEADER,
+    KAFKA_NOT_BEFORE_HEADER,
+    get_message_key,
+    kafka_producer_manager,
+    merge_headers,
+)
+
+router = APIRouter()
+
+
+@router.get("/dead-letters", response_model=PageResponse)
+async def get_dead_letters(
+    status: str = Query("dead"),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(10, ge=1, le=100),
+    current_user: User = Depends(get_current_user),
+    db: MongoDB = Depends(get_mongo),
+):
+    """
+    获取超过最大重试次数的解析消息（分页）
+    """
+    await verify_admin(current_user)
+    result = await db.get_dead_letters_with_pagination(
+        status=status, skip=(page - 1) * page_size, limit=page_size
+    )
+    return format_page_response(result, page, page_size)
+
+
+@router.post("/dead-letters/{dead_letter_id}/replay", response_model=dict)
+async def replay_dead_letter(
+    dead_letter_id: str,
+    current_user: User = Depends(get_current_user),
+    db: MongoDB = Depends(get_mongo),
+):
+    """
+    重放死信：重置处理次数后投递回原 topic，解析从断点继续
+    """
+    await verify_admin(current_user)
+    dead_letter = await db.get_dead_letter(dead_letter_id)
+    if not dead_letter:
+        raise HTTPException(status_code=404, detail="Dead letter not found")
+    if dead_letter["status"] != "dead":
+        raise HTTPException(status_code=400, detail="Dead letter already replayed")
+
+    headers = merge_headers(
+        [(key, value.encode("utf-8")) for key, value in dead_letter["headers"]],
+        **{
+            KAFKA_ATTEMPTS_HEADER: None,
+            KAFKA_NOT_BEFORE_HEADER: None,
+            KAFKA_ERROR_HEADER: None,
+        },
+    )
+
+    # 任务进度可能已经过期，重新创建以便前端继续显示进度
+    task_id = dead_letter["task_id"]
+    if task_id:
+        redis_connection = await redis.get_task_connection()
+        if await redis_connection.exists(f"task:{task_id}"):
+            await update_task_progress(
+                redis_connection, task_id, "processing", "Replaying failed file..."
+            )
+        else:
+            await init_task_progress(
+                redis_connection, task_id, dead_letter["username"], 1
+            )
+
+    try:
+        await kafka_producer_manager.republish(
+            dead_letter["origin_topic"],
+            get_message_key(dead_letter["knowledge_db_id"]),
+            dead_letter["value"].encode("utf-8"),
+            headers,
+        )
+    except KafkaError as e:
+        logger.error(f"Replay dead letter {dead_letter_id} failed: {e}")
+        raise HTTPException(status_code=503, detail="Replay dead letter failed")
+
+    result = await db.mark_dead_letter_replayed(dead_letter_id)
+    logger.info(f"Dead letter {dead_letter_id} replayed by {current_user.username}")
+    return {**result, "dead_letter_id": dead_letter_id, "task_id": task_id}
+
+
+@router.post("/knowledge_bases/{knowledge_base_id}/reindex", response_model=dict)
+async def reindex_knowledge_base(
+    knowledge_base_id: str,
+    current_user: User = Depends(get_current_user),
+):
+    """
+    用当前嵌入模型重建知识库向量索引（后台执行），进度通过知识库所属用户的任务进度查看
+    """
+    await verify_admin(current_user)
+    redis_connection = await redis.get_task_connection()
+    result = await start_reindex(redis_connection, knowledge_base_id)
+    if result["status"] != "success":
+        raise HTTPException(status_code=409, detail=result["message"])
+
+    try:
+        await kafka_producer_manager.send_reindex_task(
+            result["task_id"], result["username"], knowledge_base_id
+        )
+    except KafkaError as e:
+        logger.error(f"Send reindex task of {knowledge_base_id} failed: {e}")
+        await cancel_reindex(redis_connection, knowledge_base_id)
+        raise HTTPException(status_code=503, detail="Start reindex failed")
+    return result
+
+
+@router.delete("/knowledge_bases/{knowledge_base_id}/reindex", response_model=dict)
+async def cancel_knowledge_base_reindex(
+    knowledge_base_id: str,
+    current_user: User = Depends(get_current_user),
+):
+    await verify_admin(current_user)
+    redis_connection = await redis.get_task_connection()
+    result = await cancel_reindex(redis_connection, knowledge_base_id)
+    if result["status"] != "success":
+        raise HTTPException(status_code=404, detail=result["message"])
+    return result
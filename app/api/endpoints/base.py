@@ -1,4 +1,5 @@
 from typing import List
+import time
 import uuid
 from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile
 from fastapi.responses import RedirectResponse
@@ -12,15 +13,17 @@ from app.models.knowledge_base import (
     KnowledgeBaseRenameInput,
     KnowledgeBaseSummary,
     PageResponse,
+    RetrieveRequest,
 )
 from app.models.user import User
 from app.db.mongo import MongoDB, get_mongo
 from app.core.security import get_current_user, verify_username_match
-from app.rag.convert_file import (
-    save_file_to_minio,
-)
-from app.utils.kafka_producer import kafka_producer_manager
-from app.core.logging import logger
+from app.rag.cleanup import enqueue_cleanup
+from app.rag.get_embedding import get_embeddings_from_httpx
+from app.rag.llm_service import retrieve, timed
+from app.rag.model_config_cache import clamp_top_k
+from app.rag.utils import add_uploaded_files, init_task_progress
+from app.utils.kafka_producer import get_knowledge_base_priority
 from app.db.miniodb import async_minio_manager
 
 router = APIRouter()
@@ -144,23 +147,19 @@ async def bulk_delete_files(
     # 执行批量删除
     deletion_result = await db.bulk_delete_files_from_knowledge(valid_operations)
 
-    # 处理 Milvus 删除
+    # 后台清理 Milvus 向量和 MinIO 文件
+    cleanup_task_ids = []
     if deletion_result.get("status") in ["success", "partial_success"]:
+        file_ids_by_kb = {}
         for item in valid_operations:
-            try:
-                collection_name = "colqwen" + item["knowledge_id"].replace("-", "_")
-                milvus_client.delete_files(collection_name, [item["file_id"]])
-            except Exception as e:
-                logger.error(f"Milvus 删除失败 {item}: {str(e)}")
-                if "milvus_errors" not in deletion_result:
-                    deletion_result["milvus_errors"] = []
-                deletion_result["milvus_errors"].append(
-                    {
-                        "knowledge_id": item["knowledge_id"],
-                        "file_id": item["file_id"],
-                        "error": str(e),
-                    }
+            file_ids_by_kb.setdefault(item["knowledge_id"], []).append(item["file_id"])
+        redis_connection = await redis.get_task_connection()
+        for knowledge_id, file_ids in file_ids_by_kb.items():
+            cleanup_task_ids.append(
+                await enqueue_cleanup(
+                    redis_connection, current_user.username, knowledge_id, file_ids
                 )
+            )
 
     # 构建最终响应
     response = {
@@ -169,6 +168,7 @@ async def bulk_delete_files(
             "processed_count": len(valid_operations),
             "invalid_items": invalid_items,
             "database_result": deletion_result,
+            "cleanup_task_ids": cleanup_task_ids,
         },
     }
 
@@ -181,6 +181,54 @@ async def bulk_delete_files(
     return response
 
 
+# 只检索不调用模型，返回排序后的页面和各阶段耗时（毫秒），用于评估和调试检索效果
+@router.post("/retrieve", response_model=dict)
+async def retrieve_pages(
+    retrieve_request: RetrieveRequest,
+    db: MongoDB = Depends(get_mongo),
+    current_user: User = Depends(get_current_user),
+):
+    await verify_username_match(current_user, retrieve_request.username)
+    for knowledge_base_id in retrieve_request.knowledge_base_ids:
+        if "temp" in knowledge_base_id:
+            username = knowledge_base_id.split("_")[1]
+        else:
+            username = knowledge_base_id.split("_")[0]
+        await verify_username_match(current_user, username)
+
+    # 与聊天相同的取值范围
+    top_K = clamp_top_k(retrieve_request.top_K)
+
+    start_time = time.perf_counter()
+    timing = {}
+    query_embedding = await timed(
+        timing,
+        "embed_query",
+        get_embeddings_from_httpx([retrieve_request.query], endpoint="embed_text"),
+    )
+    pages = await retrieve(
+        db, retrieve_request.knowledge_base_ids, query_embedding[0], top_K, timing
+    )
+    timing["total"] = round((time.perf_counter() - start_time) * 1000, 1)
+    return {
+        "status": "success",
+        "results": [
+            {
+                "score": page["score"],
+                "knowledge_db_id": page["knowledge_db_id"],
+                "file_id": page["file_id"],
+                "file_name": page["file_name"],
+                "page_number": page["page_number"],
+                "image_id": page["image_id"],
+                "image_url": page["image_minio_url"],
+                "file_url": page["file_minio_url"],
+            }
+            for page in pages
+        ],
+        "timing": timing,
+    }
+
+
 # 删除知识库文件
 @router.delete("/file/{knowledge_base_id}/{file_id}", response_model=dict)
 async def delete_file(
@@ -195,9 +243,12 @@ async def delete_file(
         username = knowledge_base_id.split("_")[0]
     await verify_username_match(current_user, username)
     result = await db.delete_file_from_knowledge_base(knowledge_base_id, file_id)
-    milvus_client.delete_files("colqwen" + knowledge_base_id.replace("-", "_"), [file_id])
     if result["status"] == "failed":
         raise HTTPException(status_code=404, detail=result["message"])
+    redis_connection = await redis.get_task_connection()
+    result["cleanup_task_id"] = await enqueue_cleanup(
+        redis_connection, username, knowledge_base_id, [file_id]
+    )
     return result
 
 
@@ -210,9 +261,15 @@ async def delete_knowledge_base(
 ):
     await verify_username_match(current_user, knowledge_base_id.split("_")[0])
     result = await db.delete_knowledge_base(knowledge_base_id)
-    milvus_client.delete_collection("colqwen" + knowledge_base_id.replace("-", "_"))
     if result["status"] == "failed":
         raise HTTPException(status_code=404, detail=result["message"])
+    redis_connection = await redis.get_task_connection()
+    result["cleanup_task_id"] = await enqueue_cleanup(
+        redis_connection,
+        current_user.username,
+        knowledge_base_id,
+        drop_knowledge_base=True,
+    )
     return result
 
 
@@ -291,77 +348,15 @@ async def upload_multiple_files(
     # 验证当前用户是否与要删除的用户名匹配
     username = knowledge_db_id.split("_")[0]
     await verify_username_match(current_user, username)
-    return_files = []
     # 生成任务ID
     task_id = username + "_" + str(uuid.uuid4())
     total_files = len(files)
     redis_connection = await redis.get_task_connection()
-    # 初始化任务状态
-    await redis_connection.hset(
-        f"task:{task_id}",
-        mapping={
-            "status": "processing",
-            "total": total_files,
-            "processed": 0,
-            "message": "Initializing file processing...",
-        },
-    )
-    await redis_connection.expire(f"task:{task_id}", 3600)  # 1小时过期
-
-    # 保存文件元数据并准备Kafka消息
-    file_meta_list = []
-    for file in files:
-        # 保存文件到MinIO
-        minio_filename, minio_url = await save_file_to_minio(username, file)
-
-        # 生成文件ID并保存元数据
-        file_id = f"{username}_{uuid.uuid4()}"
-        await db.create_files(
-            file_id=file_id,
-            username=username,
-            filename=file.filename,
-            minio_filename=minio_filename,
-            minio_url=minio_url,
-            knowledge_db_id=knowledge_db_id,
-        )
-        await db.knowledge_base_add_file(
-            knowledge_base_id=knowledge_db_id,
-            file_id=file_id,
-            original_filename=file.filename,
-            minio_filename=minio_filename,
-            minio_url=minio_url,
-        )
-        file_meta_list.append(
-            {
-                "file_id": file_id,
-                "minio_filename": minio_filename,
-                "original_filename": file.filename,
-            }
-        )
-        return_files.append(
-            {
-                "id": file_id,
-                "minio_filename": minio_filename,
-                "filename": file.filename,
-                "url": minio_url,
-            }
-        )
-
-    # 发送Kafka消息（每个文件一个消息）
-    for meta in file_meta_list:
-        logger.info(
-            "send {task_id} to kafka, file name {file.filename}, knowledge id {knowledge_db_id}."
-        )
-        await kafka_producer_manager.send_embedding_task(
-            task_id=task_id,
-            username=username,
-            knowledge_db_id=knowledge_db_id,
-            file_meta=meta,
-            priority=1,
-        )
+    await init_task_progress(redis_connection, task_id, username, total_files)
 
-    return {
-        "task_id": task_id,
-        "knowledge_db_id": knowledge_db_id,
-        "files": return_files,
-    }
+    # 保存文件元数据并投递解析消息
+    result = await add_uploaded_files(
+        redis_connection, db, task_id, username, knowledge_db_id, files,
+        get_knowledge_base_priority(knowledge_db_id),
+    )
+    return {"task_id": task_id, "knowledge_db_id": knowledge_db_id, **result}
@@ -12,9 +12,10 @@ from app.models.conversation import (
 from app.models.user import User
 from app.db.mongo import MongoDB, get_mongo
 from app.core.security import get_current_user, verify_username_match
-from app.rag.convert_file import save_file_to_minio
-from app.utils.kafka_producer import kafka_producer_manager
-from app.core.logging import logger
+from app.rag.cleanup import enqueue_cleanup
+from app.rag.model_config_cache import model_config_cache
+from app.rag.utils import add_uploaded_files, init_task_progress
+from app.utils.kafka_producer import get_knowledge_base_priority
 from app.db.milvus import milvus_client
 
 router = APIRouter()
@@ -70,6 +71,7 @@ async def select_bases(
     )
     if result["status"] == "failed":
         raise HTTPException(status_code=404, detail="Conversation not found")
+    await model_config_cache.invalidate(conversation_id=basesInput.conversation_id)
     return result
 
 
@@ -140,6 +142,19 @@ async def get_conversations_by_user(
     ]
 
 
+async def cleanup_temp_knowledge_bases(username: str, result: dict):
+    """为已标记删除的临时知识库投递后台清理任务"""
+    redis_connection = await redis.get_task_connection()
+    for deletion in result.get("knowledge_base_deletion", []):
+        if deletion["result"]["status"] == "success":
+            deletion["cleanup_task_id"] = await enqueue_cleanup(
+                redis_connection,
+                username,
+                deletion["knowledge_base_id"],
+                drop_knowledge_base=True,
+            )
+
+
 # 删除指定会话
 @router.delete("/conversations/{conversation_id}", response_model=dict)
 async def delete_conversation(
@@ -151,6 +166,8 @@ async def delete_conversation(
     result = await db.delete_conversation(conversation_id)
     if result["status"] == "failed":
         raise HTTPException(status_code=404, detail=result["message"])
+    await model_config_cache.invalidate(conversation_id=conversation_id)
+    await cleanup_temp_knowledge_bases(current_user.username, result)
     return result
 
 
@@ -166,6 +183,8 @@ async def delete_all_conversations_by_user(
 
     # 执行批量删除
     result = await db.delete_all_conversation(username)
+    await model_config_cache.invalidate(username=username)
+    await cleanup_temp_knowledge_bases(username, result)
 
     # 检查删除结果并返回响应
     """if result.deleted_count == 0:
@@ -189,7 +208,6 @@ async def upload_multiple_files(
 
     # 验证当前用户是否与要删除的用户名匹配
     await verify_username_match(current_user, username)
-    return_files = []
     knowledge_db_id = "temp_" + conversation_id
     await db.create_knowledge_base(
         username,
@@ -205,73 +223,11 @@ async def upload_multiple_files(
     task_id = username + "_" + str(uuid.uuid4())
     total_files = len(files)
     redis_connection = await redis.get_task_connection()
-    # 初始化任务状态
-    await redis_connection.hset(
-        f"task:{task_id}",
-        mapping={
-            "status": "processing",
-            "total": total_files,
-            "processed": 0,
-            "message": "Initializing file processing...",
-        },
-    )
-    await redis_connection.expire(f"task:{task_id}", 3600)  # 1小时过期
+    await init_task_progress(redis_connection, task_id, username, total_files)
 
-    # 保存文件元数据并准备Kafka消息
-    file_meta_list = []
-    for file in files:
-        # 保存文件到MinIO
-        minio_filename, minio_url = await save_file_to_minio(username, file)
-
-        # 生成文件ID并保存元数据
-        file_id = f"{username}_{uuid.uuid4()}"
-        await db.create_files(
-            file_id=file_id,
-            username=username,
-            filename=file.filename,
-            minio_filename=minio_filename,
-            minio_url=minio_url,
-            knowledge_db_id=knowledge_db_id,
-        )
-        res = await db.knowledge_base_add_file(
-            knowledge_base_id=knowledge_db_id,
-            file_id=file_id,
-            original_filename=file.filename,
-            minio_filename=minio_filename,
-            minio_url=minio_url,
-        )
-
-        file_meta_list.append(
-            {
-                "file_id": file_id,
-                "minio_filename": minio_filename,
-                "original_filename": file.filename,
-            }
-        )
-        return_files.append(
-            {
-                "id": file_id,
-                "minio_filename": minio_filename,
-                "filename": file.filename,
-                "url": minio_url,
-            }
-        )
-
-    # 发送Kafka消息（每个文件一个消息）
-    for meta in file_meta_list:
-        logger.info(
-            "send {task_id} to kafka, file name {file.filename}, knowledge id {knowledge_db_id}."
-        )
-        await kafka_producer_manager.send_embedding_task(
-            task_id=task_id,
-            username=username,
-            knowledge_db_id=knowledge_db_id,
-            file_meta=meta,
-            priority=1,
-        )
-
-    return {
-        "task_id": task_id,
-        "knowledge_db_id": knowledge_db_id,
-        "files": return_files,
-    }
+    # 保存文件元数据并投递解析消息
+    result = await add_uploaded_files(
+        redis_connection, db, task_id, username, knowledge_db_id, files,
+        get_knowledge_base_priority(knowledge_db_id),
+    )
+    return {"task_id": task_id, "knowledge_db_id": knowledge_db_id, **result}
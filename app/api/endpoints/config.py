@@ -12,6 +12,7 @@ from app.core.security import (
     verify_username_match,
 )
 from app.db.mongo import get_mongo, MongoDB
+from app.rag.model_config_cache import model_config_cache
 
 router = APIRouter()
 
@@ -49,6 +50,7 @@ async def delete_model_config(
     await verify_username_match(current_user, username)
     """删除指定模型配置"""
     result = await db.delete_model_config(username, model_id)
+    await model_config_cache.invalidate(username=username)
 
     if result["status"] == "error":
         if "User not found" in result["message"]:
@@ -75,6 +77,7 @@ async def update_model_config(
     await db.update_selected_model(
             username=username, model_id=model_id
         )
+    await model_config_cache.invalidate(username=username)
     if result["status"] == "error":
         if "User not found" in result["message"]:
             raise HTTPException(status_code=404, detail=result["message"])
@@ -131,6 +134,7 @@ async def update_selected_model(
     result = await db.update_selected_model(
         username=username, model_id=request.model_id
     )
+    await model_config_cache.invalidate(username=username)
 
     if result["status"] == "error":
         if "User not found" in result["message"]:
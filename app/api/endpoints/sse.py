@@ -9,6 +9,11 @@ from app.db.redis import redis
 from app.models.conversation import UserMessage
 from app.models.user import User
 from app.rag.llm_service import ChatService
+from app.rag.utils import (
+    TERMINAL_TASK_STATUSES,
+    format_task_progress,
+    task_event_channel,
+)
 import uuid
 
 router = APIRouter()
@@ -33,6 +38,30 @@ async def chat_stream(
     )
 
 
+async def subscribe_task_events(redis_connection, username):
+    pubsub = redis_connection.pubsub()
+    await pubsub.subscribe(task_event_channel(username))
+    return pubsub
+
+
+async def iter_task_events(pubsub, idle_timeout=15):
+    """
+    逐条产出订阅到的任务进度事件
+
+    超过 idle_timeout 秒没有事件时产出 None，调用方据此回读任务 hash，防止漏掉事件
+    """
+    while True:
+        message = await pubsub.get_message(
+            ignore_subscribe_messages=True, timeout=idle_timeout
+        )
+        yield json.loads(message["data"]) if message else None
+
+
+async def read_task_progress(redis_connection, task_id):
+    task_data = await redis_connection.hgetall(f"task:{task_id}")
+    return format_task_progress(task_id, task_data) if task_data else None
+
+
 # SSE进度查询接口
 @router.get("/task/{username}/{task_id}")
 async def get_task_progress(
@@ -46,33 +75,61 @@ async def get_task_progress(
     redis_connection = await redis.get_task_connection()
 
     async def event_generator():
-        retries = 5
-        while retries > 0:
-            task_data = await redis_connection.hgetall(f"task:{task_id}")
-            if not task_data:
+        # 先订阅再读取当前状态，避免两者之间的事件丢失
+        pubsub = await subscribe_task_events(redis_connection, username)
+        try:
+            retries = 5
+            payload = await read_task_progress(redis_connection, task_id)
+            while not payload and retries > 0:
                 retries -= 1
                 await asyncio.sleep(1)
-                continue
-
-            status = task_data.get("status", "unknown")
-            total = int(task_data.get("total", 0))
-            processed = int(task_data.get("processed", 0))
-            message = task_data.get("message", "")
-
-            payload = json.dumps(
-                {
-                    "event": "progress",
-                    "status": status,
-                    "progress": f"{(processed/total)*100:.1f}" if total > 0 else 0,
-                    "processed": processed,
-                    "total": total,
-                    "message": message,
-                }
-            )
-            yield f"{payload}"  # 保持SSE事件标准分隔符
-            if status in ["completed", "failed"]:
-                break
-
-            await asyncio.sleep(1)
+                payload = await read_task_progress(redis_connection, task_id)
+            if not payload:
+                return
+            yield json.dumps(payload)  # 保持SSE事件标准分隔符
+            if payload["status"] in TERMINAL_TASK_STATUSES:
+                return
+
+            async for payload in iter_task_events(pubsub):
+                if payload is None:
+                    payload = await read_task_progress(redis_connection, task_id)
+                    if not payload:
+                        return
+                elif payload["task_id"] != task_id:
+                    continue
+                yield json.dumps(payload)
+                if payload["status"] in TERMINAL_TASK_STATUSES:
+                    return
+        finally:
+            await pubsub.reset()
+
+    return EventSourceResponse(event_generator())
+
+
+# 用户所有进行中任务的多路复用进度流
+@router.get("/tasks/{username}")
+async def get_user_tasks_progress(
+    username: str,
+    current_user: User = Depends(get_current_user),
+):
+    await verify_username_match(current_user, username)
+    redis_connection = await redis.get_task_connection()
+
+    async def event_generator():
+        pubsub = await subscribe_task_events(redis_connection, username)
+        try:
+            # 先发送所有进行中任务的当前状态
+            for task_id in await redis_connection.smembers(f"user_tasks:{username}"):
+                payload = await read_task_progress(redis_connection, task_id)
+                if not payload:
+                    await redis_connection.srem(f"user_tasks:{username}", task_id)
+                    continue
+                yield json.dumps(payload)
+
+            async for payload in iter_task_events(pubsub):
+                if payload is not None:
+                    yield json.dumps(payload)
+        finally:
+            await pubsub.reset()
 
     return EventSourceResponse(event_generator())
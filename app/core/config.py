@@ -1,3 +1,4 @@
+from typing import Any, Dict, List
 from pydantic_settings import BaseSettings
 
 
@@ -14,7 +15,9 @@ class Settings(BaseSettings):
     redis_token_db: int = 0  # 用于token存储
     redis_task_db: int = 1  # 用于存储embedding任务队列
     redis_lock_db: int = 2  # 用于存储embedding任务队列
+    redis_cache_db: int = 3  # 用于答案缓存
     secret_key: str = "your_secret_key"
+    admin_usernames: List[str] = []  # 可以访问 /admin 接口的用户名
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 60 * 24 * 8  # 8 days
     mongodb_url: str = "localhost:27017"
@@ -27,13 +30,66 @@ class Settings(BaseSettings):
     kafka_broker_url: str = "localhost:9094"
     kafka_topic: str = "task_generation"
     kafka_group_id: str = "task_consumer_group"
+    kafka_producer_linger_ms: int = 20  # 生产者等待更多消息合并为一个批次的时间（毫秒）
+    kafka_producer_max_batch_size: int = 65536  # 单个分区批次的最大字节数
+    kafka_producer_compression_type: str = "lz4"  # 批次压缩算法：lz4 / zstd / gzip / snappy，留空不压缩
+    kafka_retry_topic: str = "task_generation_retry"  # 解析失败后等待重试的消息
+    kafka_retry_max_pending: int = 1000  # 重试调度器在内存中等待到期的最大消息数
+    kafka_dead_letter_topic: str = "task_generation_dead"  # 超过最大重试次数的消息
+    ingest_max_attempts: int = 5  # 单个文件的最大处理次数（含首次）
+    ingest_retry_base_delay: float = 10  # 第一次重试的等待时间（秒），之后每次翻倍
+    ingest_retry_max_delay: float = 600  # 重试等待时间上限（秒）
+    kafka_consumer_in_api: bool = True  # API 进程内是否启动 Kafka 消费者，使用独立 worker 时关闭
+    kafka_consumer_max_in_flight: int = 4  # 单个消费者同时处理的文件（消息）数
+    ingest_worker_consumers: int = 1  # 独立解析 worker（python -m app.worker）内的消费者数量
     # kafka_priority_levels: int = 5  # 定义优先级的级别（0为最高）
+    kafka_priority_topic: str = "task_generation_priority"  # 高优先级（priority=0，聊天中上传的临时文件）解析任务的 topic
+    kafka_priority_reserved_slots: int = 1  # 每个消费者为高优先级通道保留的处理槽位
+    embed_priority_weight: int = 3  # 两个通道都有积压时，每批嵌入中高优先级页面与普通页面的数量比
     minio_url: str = "http://localhost:9110"  # MinIO 服务的URL
     minio_access_key: str = "your_access_key"  # MinIO 的访问密钥
     minio_secret_key: str = "your_secret_key"  # MinIO 的密钥
     minio_bucket_name: str = "ai-chat"  # 需要上传的桶的名称
     milvus_uri:str ="http://127.0.0.1:19530"
     colbert_model_path:str = "/home/administrator/KnowFlowVisualRAG/colqwen2.5-v0.2"
+    embed_max_pixels: int = 28 * 28 * 768  # 嵌入模型处理器保留的最大像素数（longest_edge）
+    embed_min_pixels: int = 56 * 56  # 嵌入模型处理器的最小像素数（shortest_edge）
+    render_min_dpi: int = 50  # PDF 渲染 DPI 下限
+    render_max_dpi: int = 200  # PDF 渲染 DPI 上限（pdf2image 默认值）
+    llm_render_dpi: int = 0  # 发送给LLM的页面图片单独使用的渲染 DPI，0 表示与嵌入图片共用
+    # 解析时额外生成的发送给LLM的页面图片规格：名称 -> 最大像素数、格式（JPEG/PNG/WEBP）、质量
+    llm_image_renditions: Dict[str, Dict[str, Any]] = {
+        "llm": {"max_pixels": 1024 * 1024, "format": "JPEG", "quality": 85}
+    }
+    llm_image_model_renditions: Dict[str, str] = {}  # 模型名 -> 使用的图片规格，"original" 表示发送原图
+    llm_image_default_rendition: str = "llm"  # 未单独配置的模型使用的图片规格
+    chat_context_token_budget: int = 32000  # 聊天提示词的 token 预算（估算值），超出时依次减少检索页面和历史消息，0 表示不限制
+    chat_image_tokens: Dict[str, int] = {}  # provider_type -> 每张图片的 token 数，覆盖内置估算
+    answer_cache_enabled: bool = False  # 是否对相同知识库上的相同问题（忽略大小写、标点和空白）复用已生成的答案
+    answer_cache_ttl: int = 24 * 3600  # 缓存答案的过期时间（秒）
+    answer_cache_replay_chunk: int = 16  # 回放缓存答案时每个 text 事件的字符数
+    sse_coalesce_window_ms: int = 30  # 聊天流中连续的小增量最多合并等待的时间（毫秒），0 表示不合并
+    sse_coalesce_max_bytes: int = 512  # 合并的增量达到该字节数时立即发送
+    embed_batch_size: int = 8  # 每次请求 /embed_image 的页数，多个文件的页面会被打包到同一批
+    embed_batch_wait: float = 0.05  # 凑满一批前最多等待的时间（秒）
+    embed_max_concurrent_batches: int = 2  # 同时在途的嵌入请求数
+    embed_model_batch_size: int = 4  # 嵌入服务内部每次送入模型的图片数
+    ingest_lock_timeout: int = 120  # 文件解析锁的过期时间（秒），处理期间定期续期
+    reindex_batch_size: int = 8  # 重建索引时每批重新嵌入的页数
+    reindex_batch_interval: float = 1.0  # 重建索引每批之间的间隔（秒），避免占满嵌入服务
+    reindex_drop_delay: float = 30  # 切换到新集合后等待多久删除旧集合（秒），等待进行中的检索结束
+    cleanup_batch_size: int = 50  # 后台清理每批删除的文件数
+    cleanup_sweep_interval: float = 600  # 定期检查遗留删除标记的间隔（秒）
+    cleanup_sweep_grace: float = 1800  # 标记删除超过该时间仍未清理时重新投递清理任务（秒）
+    ingest_checkpoint_expire: int = 7 * 24 * 3600  # 文件解析逐页断点状态保留时间（秒）
+    page_info_cache_size: int = 4096  # 检索命中页面元数据的进程内缓存条数，0 表示不缓存
+    page_info_cache_ttl: float = 300  # 页面元数据缓存过期时间（秒）
+    llm_image_fetch_concurrency: int = 8  # 组装提示词时并发下载页面图片的数量
+    llm_image_cache_bytes: int = 256 * 1024 * 1024  # 进程内页面图片 data URL 缓存的容量（字节），0 表示不缓存
+    llm_image_cache_dir: str = ""  # 页面图片的本地磁盘缓存目录，为空表示不使用磁盘缓存
+    llm_image_cache_disk_bytes: int = 2 * 1024 * 1024 * 1024  # 磁盘缓存的容量（字节）
+    model_config_cache_size: int = 1024  # 会话模型配置的进程内缓存条数，0 表示不缓存
+    model_config_cache_ttl: float = 30  # 会话模型配置缓存过期时间（秒），失效消息丢失时的兜底
 
     class Config:
         env_file = ".env"
@@ -63,6 +63,11 @@ async def verify_username_match(
         raise HTTPException(status_code=403, detail="Username mismatch")
 
 
+async def verify_admin(token_data) -> None:
+    if token_data.username not in settings.admin_usernames:
+        raise HTTPException(status_code=403, detail="Admin permission required")
+
+
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
 ):
@@ -1,6 +1,8 @@
 from pymilvus import MilvusClient, DataType
 import numpy as np
 import concurrent.futures
+import threading
+import time
 from app.core.config import settings
 
 
@@ -26,6 +28,17 @@ class MilvusManager:
         )
         return res
 
+    def delete_images(self, collection_name: str, image_ids: list):
+        filter = "image_id in ["
+        for image_id in image_ids:
+            filter += f"'{image_id}', "
+        filter += "]"
+        res = self.client.delete(
+            collection_name=collection_name,
+            filter=filter,
+        )
+        return res
+
     def check_collection(self, collection_name: str):
         if self.client.has_collection(collection_name):
             return True
@@ -76,8 +89,13 @@ class MilvusManager:
         )
         self.client.load_collection(collection_name)
 
-    def search(self, collection_name, data, topk):
+    def search(self, collection_name, data, topk, timing=None):
         # Perform a vector search on the collection to find the top-k most similar documents.
+        # timing 不为 None 时记录各阶段耗时（毫秒）：ann 为向量检索，fetch / rerank 为
+        # 各候选页面读取向量和计算分数的耗时之和（多线程并发，可能大于 rerank_wall）
+        timing = {} if timing is None else timing
+        timing_lock = threading.Lock()
+        start = time.perf_counter()
         search_params = {"metric_type": "IP", "params": {}}
         results = self.client.search(
             collection_name,
@@ -90,17 +108,29 @@ class MilvusManager:
         for r_id in range(len(results)):
             for r in range(len(results[r_id])):
                 image_ids.add(results[r_id][r]["entity"]["image_id"])
+        timing["ann"] = round((time.perf_counter() - start) * 1000, 1)
+        timing["candidates"] = len(image_ids)
+        timing["fetch"] = 0.0
+        timing["rerank"] = 0.0
+
+        def add_timing(stage, stage_start):
+            with timing_lock:
+                timing[stage] = round(
+                    timing[stage] + (time.perf_counter() - stage_start) * 1000, 1
+                )
 
         scores = []
 
         def rerank_single_doc(image_id, data, client, collection_name):
             # Rerank a single document by retrieving its embeddings and calculating the similarity with the query.
+            fetch_start = time.perf_counter()
             doc_colbert_vecs = client.query(
                 collection_name=collection_name,
                 filter=f"image_id in ['{image_id}']",
                 output_fields=["vector", "image_id", "page_number", "file_id"],
                 limit=1000,
             )
+            add_timing("fetch", fetch_start)
             # 提取元数据（假设同一 image_id 对应的 file_id 和 page_number 是相同的）
             if not doc_colbert_vecs:
                 return (
@@ -115,12 +145,15 @@ class MilvusManager:
                 "page_number": doc_colbert_vecs[0]["page_number"],
             }
 
+            rerank_start = time.perf_counter()
             doc_vecs = np.vstack(
                 [doc_colbert_vecs[i]["vector"] for i in range(len(doc_colbert_vecs))]
             )
             score = np.dot(data, doc_vecs.T).max(1).sum()
+            add_timing("rerank", rerank_start)
             return (score, metadata)
 
+        rerank_start = time.perf_counter()
         with concurrent.futures.ThreadPoolExecutor(max_workers=300) as executor:
             futures = {
                 executor.submit(
@@ -131,6 +164,7 @@ class MilvusManager:
             for future in concurrent.futures.as_completed(futures):
                 score, metadata = future.result()
                 scores.append((score, metadata))  # 保存元数据
+        timing["rerank_wall"] = round((time.perf_counter() - rerank_start) * 1000, 1)
 
         scores.sort(key=lambda x: x[0], reverse=True)
         # 返回 Top-K 结果，包含所有字段
@@ -144,6 +178,38 @@ class MilvusManager:
             for score, metadata in scores[:topk]
         ]
 
+    def copy_file_vectors(
+        self,
+        source_collection: str,
+        target_collection: str,
+        file_id: str,
+        new_file_id: str,
+        image_id_map: dict,
+    ):
+        # Copy the vectors of an already indexed file into another collection under new ids,
+        # page by page so that a single query stays below Milvus' result size limit.
+        for image_id, new_image_id in image_id_map.items():
+            rows = self.client.query(
+                collection_name=source_collection,
+                filter=f"file_id in ['{file_id}'] and image_id in ['{image_id}']",
+                output_fields=["vector", "page_number"],
+                limit=16384,
+            )
+            if not rows:
+                continue
+            self.client.insert(
+                target_collection,
+                [
+                    {
+                        "vector": row["vector"],
+                        "image_id": new_image_id,
+                        "page_number": row["page_number"],
+                        "file_id": new_file_id,
+                    }
+                    for row in rows
+                ],
+            )
+
     def insert(self, data, collection_name):
         # Insert ColQwen embeddings and metadata for a document into the collection.
         colqwen_vecs = [vec for vec in data["colqwen_vecs"]]
@@ -164,4 +230,9 @@ class MilvusManager:
         )
 
 
+def default_collection_name(knowledge_db_id: str) -> str:
+    # 知识库未重建过索引时使用的集合名
+    return "colqwen" + knowledge_db_id.replace("-", "_")
+
+
 milvus_client = MilvusManager()
@@ -1,4 +1,4 @@
-import base64
+import asyncio
 from botocore.exceptions import ClientError
 from typing import List
 import aioboto3
@@ -46,7 +46,9 @@ class AsyncMinIOManager:
                 logger.error(f"Error checking or creating bucket: {e}")
                 raise e
 
-    async def upload_image(self, file_name: str, image_stream: BytesIO):
+    async def upload_image(
+        self, file_name: str, image_stream: BytesIO, content_type: str = "image/png"
+    ):
         """将图像流上传到 MinIO"""
         async with self.session.client(
             "s3",
@@ -62,7 +64,7 @@ class AsyncMinIOManager:
                     Bucket=self.bucket_name,
                     Key=file_name,
                     Body=image_stream,
-                    ContentType="image/png",
+                    ContentType=content_type,
                 )
             except Exception as e:
                 logger.exception(f"MinIO error upload_image: {e}")
@@ -92,8 +94,9 @@ class AsyncMinIOManager:
                 logger.exception(f"MinIO error upload_file: {e}")
                 raise e
 
-    async def download_image_and_convert_to_base64(self, file_name: str):
-        """下载图像并转换为Base64编码"""
+    async def download_images(self, file_names: List[str], concurrency: int = 8):
+        """复用同一个客户端并发下载多个对象，返回 file_name -> bytes"""
+        semaphore = asyncio.Semaphore(concurrency)
         async with self.session.client(
             "s3",
             endpoint_url=settings.minio_url,
@@ -101,16 +104,22 @@ class AsyncMinIOManager:
             aws_secret_access_key=settings.minio_secret_key,
             use_ssl=False,
         ) as client:
+
+            async def download(file_name):
+                async with semaphore:
+                    response = await client.get_object(
+                        Bucket=self.bucket_name, Key=file_name
+                    )
+                    return await response["Body"].read()
+
             try:
-                response = await client.get_object(
-                    Bucket=self.bucket_name, Key=file_name
+                images = await asyncio.gather(
+                    *[download(file_name) for file_name in file_names]
                 )
-                image_data = await response["Body"].read()  # 读取图像数据
-                base64_image = base64.b64encode(image_data).decode("utf-8")
-                return base64_image
             except Exception as e:
-                logger.exception(f"Error downloading image: {e}")
+                logger.exception(f"Error downloading images: {e}")
                 raise e
+        return dict(zip(file_names, images))
 
     async def create_presigned_url(self, file_name: str, expires: int = 3153600000):
         """生成预签名 URL 以供文件下载"""
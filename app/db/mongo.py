@@ -1,16 +1,38 @@
 from collections import defaultdict
+import json
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo import DeleteMany, UpdateMany
 from app.core.config import settings
 from typing import Dict, Any, List, Optional
 from app.core.logging import logger
 from app.db.ultils import parse_aggregate_result
+from app.utils.cache import TTLCache
+from app.utils.cache_invalidation import InvalidationChannel
 from app.utils.timezone import beijing_time_now
 from app.db.miniodb import async_minio_manager
-from app.db.milvus import milvus_client
+from app.db.milvus import default_collection_name
 from pymongo.errors import DuplicateKeyError, BulkWriteError
 
 
+# 检索命中页面的元数据，解析完成后不再变化；标记删除时通知所有实例清除缓存
+page_info_cache = TTLCache(settings.page_info_cache_size, settings.page_info_cache_ttl)
+
+
+def discard_page_info(file_ids=None, knowledge_db_id=None):
+    if file_ids:
+        deleted = set(file_ids)
+        page_info_cache.discard_if(lambda info: info["file_id"] in deleted)
+    if knowledge_db_id:
+        page_info_cache.discard_if(
+            lambda info: info["knowledge_db_id"] == knowledge_db_id
+        )
+
+
+page_info_invalidation = InvalidationChannel(
+    "page_info_invalidation", discard_page_info, page_info_cache.clear
+)
+
+
 class MongoDB:
     def __init__(self):
         self.client = None
@@ -19,6 +41,14 @@ class MongoDB:
     async def _create_indexes(self):
         """创建所有必要的索引（唯一索引+普通索引）"""
         try:
+            # 标记删除的知识库和文件，供后台清理任务查找
+            await self.db.knowledge_bases.create_index(
+                [("deleted_at", 1)], sparse=True, name="kb_deleted_at"
+            )
+            await self.db.files.create_index(
+                [("deleted_at", 1)], sparse=True, name="file_deleted_at"
+            )
+
             # 知识库集合索引
             await self.db.knowledge_bases.create_index(
                 [("knowledge_base_id", 1)], unique=True, name="unique_kb_id"  # 唯一索引
@@ -42,6 +72,14 @@ class MongoDB:
             await self.db.files.create_index(
                 [("knowledge_db_id", 1)], name="kb_file_query"  # 普通索引
             )
+            await self.db.files.create_index(
+                [("username", 1), ("content_hash", 1)],
+                name="user_content_hash",  # 上传去重查询
+            )
+            await self.db.files.create_index(
+                [("images.minio_filename", 1)],
+                name="image_minio_filename",  # 删除时检查图片是否被其他文件引用
+            )
 
             # 对话集合索引
             await self.db.conversations.create_index(
@@ -54,6 +92,14 @@ class MongoDB:
                 name="user_conversations",
             )
 
+            # 死信集合索引
+            await self.db.dead_letters.create_index(
+                [("dead_letter_id", 1)], unique=True, name="unique_dead_letter_id"
+            )
+            await self.db.dead_letters.create_index(
+                [("status", 1), ("created_at", -1)], name="dead_letter_query"
+            )
+
             logger.info("MongoDB 索引创建完成")
         except Exception as e:
             logger.error(f"索引创建失败: {str(e)}")
@@ -362,10 +408,25 @@ class MongoDB:
         )
         return conversation if conversation else None
 
+    async def get_conversation_turns(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """只获取会话各轮的消息ID和消息内容，用于组装历史消息"""
+        conversation = await self.db.conversations.find_one(
+            {"conversation_id": conversation_id, "is_delete": False},
+            projection={
+                "_id": 0,
+                "turns.message_id": 1,
+                "turns.parent_message_id": 1,
+                "turns.user_message": 1,
+                "turns.ai_message": 1,
+            },
+        )
+        return conversation.get("turns", []) if conversation else []
+
     async def get_conversation_model_config(self, conversation_id: str):
         """获取指定 conversation_id 的system prompt"""
         conversation = await self.db.conversations.find_one(
-            {"conversation_id": conversation_id, "is_delete": False}
+            {"conversation_id": conversation_id, "is_delete": False},
+            projection={"_id": 0, "model_config": 1},
         )
         return conversation["model_config"] if conversation else None
 
@@ -492,9 +553,9 @@ class MongoDB:
         # 去重并删除临时知识库
         deletion_results = []
         for db_id in set(temp_dbs):
+            # 标记删除，Milvus 集合和文件由后台清理任务删除
             result = await self.delete_knowledge_base(db_id)
             deletion_results.append({"knowledge_base_id": db_id, "result": result})
-            milvus_client.delete_collection("colqwen" + db_id.replace("-", "_"))
 
         # 删除对话文档
         delete_result = await self.db.conversations.delete_one(
@@ -527,9 +588,9 @@ class MongoDB:
         # 去重并删除临时知识库
         deletion_results = []
         for db_id in set(temp_dbs):
+            # 标记删除，Milvus 集合和文件由后台清理任务删除
             result = await self.delete_knowledge_base(db_id)
             deletion_results.append({"knowledge_base_id": db_id, "result": result})
-            milvus_client.delete_collection("colqwen" + db_id.replace("-", "_"))
 
         # 删除所有对话文档
         delete_result = await self.db.conversations.delete_many({"username": username})
@@ -591,64 +652,36 @@ class MongoDB:
         return await cursor.to_list(length=None)  # 返回所有匹配的记录
 
     async def delete_knowledge_base(self, knowledge_base_id: str) -> dict:
-        """删除知识库及关联的所有文件"""
-        # 查询知识库文档
-        knowledge_base = await self.db.knowledge_bases.find_one(
-            {"knowledge_base_id": knowledge_base_id}
+        """
+        标记删除知识库及关联的所有文件，立即对用户不可见
+
+        MinIO 文件、Milvus 集合和数据库记录由后台清理任务（app.rag.cleanup）分批删除
+        """
+        now = beijing_time_now()
+        result = await self.db.knowledge_bases.update_one(
+            {"knowledge_base_id": knowledge_base_id, "deleted_at": None},
+            {"$set": {"is_delete": True, "deleted_at": now}},
         )
-        if not knowledge_base:
+        if result.matched_count == 0:
             return {"status": "failed", "message": "知识库不存在"}
 
-        # 收集所有关联文件ID（自动去重）
-        file_ids = list({file["file_id"] for file in knowledge_base.get("files", [])})
-
-        # 批量删除文件（包含MongoDB记录和MinIO文件）
-        file_deletion_result = (
-            await self.delete_files_bulk(file_ids)
-            if file_ids
-            else {"status": "success", "message": "无关联文件需要删除", "detail": {}}
+        file_result = await self.db.files.update_many(
+            {"knowledge_db_id": knowledge_base_id, "is_delete": False},
+            {"$set": {"is_delete": True, "deleted_at": now}},
         )
-
-        # 删除知识库文档
-        try:
-            delete_result = await self.db.knowledge_bases.delete_one(
-                {"knowledge_base_id": knowledge_base_id}
-            )
-        except Exception as e:
-            logger.error(f"删除知识库失败 | ID: {knowledge_base_id} | 错误: {str(e)}")
-            return {
-                "status": "failed",
-                "message": f"数据库删除失败: {str(e)}",
-                "file_deletion": file_deletion_result,
-            }
-
-        # 处理结果
-        response = {
+        await page_info_invalidation.publish(knowledge_db_id=knowledge_base_id)
+        return {
             "status": "success",
-            "message": "知识库及关联文件已删除",
-            "detail": {
-                "knowledge_base_deleted": delete_result.deleted_count,
-                "file_deletion": file_deletion_result,
-            },
+            "message": "知识库已删除，关联文件将在后台清理",
+            "detail": {"files_marked": file_result.modified_count},
         }
 
-        # 处理部分成功情况
-        if (
-            file_deletion_result.get("status") != "success"
-            or delete_result.deleted_count != 1
-        ):
-            response["status"] = "partial_success"
-            error_messages = []
-
-            if delete_result.deleted_count != 1:
-                error_messages.append("知识库删除失败")
-
-            if file_deletion_result.get("status") != "success":
-                error_messages.append("部分文件删除失败")
-
-            response["message"] = ",".join(error_messages)
-
-        return response
+    async def purge_knowledge_base(self, knowledge_base_id: str) -> dict:
+        """清理完成后删除已标记删除的知识库记录"""
+        result = await self.db.knowledge_bases.delete_one(
+            {"knowledge_base_id": knowledge_base_id, "deleted_at": {"$ne": None}}
+        )
+        return {"status": "success" if result.deleted_count > 0 else "failed"}
 
     async def update_knowledge_base_name(
         self, knowledge_base_id: str, new_name: str
@@ -725,6 +758,96 @@ class MongoDB:
             )
             return []
 
+    async def get_collection_name(self, knowledge_base_id: str) -> str:
+        """知识库当前用于检索的 Milvus 集合"""
+        kb = await self.db.knowledge_bases.find_one(
+            {"knowledge_base_id": knowledge_base_id}, {"collection_name": 1}
+        )
+        return (kb or {}).get("collection_name") or default_collection_name(
+            knowledge_base_id
+        )
+
+    async def get_write_collection_names(self, knowledge_base_id: str) -> List[str]:
+        """写入和删除向量时需要同步的集合，重建索引期间同时包含新集合"""
+        kb = await self.db.knowledge_bases.find_one(
+            {"knowledge_base_id": knowledge_base_id},
+            {"collection_name": 1, "reindex": 1},
+        )
+        kb = kb or {}
+        names = [kb.get("collection_name") or default_collection_name(knowledge_base_id)]
+        if reindex := kb.get("reindex"):
+            names.append(reindex["collection_name"])
+        return names
+
+    async def get_knowledge_base_reindex(
+        self, knowledge_base_id: str
+    ) -> Optional[Dict[str, Any]]:
+        return await self.db.knowledge_bases.find_one(
+            {"knowledge_base_id": knowledge_base_id},
+            {"username": 1, "collection_name": 1, "reindex": 1},
+        )
+
+    async def start_knowledge_base_reindex(
+        self, knowledge_base_id: str, task_id: str, collection_name: str
+    ) -> Dict[str, Any]:
+        """记录重建索引任务，同一知识库同时只能有一个"""
+        result = await self.db.knowledge_bases.update_one(
+            {"knowledge_base_id": knowledge_base_id, "reindex": {"$exists": False}},
+            {
+                "$set": {
+                    "reindex": {
+                        "task_id": task_id,
+                        "collection_name": collection_name,
+                        "started_at": beijing_time_now(),
+                    }
+                }
+            },
+        )
+        return {"status": "success" if result.modified_count > 0 else "failed"}
+
+    async def switch_knowledge_base_collection(
+        self, knowledge_base_id: str, task_id: str, collection_name: str
+    ) -> Dict[str, Any]:
+        """重建索引完成后切换检索集合，只有仍属于该任务时才切换"""
+        result = await self.db.knowledge_bases.update_one(
+            {"knowledge_base_id": knowledge_base_id, "reindex.task_id": task_id},
+            {
+                "$set": {
+                    "collection_name": collection_name,
+                    "last_modify_at": beijing_time_now(),
+                },
+                "$unset": {"reindex": ""},
+            },
+        )
+        return {"status": "success" if result.modified_count > 0 else "failed"}
+
+    async def cancel_knowledge_base_reindex(
+        self, knowledge_base_id: str
+    ) -> Optional[Dict[str, Any]]:
+        """取消重建索引，返回被取消的任务信息"""
+        kb = await self.db.knowledge_bases.find_one_and_update(
+            {"knowledge_base_id": knowledge_base_id, "reindex": {"$exists": True}},
+            {"$unset": {"reindex": ""}},
+            projection={"reindex": 1},
+        )
+        return kb["reindex"] if kb else None
+
+    async def get_knowledge_base_images(
+        self, knowledge_base_id: str
+    ) -> List[Dict[str, Any]]:
+        """知识库内所有文件及其页面图片"""
+        cursor = self.db.files.find(
+            {"knowledge_db_id": knowledge_base_id, "is_delete": False},
+            projection={
+                "_id": 0,
+                "file_id": 1,
+                "images.images_id": 1,
+                "images.minio_filename": 1,
+                "images.page_number": 1,
+            },
+        )
+        return await cursor.to_list(length=None)
+
     # files
     async def create_files(
         self,
@@ -734,6 +857,9 @@ class MongoDB:
         minio_filename: str,
         minio_url: str,
         knowledge_db_id: str,
+        content_hash: str = "",
+        images: Optional[list] = None,
+        ingest_status: str = "pending",
     ):
         """创建文件记录（带唯一索引保护）"""
         file = {
@@ -743,7 +869,9 @@ class MongoDB:
             "minio_filename": minio_filename,
             "minio_url": minio_url,
             "knowledge_db_id": knowledge_db_id,
-            "images": [],
+            "content_hash": content_hash,
+            "ingest_status": ingest_status,
+            "images": images or [],
             "created_at": beijing_time_now(),
             "last_modify_at": beijing_time_now(),
             "is_delete": False,
@@ -763,16 +891,26 @@ class MongoDB:
         minio_filename: str,
         minio_url: str,
         page_number: str,
+        renditions: Optional[Dict[str, str]] = None,
     ) -> Dict[str, Any]:
-        """向指定的 file_id 中添加解析的图片"""
+        """
+        向指定的 file_id 中添加解析的图片（同一 images_id 只添加一次）
+
+        renditions 为发送给LLM的各规格图片：规格名 -> MinIO 对象名
+        """
         images = {
             "images_id": images_id,
             "minio_filename": minio_filename,
             "minio_url": minio_url,
             "page_number": page_number,
+            "renditions": renditions or {},
         }
         result = await self.db.files.update_one(
-            {"file_id": file_id, "is_delete": False},
+            {
+                "file_id": file_id,
+                "is_delete": False,
+                "images.images_id": {"$ne": images_id},
+            },
             {
                 "$push": {
                     "images": images,
@@ -782,60 +920,151 @@ class MongoDB:
         )
         return {"status": "success" if result.modified_count > 0 else "failed"}
 
-    async def get_file_and_image_info(
-        self, file_id: str, image_id: str
-    ) -> Dict[str, Any]:
+    async def reset_file_images(self, file_id: str) -> List[Dict[str, Any]]:
+        """清空文件已保存的页面，返回被清空的页面（断点丢失后重新解析前调用）"""
+        file_doc = await self.db.files.find_one_and_update(
+            {"file_id": file_id, "is_delete": False},
+            {"$set": {"images": [], "last_modify_at": beijing_time_now()}},
+            projection={"images": 1},
+        )
+        images = (file_doc or {}).get("images") or []
+        if images:
+            await page_info_invalidation.publish(file_ids=[file_id])
+        return images
+
+    async def mark_file_processed(self, file_id: str, task_id: str) -> Dict[str, Any]:
+        """
+        标记文件已完成解析和向量写入，之后可以作为上传去重的来源
+        同时记录完成的任务ID，重放消息时据此跳过
+        """
+        result = await self.db.files.update_one(
+            {"file_id": file_id, "is_delete": False},
+            {
+                "$set": {
+                    "ingest_status": "completed",
+                    "last_modify_at": beijing_time_now(),
+                },
+                "$addToSet": {"ingested_tasks": task_id},
+            },
+        )
+        return {"status": "success" if result.modified_count > 0 else "failed"}
+
+    async def mark_files_ingest_failed(self, file_ids: List[str]) -> Dict[str, Any]:
+        """标记解析任务未能投递的文件"""
+        result = await self.db.files.update_many(
+            {"file_id": {"$in": file_ids}, "is_delete": False},
+            {
+                "$set": {
+                    "ingest_status": "failed",
+                    "last_modify_at": beijing_time_now(),
+                }
+            },
+        )
+        return {"status": "success" if result.modified_count > 0 else "failed"}
+
+    async def get_file_ingest_state(self, file_id: str, task_id: str) -> str:
         """
-        根据 file_id 和 image_id 获取：
-        - knowledge_db_id
-        - filename
-        - 文件的 minio_filename 和 minio_url
-        - 图片的 minio_filename 和 minio_url
+        返回文件在指定任务下的解析状态：
+        - missing: 文件不存在或已删除，无需处理
+        - completed: 该任务已处理完成
+        - pending: 需要处理
         """
-        # 查询文件文档，并匹配对应的图片
         file_doc = await self.db.files.find_one(
+            {"file_id": file_id, "is_delete": False},
+            projection={"ingested_tasks": 1},
+        )
+        if not file_doc:
+            return "missing"
+        if task_id in file_doc.get("ingested_tasks", []):
+            return "completed"
+        return "pending"
+
+    async def find_processed_file_by_hash(
+        self, username: str, content_hash: str
+    ) -> Optional[Dict[str, Any]]:
+        """查找该用户已解析完成的相同内容文件"""
+        return await self.db.files.find_one(
             {
-                "file_id": file_id,
+                "username": username,
+                "content_hash": content_hash,
                 "is_delete": False,
-                "images.images_id": image_id,  # 确保存在该 image_id 的图片
+                "ingest_status": "completed",
             },
             projection={
+                "file_id": 1,
                 "knowledge_db_id": 1,
-                "filename": 1,
-                "minio_filename": 1,  # 文件的 minio_filename
-                "minio_url": 1,  # 文件的 minio_url
-                "images.$": 1,  # 使用 $ 操作符获取匹配的第一个图片元素
+                "minio_filename": 1,
+                "minio_url": 1,
+                "content_hash": 1,
+                "images": 1,
             },
         )
 
-        if not file_doc:
-            return {"status": "failed", "message": "file_id or image_id not found"}
-
-        # 提取文件信息
-        knowledge_db_id = file_doc.get("knowledge_db_id")
-        file_name = file_doc.get("filename")
-        file_minio_filename = file_doc.get("minio_filename")
-        file_minio_url = file_doc.get("minio_url")  # 新增文件的 minio_url
-
-        # 提取图片信息
-        images = file_doc.get("images", [])
-        if not images:
-            return {"status": "failed", "message": "image not found"}
+    async def get_files_and_images_info(
+        self, hits: List[Dict[str, Any]]
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        批量获取检索命中页面的信息，返回 image_id -> 信息：file_id、knowledge_db_id、file_name、
+        文件和页面图片的 minio_filename / minio_url 以及 image_renditions
 
-        image_info = images[0]  # 因为使用了 $ 操作符，数组只有一个匹配元素
-        image_minio_filename = image_info.get("minio_filename")
-        image_minio_url = image_info.get("minio_url")  # 新增图片的 minio_url
+        未命中缓存的页面通过一次聚合查询获取；已删除或不存在的页面不在结果中
+        """
+        result = {}
+        missing = []
+        for hit in hits:
+            info = page_info_cache.get(hit["image_id"])
+            if info is not None and info["file_id"] == hit["file_id"]:
+                result[hit["image_id"]] = info
+            else:
+                missing.append(hit)
+        if not missing:
+            return result
 
-        # 返回所有字段
-        return {
-            "status": "success",
-            "knowledge_db_id": knowledge_db_id,
-            "file_name": file_name,
-            "file_minio_filename": file_minio_filename,
-            "file_minio_url": file_minio_url,  # 文件的 URL
-            "image_minio_filename": image_minio_filename,
-            "image_minio_url": image_minio_url,  # 图片的 URL
-        }
+        generation = page_info_cache.generation
+        image_ids = list({hit["image_id"] for hit in missing})
+        pipeline = [
+            {
+                "$match": {
+                    "file_id": {"$in": list({hit["file_id"] for hit in missing})},
+                    "is_delete": False,
+                }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "file_id": 1,
+                    "knowledge_db_id": 1,
+                    "filename": 1,
+                    "minio_filename": 1,
+                    "minio_url": 1,
+                    "images": {
+                        "$filter": {
+                            "input": "$images",
+                            "as": "image",
+                            "cond": {"$in": ["$$image.images_id", image_ids]},
+                        }
+                    },
+                }
+            },
+        ]
+        async for file_doc in self.db.files.aggregate(pipeline):
+            for image in file_doc.get("images") or []:
+                info = {
+                    "status": "success",
+                    "file_id": file_doc["file_id"],
+                    "knowledge_db_id": file_doc.get("knowledge_db_id"),
+                    "file_name": file_doc.get("filename"),
+                    "file_minio_filename": file_doc.get("minio_filename"),
+                    "file_minio_url": file_doc.get("minio_url"),
+                    "image_minio_filename": image.get("minio_filename"),
+                    "image_minio_url": image.get("minio_url"),
+                    "image_renditions": image.get("renditions") or {},
+                }
+                # 查询期间文件被标记删除时不写入缓存
+                if generation == page_info_cache.generation:
+                    page_info_cache.set(image["images_id"], info)
+                result[image["images_id"]] = info
+        return result
 
     async def delete_files_base(self, file_id: str) -> dict:
         """根据 knowledge_base_id 删除指定会话"""
@@ -849,6 +1078,74 @@ class MongoDB:
         else:
             return {"status": "failed", "message": "Knowledge Base not found"}
 
+    async def tombstone_files(self, file_ids: List[str]) -> int:
+        """标记删除文件，返回新标记的数量"""
+        if not file_ids:
+            return 0
+        result = await self.db.files.update_many(
+            {"file_id": {"$in": file_ids}, "is_delete": False},
+            {"$set": {"is_delete": True, "deleted_at": beijing_time_now()}},
+        )
+        await page_info_invalidation.publish(file_ids=file_ids)
+        return result.modified_count
+
+    async def get_deleted_file_ids(
+        self, knowledge_db_id: str, file_ids: Optional[List[str]] = None
+    ) -> List[str]:
+        """知识库中已标记删除、等待清理的文件，指定 file_ids 时只在其中查找"""
+        query = {"knowledge_db_id": knowledge_db_id, "deleted_at": {"$ne": None}}
+        if file_ids is not None:
+            query["file_id"] = {"$in": file_ids}
+        cursor = self.db.files.find(query, projection={"_id": 0, "file_id": 1})
+        return [doc["file_id"] for doc in await cursor.to_list(length=None)]
+
+    async def get_pending_cleanups(self, before, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        查找 before 之前标记删除但仍未清理的数据（清理消息发送失败或进入死信）
+
+        已删除的知识库整体清理；其余按知识库汇总已删除的文件
+        """
+        pending = []
+        cursor = self.db.knowledge_bases.find(
+            {"deleted_at": {"$ne": None, "$lt": before}},
+            projection={"_id": 0, "knowledge_base_id": 1, "username": 1},
+        ).limit(limit)
+        deleted_kbs = set()
+        async for kb in cursor:
+            deleted_kbs.add(kb["knowledge_base_id"])
+            pending.append(
+                {
+                    "knowledge_db_id": kb["knowledge_base_id"],
+                    "username": kb["username"],
+                    "file_ids": None,
+                    "drop_knowledge_base": True,
+                }
+            )
+
+        pipeline = [
+            {"$match": {"deleted_at": {"$ne": None, "$lt": before}}},
+            {
+                "$group": {
+                    "_id": "$knowledge_db_id",
+                    "username": {"$first": "$username"},
+                    "file_ids": {"$push": "$file_id"},
+                }
+            },
+            {"$limit": limit},
+        ]
+        async for group in self.db.files.aggregate(pipeline):
+            if group["_id"] in deleted_kbs:
+                continue
+            pending.append(
+                {
+                    "knowledge_db_id": group["_id"],
+                    "username": group["username"],
+                    "file_ids": group["file_ids"],
+                    "drop_knowledge_base": False,
+                }
+            )
+        return pending
+
     async def delete_files_bulk(self, file_ids: List[str]) -> dict:
         """批量删除文件记录及关联的 MinIO 文件"""
         # 去重处理
@@ -864,17 +1161,48 @@ class MongoDB:
         minio_files = []
         found_ids = set()
 
+        # 各规格的LLM图片随页面图片一起删除：页面图片对象名 -> 规格图片对象名
+        rendition_files = {}
+
         for file in files:
             found_ids.add(file["file_id"])
             # 主文件
             if main_file := file.get("minio_filename"):
                 minio_files.append(main_file)
             # 图片文件
-            minio_files.extend(
-                img["minio_filename"]
-                for img in file.get("images", [])
-                if img.get("minio_filename")
+            for img in file.get("images", []):
+                if img.get("minio_filename"):
+                    minio_files.append(img["minio_filename"])
+                    rendition_files[img["minio_filename"]] = list(
+                        (img.get("renditions") or {}).values()
+                    )
+
+        # 去重上传的文件与来源文件共享 MinIO 对象，仍被其他未删除文件引用的对象不删除；
+        # 已标记删除的文件不算引用，否则同时删除的文件会互相保留对方的对象
+        if minio_files:
+            shared_cursor = self.db.files.find(
+                {
+                    "file_id": {"$nin": unique_ids},
+                    "is_delete": {"$ne": True},
+                    "$or": [
+                        {"minio_filename": {"$in": minio_files}},
+                        {"images.minio_filename": {"$in": minio_files}},
+                    ],
+                },
+                projection={"minio_filename": 1, "images.minio_filename": 1},
             )
+            shared_files = set()
+            async for doc in shared_cursor:
+                shared_files.add(doc.get("minio_filename"))
+                shared_files.update(
+                    img.get("minio_filename") for img in doc.get("images", [])
+                )
+            minio_files = [name for name in minio_files if name not in shared_files]
+            minio_files += [
+                rendition
+                for name in minio_files
+                for rendition in rendition_files.get(name, [])
+            ]
 
         # 执行 MinIO 批量删除
         error_messages = []
@@ -887,14 +1215,15 @@ class MongoDB:
             error_messages.append(f"MinIO 批量删除异常: {str(e)}")
             logger.error(f"批量删除 MinIO 文件异常 | {str(e)}")
 
-        # 执行 MongoDB 批量删除
+        # 执行 MongoDB 批量删除（MinIO 删除失败时保留记录，由清理任务重试）
         db_success = 0
         try:
-            result = await self.db.files.bulk_write(
-                [DeleteMany({"file_id": {"$in": unique_ids}})]
-            )
-            db_success = result.deleted_count
-            logger.info(f"批量删除 mongo 数据库记录成功")
+            if not error_messages:
+                result = await self.db.files.bulk_write(
+                    [DeleteMany({"file_id": {"$in": unique_ids}})]
+                )
+                db_success = result.deleted_count
+                logger.info(f"批量删除 mongo 数据库记录成功")
         except Exception as e:
             error_messages.append(f"数据库删除失败: {str(e)}")
             logger.error(f"批量删除数据库记录失败 | {str(e)}")
@@ -1058,16 +1387,8 @@ class MongoDB:
             logger.warning(f"文件记录 {file_id} 不存在或不属于知识库 {knowledge_id}")
             return {"status": "failed", "message": "文件记录不存在或不属于该知识库"}
 
-        # 删除文件记录及MinIO中的文件
-        deletion_result = await self.delete_files_bulk([file_id])
-
-        if deletion_result["status"] != "success":
-            logger.error(f"删除文件 {file_id} 失败: {deletion_result}")
-            return {
-                "status": "partial_success",
-                "message": "文件已从知识库中移除，但删除文件记录或存储文件失败",
-                "detail": deletion_result,
-            }
+        # 标记删除文件记录，MinIO 文件和向量由后台清理任务删除
+        await self.tombstone_files([file_id])
 
         logger.info(f"成功从知识库 {knowledge_id} 删除文件 {file_id}")
         return {"status": "success", "message": "文件删除成功"}
@@ -1124,20 +1445,16 @@ class MongoDB:
             if doc["file_id"] in grouped.get(doc["knowledge_db_id"], []):
                 valid_files.append(doc["file_id"])
 
-        # 第三阶段：执行文件删除
-        deletion_result = await self.delete_files_bulk(valid_files)
+        # 第三阶段：标记删除文件，MinIO 文件和向量由后台清理任务删除
+        files_marked = await self.tombstone_files(valid_files)
 
         # 第四阶段：构建详细响应
         return {
-            "status": (
-                "success"
-                if deletion_result["status"] == "success"
-                else "partial_success"
-            ),
+            "status": "success",
             "detail": {
                 "total_requested": len(unique_pairs),
                 "valid_files_found": len(valid_files),
-                "file_deletion": deletion_result,
+                "files_marked": files_marked,
                 "knowledge_updates": {
                     "attempted": len(grouped),
                     "modified_count": (
@@ -1147,6 +1464,73 @@ class MongoDB:
             },
         }
 
+    # dead letters
+    async def add_dead_letter(
+        self,
+        dead_letter_id: str,
+        origin_topic: str,
+        value: str,
+        headers: List[List[str]],
+        attempts: int,
+        error: str,
+    ) -> Dict[str, Any]:
+        """记录超过最大重试次数的解析消息，供管理员查看和重放"""
+        try:
+            message = json.loads(value)
+        except ValueError:
+            message = {}
+        dead_letter = {
+            "dead_letter_id": dead_letter_id,
+            "task_id": message.get("task_id", ""),
+            "username": message.get("username", ""),
+            "knowledge_db_id": message.get("knowledge_db_id", ""),
+            "filename": message.get("file_meta", {}).get("original_filename", ""),
+            "origin_topic": origin_topic,
+            "value": value,
+            "headers": headers,
+            "attempts": attempts,
+            "error": error,
+            "status": "dead",
+            "created_at": beijing_time_now(),
+            "replayed_at": None,
+        }
+        await self.db.dead_letters.insert_one(dead_letter)
+        return {"status": "success", "dead_letter_id": dead_letter_id}
+
+    async def get_dead_letters_with_pagination(
+        self, status: str = "dead", skip: int = 0, limit: int = 10
+    ) -> Dict[str, Any]:
+        pipeline = [
+            {"$match": {"status": status}},
+            {"$sort": {"created_at": -1}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "value": 0,
+                    "headers": 0,
+                }
+            },
+            {
+                "$facet": {
+                    "metadata": [{"$count": "total"}],
+                    "data": [{"$skip": skip}, {"$limit": limit}],
+                }
+            },
+        ]
+        cursor = self.db.dead_letters.aggregate(pipeline)
+        result = await cursor.to_list(length=1)
+        return parse_aggregate_result(result)
+
+    async def get_dead_letter(self, dead_letter_id: str) -> Optional[Dict[str, Any]]:
+        return await self.db.dead_letters.find_one({"dead_letter_id": dead_letter_id})
+
+    async def mark_dead_letter_replayed(self, dead_letter_id: str) -> Dict[str, Any]:
+        result = await self.db.dead_letters.update_one(
+            {"dead_letter_id": dead_letter_id, "status": "dead"},
+            {"$set": {"status": "replayed", "replayed_at": beijing_time_now()}},
+        )
+        return {"status": "success" if result.modified_count > 0 else "failed"}
+
 
 mongodb = MongoDB()
 
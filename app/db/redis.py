@@ -28,6 +28,9 @@ class Redis:
     async def get_lock_connection(self):
         return await self.get_redis_connection(settings.redis_lock_db)
 
+    async def get_cache_connection(self):
+        return await self.get_redis_connection(settings.redis_cache_db)
+
     async def close(self):
         for pool in self.redis_pools.values():
             await pool.disconnect()
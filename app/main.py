@@ -10,11 +10,15 @@ from app.framework.app_framework import FastAPIFramework
 
 
 from app.db.mysql_session import mysql
-from app.db.mongo import mongodb
+from app.db.mongo import mongodb, page_info_invalidation
 from app.db.redis import redis
 from app.db.miniodb import async_minio_manager
+from app.rag.cleanup import tombstone_sweeper
+from app.rag.embed_batcher import embedding_batcher
+from app.rag.model_config_cache import model_config_cache
 from app.utils.kafka_producer import kafka_producer_manager
 from app.utils.kafka_consumer import kafka_consumer_manager
+from app.utils.kafka_retry import kafka_retry_scheduler
 
 # 创建 FastAPIFramework 实例
 framework = FastAPIFramework(debug_mode=settings.debug_mode)
@@ -46,13 +50,34 @@ async def lifespan(app: FastAPI):
     await mongodb.connect()  # 连接 MongoDB
     await kafka_producer_manager.start()  # 启动Kafka生产者
     await async_minio_manager.init_minio()
-    # await kafka_consumer_manager.start()  # 启动Kafka消费者
-    asyncio.create_task(kafka_consumer_manager.consume_messages())  # 启动Kafka消费者
+    # 接收其他实例发出的模型配置和页面元数据失效消息
+    model_config_task = asyncio.create_task(model_config_cache.run())
+    page_info_task = asyncio.create_task(page_info_invalidation.run())
+    # 文件解析可以交给独立 worker（python -m app.worker），避免影响聊天接口延迟
+    consumer_task = None
+    retry_task = None
+    sweeper_task = None
+    if settings.kafka_consumer_in_api:
+        consumer_task = asyncio.create_task(
+            kafka_consumer_manager.consume_messages()
+        )  # 启动Kafka消费者
+        retry_task = asyncio.create_task(kafka_retry_scheduler.run())  # 重试调度
+        sweeper_task = asyncio.create_task(tombstone_sweeper.run())  # 遗留删除标记的清理
 
     yield
     # 关闭事件处理代码可以放在这里
+    if consumer_task:
+        consumer_task.cancel()
+        await kafka_consumer_manager.stop()  # 停止Kafka消费者
+        await embedding_batcher.stop()
+    if retry_task:
+        retry_task.cancel()
+        await kafka_retry_scheduler.stop()
+    if sweeper_task:
+        sweeper_task.cancel()
+    model_config_task.cancel()
+    page_info_task.cancel()
     await kafka_producer_manager.stop()  # 停止Kafka生产者
-    # await kafka_consumer_manager.stop()  # 停止Kafka消费者
     await mysql.close()  # 关闭 MySQL 连接
     await mongodb.close()  # 关闭 MongoDB 连接
     await redis.close()  # 关闭 Redis 连接
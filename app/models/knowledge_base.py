@@ -27,4 +27,10 @@ class PageResponse(BaseModel):
 
 class BulkDeleteRequestItem(BaseModel):
     knowledge_id: str
-    file_id: str
\ No newline at end of file
+    file_id: str
+
+class RetrieveRequest(BaseModel):
+    username: str
+    query: str
+    knowledge_base_ids: List[str]
+    top_K: int = 3
\ No newline at end of file
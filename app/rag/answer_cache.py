@@ -0,0 +1,83 @@
+import hashlib
+import json
+import re
+import unicodedata
+from app.core.config import settings
+from app.core.logging import logger
+from app.db.redis import redis
+
+
+def knowledge_base_version_key(knowledge_db_id):
+    return f"answer_cache_version:{knowledge_db_id}"
+
+
+async def bump_knowledge_base_version(knowledge_db_id):
+    """
+    知识库内容变化（文件解析完成、删除、重建索引）后使该知识库上的缓存答案失效
+
+    版本号是缓存键的一部分，旧版本的缓存不再命中，过期后自动删除
+    """
+    if not settings.answer_cache_enabled:
+        return
+    try:
+        connection = await redis.get_cache_connection()
+        await connection.incr(knowledge_base_version_key(knowledge_db_id))
+    except Exception as e:
+        logger.warning(f"Bump answer cache version of {knowledge_db_id} failed: {e}")
+
+
+def normalize_question(question):
+    """统一全半角和大小写，去掉标点并合并空白，只有这些差异的问题视为同一问题"""
+    text = unicodedata.normalize("NFKC", question).casefold()
+    text = "".join(
+        " " if unicodedata.category(char).startswith("P") else char for char in text
+    )
+    return re.sub(r"\s+", " ", text).strip()
+
+
+async def answer_cache_key(
+    knowledge_db_ids, image_ids, model_name, system_prompt, question
+):
+    """
+    同一问题（规范化后的文本相同）在检索到的页面、知识库版本、模型和系统提示词都相同时共用一个缓存键
+
+    检索到相同页面的不同问题答案不同，不按问题向量的相似度复用
+    """
+    connection = await redis.get_cache_connection()
+    knowledge_db_ids = sorted(set(knowledge_db_ids))
+    versions = (
+        await connection.mget(
+            [knowledge_base_version_key(kb_id) for kb_id in knowledge_db_ids]
+        )
+        if knowledge_db_ids
+        else []
+    )
+    digest = hashlib.sha256(
+        json.dumps(
+            {
+                "knowledge_bases": dict(zip(knowledge_db_ids, versions)),
+                "image_ids": image_ids,
+                "model_name": model_name,
+                "system_prompt": system_prompt,
+                "question": normalize_question(question),
+            },
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+    return f"answer_cache:{digest}"
+
+
+async def get_cached_answer(key):
+    """返回缓存的答案，没有时返回 None"""
+    connection = await redis.get_cache_connection()
+    raw = await connection.get(key)
+    return json.loads(raw) if raw else None
+
+
+async def set_cached_answer(key, question, answer):
+    connection = await redis.get_cache_connection()
+    await connection.set(
+        key,
+        json.dumps({"question": question, "answer": answer}),
+        ex=settings.answer_cache_ttl,
+    )
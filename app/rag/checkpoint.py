@@ -0,0 +1,70 @@
+import json
+from app.core.config import settings
+
+# 单页处理阶段，按顺序推进
+PAGE_STAGES = ("rendered", "uploaded", "embedded", "indexed")
+
+
+class IngestCheckpoint:
+    """
+    文件解析的逐页断点状态，保存在 Redis hash ingest:{task_id}:{file_id} 中
+
+    - page:{n} 字段记录第 n 页的阶段以及 image_id / minio_filename 等信息
+    - 其余字段记录文件级状态（总页数、是否已计入任务进度、是否完成）
+    """
+
+    def __init__(self, redis, task_id: str, file_id: str):
+        self.redis = redis
+        self.key = f"ingest:{task_id}:{file_id}"
+        self.pages = {}
+        self.meta = {}
+
+    async def load(self):
+        data = await self.redis.hgetall(self.key)
+        for field, value in data.items():
+            if field.startswith("page:"):
+                self.pages[int(field[len("page:") :])] = json.loads(value)
+            else:
+                self.meta[field] = value
+        return self
+
+    @property
+    def total_pages(self) -> int:
+        return int(self.meta.get("total_pages", 0))
+
+    @property
+    def completed(self) -> bool:
+        return self.meta.get("status") == "completed"
+
+    def reached(self, page_number: int, stage: str) -> bool:
+        """第 page_number 页是否已经完成 stage 阶段"""
+        page = self.pages.get(page_number)
+        if not page:
+            return False
+        return PAGE_STAGES.index(page["stage"]) >= PAGE_STAGES.index(stage)
+
+    def first_incomplete_page(self, total_pages: int) -> int:
+        """第一个尚未写入 Milvus 的页码（从 1 开始），全部完成时返回 total_pages + 1"""
+        for page_number in range(1, total_pages + 1):
+            if not self.reached(page_number, "indexed"):
+                return page_number
+        return total_pages + 1
+
+    async def set_page(self, page_number: int, stage: str, **fields) -> dict:
+        page = {**self.pages.get(page_number, {}), **fields, "stage": stage}
+        self.pages[page_number] = page
+        await self.redis.hset(self.key, f"page:{page_number}", json.dumps(page))
+        await self.redis.expire(self.key, settings.ingest_checkpoint_expire)
+        return page
+
+    async def set_meta(self, **fields):
+        self.meta.update({k: str(v) for k, v in fields.items()})
+        await self.redis.hset(self.key, mapping=fields)
+        await self.redis.expire(self.key, settings.ingest_checkpoint_expire)
+
+    async def mark_counted(self) -> bool:
+        """标记该文件已计入任务进度，只有第一次调用返回 True"""
+        return bool(await self.redis.hsetnx(self.key, "counted", 1))
+
+    async def mark_completed(self):
+        await self.set_meta(status="completed")
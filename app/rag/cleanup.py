@@ -0,0 +1,161 @@
+import asyncio
+import uuid
+from datetime import timedelta
+from aiokafka.errors import KafkaError
+from app.core.config import settings
+from app.core.logging import logger
+from app.db.milvus import milvus_client
+from app.db.mongo import get_mongo
+from app.db.redis import redis
+from app.rag.answer_cache import bump_knowledge_base_version
+from app.rag.utils import (
+    init_task_progress,
+    publish_task_progress,
+    update_task_progress,
+)
+from app.utils.kafka_producer import kafka_producer_manager
+from app.utils.timezone import beijing_time_now
+
+
+def cleanup_pending_key(knowledge_db_id):
+    # 已投递、尚未执行的清理任务，定期检查时跳过
+    return f"cleanup_pending:{knowledge_db_id}"
+
+
+async def enqueue_cleanup(
+    redis_connection, username, knowledge_db_id, file_ids=None, drop_knowledge_base=False
+):
+    """
+    投递清理任务，返回任务ID
+
+    消息发送失败时只记录日志，遗留的删除标记由 TombstoneSweeper 稍后重新投递
+    """
+    task_id = f"{username}_{uuid.uuid4()}"
+    await bump_knowledge_base_version(knowledge_db_id)
+    await init_task_progress(
+        redis_connection,
+        task_id,
+        username,
+        len(file_ids) if file_ids else 0,
+        task_type="cleanup",
+    )
+    try:
+        await kafka_producer_manager.send_cleanup_task(
+            task_id, username, knowledge_db_id, file_ids, drop_knowledge_base
+        )
+        await redis_connection.set(
+            cleanup_pending_key(knowledge_db_id),
+            task_id,
+            ex=int(settings.cleanup_sweep_grace),
+        )
+    except KafkaError as e:
+        logger.error(f"Send cleanup task of {knowledge_db_id} failed: {e}")
+        await update_task_progress(
+            redis_connection, task_id, "retrying", "Cleanup scheduled for later"
+        )
+    return task_id
+
+
+async def run_cleanup(
+    redis_connection, task_id, knowledge_db_id, file_ids=None, drop_knowledge_base=False
+):
+    """
+    分批删除已标记删除的文件（Milvus 向量、MinIO 文件和数据库记录），
+    知识库被删除时最后删除其 Milvus 集合和知识库记录
+
+    只处理仍带有删除标记的记录，重复执行是安全的；失败时抛出异常由消费者重试
+    """
+    db = await get_mongo()
+    file_ids = await db.get_deleted_file_ids(
+        knowledge_db_id, None if drop_knowledge_base else file_ids
+    )
+    collection_names = await db.get_write_collection_names(knowledge_db_id)
+    processed = int(await redis_connection.hget(f"task:{task_id}", "processed") or 0)
+    await redis_connection.hset(
+        f"task:{task_id}",
+        mapping={
+            "status": "processing",
+            "total": processed + len(file_ids),
+            "message": f"Cleaning up {len(file_ids)} files...",
+        },
+    )
+    await publish_task_progress(redis_connection, task_id)
+
+    # pymilvus 是同步调用，放到线程池执行，避免阻塞消费者的事件循环
+    for start in range(0, len(file_ids), settings.cleanup_batch_size):
+        batch = file_ids[start : start + settings.cleanup_batch_size]
+        # 整个集合稍后会被删除，无需逐个删除向量
+        if not drop_knowledge_base:
+            for collection_name in collection_names:
+                if await asyncio.to_thread(
+                    milvus_client.check_collection, collection_name
+                ):
+                    await asyncio.to_thread(
+                        milvus_client.delete_files, collection_name, batch
+                    )
+        result = await db.delete_files_bulk(batch)
+        if result["status"] == "partial_success":
+            raise RuntimeError(f"Delete files failed: {result['detail']['errors']}")
+        await redis_connection.hincrby(f"task:{task_id}", "processed", len(batch))
+        await publish_task_progress(redis_connection, task_id)
+
+    if drop_knowledge_base:
+        for collection_name in collection_names:
+            await asyncio.to_thread(milvus_client.delete_collection, collection_name)
+        await db.purge_knowledge_base(knowledge_db_id)
+
+    await redis_connection.delete(cleanup_pending_key(knowledge_db_id))
+    await update_task_progress(
+        redis_connection, task_id, "completed", "Deleted data cleaned up"
+    )
+    logger.info(
+        f"task:{task_id}: cleaned up {len(file_ids)} files of {knowledge_db_id}"
+        + (" and dropped the knowledge base" if drop_knowledge_base else "")
+    )
+
+
+class TombstoneSweeper:
+    """
+    定期重新投递遗留的清理任务
+
+    标记删除超过 cleanup_sweep_grace 仍未清理的数据（清理消息发送失败、进入死信或实例崩溃），
+    由任一实例重新投递；通过 Redis 锁保证每个周期只有一个实例执行
+    """
+
+    def __init__(self):
+        self.lock_name = "cleanup_sweep_lock"
+
+    async def sweep(self):
+        lock_connection = await redis.get_lock_connection()
+        # 不释放锁，过期前其他实例跳过本周期
+        lock = lock_connection.lock(
+            self.lock_name, timeout=int(settings.cleanup_sweep_interval)
+        )
+        if not await lock.acquire(blocking=False):
+            return
+
+        db = await get_mongo()
+        task_connection = await redis.get_task_connection()
+        before = beijing_time_now() - timedelta(seconds=settings.cleanup_sweep_grace)
+        for item in await db.get_pending_cleanups(before):
+            if await task_connection.exists(cleanup_pending_key(item["knowledge_db_id"])):
+                continue
+            await enqueue_cleanup(
+                task_connection,
+                item["username"],
+                item["knowledge_db_id"],
+                item["file_ids"],
+                item["drop_knowledge_base"],
+            )
+            logger.info(f"Re-enqueue cleanup of {item['knowledge_db_id']}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(settings.cleanup_sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping deleted data: {e}")
+
+
+tombstone_sweeper = TombstoneSweeper()
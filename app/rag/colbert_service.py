@@ -28,7 +28,10 @@ class ColBERTService:
             ColQwen2_5_Processor,
             ColQwen2_5_Processor.from_pretrained(
                 model_path, 
-                size={"shortest_edge": 56 * 56, "longest_edge": 28 * 28 * 768}
+                size={
+                    "shortest_edge": settings.embed_min_pixels,
+                    "longest_edge": settings.embed_max_pixels,
+                },
             ),
         )
 
@@ -53,7 +56,7 @@ class ColBERTService:
         return qs
 
     def process_image(self, images: List) -> List[List[float]]:
-        batch_size = 1 # if len(images) > 2 else len(images)
+        batch_size = settings.embed_model_batch_size
         dataloader = DataLoader(
             dataset=ListDataset[str](images),
             batch_size=batch_size,
@@ -66,7 +69,15 @@ class ColBERTService:
             with torch.no_grad():
                 batch_doc = {k: v.to(self.model.device) for k, v in batch_doc.items()}
                 embeddings_doc = self.model(**batch_doc)
-            ds.extend(list(torch.unbind(embeddings_doc.to("cpu"))))
+            # 去掉批内补齐位置对应的零向量
+            attention_mask = batch_doc["attention_mask"].to("cpu").bool()
+            embeddings_doc = embeddings_doc.to("cpu")
+            ds.extend(
+                embedding[mask]
+                for embedding, mask in zip(
+                    torch.unbind(embeddings_doc), torch.unbind(attention_mask)
+                )
+            )
         for i in range(len(ds)):
             ds[i] = ds[i].float().tolist()
         return ds
@@ -0,0 +1,139 @@
+import copy
+import math
+import re
+from app.core.config import settings
+
+# 中日韩文字按每字一个 token 估算，其余按每 4 个字符一个 token 估算
+CJK_PATTERN = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]")
+IMAGE_PLACEHOLDER = "[图片已省略]"
+# 没有页面尺寸信息时按 A4 纵向页面估算宽高
+PAGE_ASPECT_RATIO = 297 / 210
+
+
+def estimate_text_tokens(text):
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def source_pixels():
+    """渲染出的页面图片的像素数：按 llm_render_dpi 渲染，未配置时按嵌入模型像素预算渲染"""
+    if settings.llm_render_dpi:
+        return max(
+            int(
+                (210 / 25.4 * settings.llm_render_dpi)
+                * (297 / 25.4 * settings.llm_render_dpi)
+            ),
+            settings.embed_max_pixels,
+        )
+    return settings.embed_max_pixels
+
+
+def image_pixels(rendition):
+    """发送给模型的页面图片的像素数，规格图片由渲染图片缩小得到，不会超过渲染图片"""
+    spec = settings.llm_image_renditions.get(rendition)
+    if spec:
+        return min(spec["max_pixels"], source_pixels())
+    return source_pixels()
+
+
+def estimate_image_tokens(provider_type, rendition):
+    """
+    估算单张页面图片占用的 token 数
+
+    qwen / ollama（Qwen-VL 等）每 28x28 像素一个 token；
+    其他 OpenAI 兼容接口按短边缩放到 768 后每 512x512 切块 170 token 加 85 token 估算
+    """
+    if provider_type in settings.chat_image_tokens:
+        return settings.chat_image_tokens[provider_type]
+    pixels = image_pixels(rendition)
+    if provider_type in ("qwen", "ollama"):
+        return math.ceil(pixels / (28 * 28)) + 2
+    width = math.sqrt(pixels / PAGE_ASPECT_RATIO)
+    height = width * PAGE_ASPECT_RATIO
+    scale = min(1, 768 / width)
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return 85 + 170 * tiles
+
+
+def content_items(message):
+    content = message.get("content")
+    if isinstance(content, list):
+        return content
+    return [{"type": "text", "text": content or ""}]
+
+
+def estimate_message_text_tokens(message):
+    return sum(
+        estimate_text_tokens(item.get("text"))
+        for item in content_items(message)
+        if item.get("type") == "text"
+    )
+
+
+def plan_context(
+    system_message, history, pages, question, provider_type, rendition, budget=None
+):
+    """
+    在 token 预算内按优先级组装提示词：当前问题 → 排名靠前的检索页面 → 最近的历史消息
+
+    history 为按时间顺序排列的历史消息，按 用户/AI 成对取舍，预算不足时先把较早轮次中的图片
+    替换为文字占位，仍放不下的轮次及更早的轮次整体丢弃；pages 为按排名排列的检索页面图片。
+    budget 为 0 表示不限制。返回保留的历史消息、页面以及估算结果
+    """
+    budget = settings.chat_context_token_budget if budget is None else budget
+    image_tokens = estimate_image_tokens(provider_type, rendition)
+    used = estimate_message_text_tokens(system_message) + estimate_text_tokens(question)
+
+    def fits(tokens):
+        return not budget or used + tokens <= budget
+
+    kept_pages = []
+    for page in pages:
+        if not fits(image_tokens):
+            break
+        kept_pages.append(page)
+        used += image_tokens
+
+    turns = []
+    for message in history:
+        if not message:
+            continue
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+
+    kept_turns = []
+    dropped_images = 0
+    for turn in reversed(turns):
+        text_tokens = sum(estimate_message_text_tokens(message) for message in turn)
+        if not fits(text_tokens):
+            break
+        used += text_tokens
+        turn = copy.deepcopy(turn)
+        for message in turn:
+            if not isinstance(message.get("content"), list):
+                continue
+            for index, item in enumerate(message["content"]):
+                if item.get("type") != "image_url":
+                    continue
+                if fits(image_tokens):
+                    used += image_tokens
+                else:
+                    message["content"][index] = {
+                        "type": "text",
+                        "text": IMAGE_PLACEHOLDER,
+                    }
+                    used += estimate_text_tokens(IMAGE_PLACEHOLDER)
+                    dropped_images += 1
+        kept_turns.insert(0, turn)
+
+    return {
+        "history": [message for turn in kept_turns for message in turn],
+        "pages": kept_pages,
+        "tokens": used,
+        "dropped_pages": len(pages) - len(kept_pages),
+        "dropped_turns": len(turns) - len(kept_turns),
+        "dropped_images": dropped_images,
+    }
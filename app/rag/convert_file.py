@@ -1,32 +1,189 @@
+import asyncio
 from io import BytesIO
+import hashlib
+import math
 import os
+import re
 from fastapi import UploadFile
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
+from PIL import Image
+from app.core.config import settings
 from app.db.miniodb import async_minio_manager
 from bson.objectid import ObjectId
 import time
 from app.core.logging import logger
+from app.utils.stage_timer import stage_timer
 
-async def convert_file_to_images(file_content):
-    # Read the contents of the uploaded file
-    images = convert_from_bytes(file_content)
-    images_buffer = []
+async def get_page_count(file_content):
+    info = pdfinfo_from_bytes(file_content)
+    return int(info["Pages"])
+
+
+def get_page_sizes(file_content, first_page, last_page):
+    """读取每页的物理尺寸（单位 pt，1/72 英寸）"""
+    info = pdfinfo_from_bytes(file_content, first_page=first_page, last_page=last_page)
+    sizes = {}
+    for key, value in info.items():
+        key_match = re.match(r"Page\s+(\d+) size", key)
+        size_match = re.match(r"([\d.]+) x ([\d.]+)", str(value))
+        if key_match and size_match:
+            sizes[int(key_match.group(1))] = (
+                float(size_match.group(1)),
+                float(size_match.group(2)),
+            )
+    return [sizes.get(page) for page in range(first_page, last_page + 1)]
+
+
+def compute_render_dpi(page_size, max_pixels=None):
+    """
+    根据页面物理尺寸计算渲染 DPI，使渲染像素数不超过嵌入模型处理器保留的像素预算
+    """
+    max_pixels = max_pixels or settings.embed_max_pixels
+    if not page_size:
+        return settings.render_max_dpi
+    width, height = page_size
+    dpi = int(72 * math.sqrt(max_pixels / (width * height)))
+    return min(max(dpi, settings.render_min_dpi), settings.render_max_dpi)
+
+
+def fit_to_pixels(image, max_pixels):
+    """等比缩小图片使像素数不超过 max_pixels"""
+    width, height = image.size
+    if width * height <= max_pixels:
+        return image
+    scale = math.sqrt(max_pixels / (width * height))
+    return image.resize(
+        (max(1, int(width * scale)), max(1, int(height * scale))),
+        Image.Resampling.LANCZOS,
+    )
+
+
+def image_to_buffer(image):
+    buffer = BytesIO()
+
+    # 保存图像到内存缓冲区
+    image.save(buffer, format="PNG", optimize=True)
+
+    # 重置指针位置（关键步骤，参考MinIO上传逻辑）
+    buffer.seek(0)
+    return buffer
+
+
+# 图片格式 -> (扩展名, MIME 类型)
+IMAGE_FORMATS = {
+    "PNG": ("png", "image/png"),
+    "JPEG": ("jpg", "image/jpeg"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+
+def image_mime_type(file_name):
+    """根据对象名的扩展名判断图片的 MIME 类型，未知的按 PNG 处理"""
+    extension = os.path.splitext(file_name)[1].lstrip(".").lower()
+    for format_extension, mime_type in IMAGE_FORMATS.values():
+        if extension == format_extension:
+            return mime_type
+    return "image/png"
+
+
+def rendition_image_name(minio_filename, name):
+    """页面图片某个规格的对象名，由原图对象名确定，重试时不会产生新对象"""
+    extension = IMAGE_FORMATS[settings.llm_image_renditions[name]["format"]][0]
+    return f"{os.path.splitext(minio_filename)[0]}_{name}.{extension}"
+
+
+def encode_rendition(image, spec):
+    """按规格缩小并编码发送给LLM的页面图片"""
+    image = fit_to_pixels(image, spec["max_pixels"])
+    if spec["format"] == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, format=spec["format"], quality=spec.get("quality", 85))
+    buffer.seek(0)
+    return buffer
+
+
+def render_pages(file_content, first_page, last_page):
+    """
+    按页计算 DPI 渲染 PDF，连续的相同 DPI 页合并为一次 pdftoppm 调用
+
+    配置了 llm_render_dpi 时按该 DPI 渲染发送给 LLM 的图片，
+    嵌入用的图片从中缩小到模型像素预算，不再重复渲染；
+    同时按 llm_image_renditions 生成各规格的LLM图片，请求时无需再缩放
+    """
+    page_sizes = get_page_sizes(file_content, first_page, last_page)
+    dpis = [
+        max(compute_render_dpi(size), settings.llm_render_dpi)
+        for size in page_sizes
+    ]
+
+    pages = []
+    group_start = 0
+    for i in range(1, len(dpis) + 1):
+        if i < len(dpis) and dpis[i] == dpis[group_start]:
+            continue
+        with stage_timer.measure("render", count=i - group_start):
+            images = convert_from_bytes(
+                file_content,
+                dpi=dpis[group_start],
+                first_page=first_page + group_start,
+                last_page=first_page + i - 1,
+            )
+        for image in images:
+            with stage_timer.measure("encode"):
+                embed_image = fit_to_pixels(image, settings.embed_max_pixels)
+                embed_buffer = image_to_buffer(embed_image)
+                llm_buffer = (
+                    image_to_buffer(image) if embed_image is not image else embed_buffer
+                )
+                renditions = {
+                    name: encode_rendition(image, spec)
+                    for name, spec in settings.llm_image_renditions.items()
+                }
+            pages.append((embed_buffer, llm_buffer, renditions))
+        group_start = i
+    return pages
+
+
+def stored_image_to_embed_buffer(image_bytes):
+    """已保存的页面图片缩小到嵌入模型的像素预算，无需重新渲染 PDF"""
+    image = Image.open(BytesIO(image_bytes))
+    embed_image = fit_to_pixels(image, settings.embed_max_pixels)
+    if embed_image is image:
+        return BytesIO(image_bytes)
+    return image_to_buffer(embed_image)
+
+
+async def convert_file_to_images(file_content, first_page=None, last_page=None):
+    """
+    将文件解析为图片，返回每页的 (嵌入用图片, 发送给LLM的图片, {规格名: 该规格的图片}) 缓冲区
+    """
+    if first_page is None:
+        first_page = 1
+    if last_page is None:
+        last_page = await get_page_count(file_content)
 
     time_start = time.time()
-    for i, image in enumerate(images):
-        buffer = BytesIO()
-
-        # 保存图像到内存缓冲区
-        image.save(buffer, format="PNG", optimize=True)
-    
-        # 重置指针位置（关键步骤，参考MinIO上传逻辑）
-        buffer.seek(0)
-        images_buffer.append(buffer)
-    spending_time = time.time() - time_start 
-    logger.info(f"convert file to {len(images)} images spend time {spending_time}s")
+    # pdftoppm 和 PNG 编码都是阻塞操作，放到线程池中执行
+    images_buffer = await asyncio.get_event_loop().run_in_executor(
+        None, render_pages, file_content, first_page, last_page
+    )
+    spending_time = time.time() - time_start
+    logger.info(
+        f"convert file to {len(images_buffer)} images spend time {spending_time}s"
+    )
 
     return images_buffer
 
+async def compute_file_hash(uploadfile: UploadFile, chunk_size: int = 1024 * 1024):
+    # 分块计算上传文件的内容哈希，计算完成后将指针重置到开头
+    sha256 = hashlib.sha256()
+    while chunk := await uploadfile.read(chunk_size):
+        sha256.update(chunk)
+    await uploadfile.seek(0)
+    return sha256.hexdigest()
+
+
 async def save_file_to_minio(username:str, uploadfile: UploadFile):
     # 将生成的图像上传到 MinIO
     file_name = f"{username}_{os.path.splitext(uploadfile.filename)[0]}_{ObjectId()}{os.path.splitext(uploadfile.filename)[1]}"
@@ -37,9 +194,13 @@ async def save_file_to_minio(username:str, uploadfile: UploadFile):
     # minio_url = minio_url.replace("localhost:9110", "127.0.0.1:9110")
     return file_name, minio_url
 
-async def save_image_to_minio(username, filename, image_stream):
-    # 将生成的图像上传到 MinIO
-    file_name = f"{username}_{os.path.splitext(filename)[0]}_{ObjectId()}.png"
+def build_image_name(username, filename):
+    return f"{username}_{os.path.splitext(filename)[0]}_{ObjectId()}.png"
+
+
+async def save_image_to_minio(username, filename, image_stream, file_name=None):
+    # 将生成的图像上传到 MinIO，断点续传时沿用之前分配的对象名
+    file_name = file_name or build_image_name(username, filename)
     await async_minio_manager.upload_image(file_name, image_stream)
     minio_url = await async_minio_manager.create_presigned_url(file_name)
 #
@@ -0,0 +1,163 @@
+import asyncio
+from collections import deque
+from app.core.config import settings
+from app.core.logging import logger
+from app.rag.get_embedding import get_embeddings_from_httpx
+
+
+class EmbeddingBatcher:
+    """
+    页面级嵌入队列
+
+    多个文件并发提交的页面被打包成固定大小的批次请求 /embed_image，
+    每页的向量再通过 future 返回给提交它的文件。
+    页面按优先级分为两个通道（priority 与 Kafka 消息头一致，0 为最高），
+    组批时高优先级页面优先，同时按 embed_priority_weight 给普通页面保留份额避免饿死。
+    一批中的页面来自不同文件，整批请求失败时逐页重试，只让出错的页面失败
+    """
+
+    def __init__(
+        self,
+        batch_size=None,
+        max_wait=None,
+        max_concurrent_batches=None,
+        priority_weight=None,
+    ):
+        self.batch_size = batch_size or settings.embed_batch_size
+        self.max_wait = settings.embed_batch_wait if max_wait is None else max_wait
+        self.max_concurrent_batches = (
+            max_concurrent_batches or settings.embed_max_concurrent_batches
+        )
+        self.priority_weight = priority_weight or settings.embed_priority_weight
+        self.high_lane = deque()
+        self.normal_lane = deque()
+        self.has_items = None
+        self.worker = None
+        self.semaphore = None
+        self.batch_tasks = set()  # 进行中的批次请求
+
+    def _ensure_worker(self):
+        if self.has_items is None:
+            self.has_items = asyncio.Event()
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_batches)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+
+    @property
+    def pending(self) -> int:
+        return len(self.high_lane) + len(self.normal_lane)
+
+    async def embed(self, image_buffer, name: str, priority: int = 1):
+        """提交单页图片，返回该页的多向量嵌入"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        lane = self.high_lane if int(priority) <= 0 else self.normal_lane
+        lane.append((name, image_buffer, future))
+        self.has_items.set()
+        return await future
+
+    async def embed_many(self, items, priority: int = 1):
+        """items 为 (name, image_buffer) 列表，按顺序返回嵌入"""
+        return await asyncio.gather(
+            *[self.embed(image_buffer, name, priority) for name, image_buffer in items]
+        )
+
+    async def _wait_for_items(self, timeout=None):
+        self.has_items.clear()
+        await asyncio.wait_for(self.has_items.wait(), timeout)
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        while not self.pending:
+            await self._wait_for_items()
+        deadline = loop.time() + self.max_wait
+        while self.pending < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                await self._wait_for_items(timeout)
+            except asyncio.TimeoutError:
+                break
+
+        # 普通页面至少占 1/(weight+1)，其余位置优先给高优先级页面
+        normal_share = 0
+        if self.normal_lane:
+            normal_share = min(
+                len(self.normal_lane),
+                max(1, self.batch_size // (self.priority_weight + 1)),
+            )
+        high_take = min(len(self.high_lane), self.batch_size - normal_share)
+        normal_take = min(len(self.normal_lane), self.batch_size - high_take)
+        batch = [self.high_lane.popleft() for _ in range(high_take)]
+        batch += [self.normal_lane.popleft() for _ in range(normal_take)]
+        # 调用方已取消（例如文件处理失败）的页面不再请求
+        return [item for item in batch if not item[2].done()]
+
+    async def _run(self):
+        while True:
+            # 先等到有空闲的请求槽位再组批，让等待期间到达的高优先级页面进入本批
+            await self.semaphore.acquire()
+            batch = await self._collect_batch()
+            if not batch:
+                self.semaphore.release()
+                continue
+            task = asyncio.create_task(self._embed_batch(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def stop(self):
+        """停止组批并等待进行中的批次完成，尚未组批的页面被取消"""
+        if self.worker is not None:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+            self.worker = None
+        await asyncio.gather(*self.batch_tasks, return_exceptions=True)
+        for lane in (self.high_lane, self.normal_lane):
+            while lane:
+                _, _, future = lane.popleft()
+                future.cancel()
+
+    async def _embed_items(self, items):
+        images_request = []
+        for name, image_buffer, _ in items:
+            image_buffer.seek(0)  # 重试时缓冲区已被读取过
+            images_request.append(("images", (name, image_buffer, "image/png")))
+        embeddings = await get_embeddings_from_httpx(
+            images_request, endpoint="embed_image"
+        )
+        for (_, _, future), embedding in zip(items, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    async def _embed_batch(self, batch):
+        try:
+            try:
+                await self._embed_items(batch)
+                return
+            except Exception as e:
+                if len(batch) == 1:
+                    self._fail(batch[0], e)
+                    return
+                logger.warning(
+                    f"Embedding batch of {len(batch)} pages failed, retry page by page: {e}"
+                )
+            for item in batch:
+                if item[2].done():
+                    continue
+                try:
+                    await self._embed_items([item])
+                except Exception as e:
+                    self._fail(item, e)
+        finally:
+            self.semaphore.release()
+
+    @staticmethod
+    def _fail(item, error):
+        name, _, future = item
+        logger.error(f"Embedding page {name} failed: {error}")
+        if not future.done():
+            future.set_exception(error)
+
+
+embedding_batcher = EmbeddingBatcher()
@@ -29,7 +29,10 @@ async def get_embeddings_from_httpx(
                     timeout=120.0  # 根据文件大小调整超时
                 )
             response.raise_for_status()
-            return np.array(response.json()["embeddings"])
+            if "text" in endpoint:
+                return np.array(response.json()["embeddings"])
+            # 不同页面的向量个数可能不同，逐页转换
+            return [np.array(embedding) for embedding in response.json()["embeddings"]]
         except httpx.HTTPStatusError as e:
             raise Exception(f"HTTP request failed: {e}")
         except json.JSONDecodeError as e:
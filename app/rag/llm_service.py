@@ -1,5 +1,6 @@
 # services/chat_service.py
-import json
+import asyncio
+import time
 from typing import AsyncGenerator
 from app.db.mongo import get_mongo
 from app.models.conversation import UserMessage
@@ -7,10 +8,19 @@ from openai import AsyncOpenAI
 
 
 from app.rag.mesage import find_depth_parent_mesage
+from app.core.config import settings
 from app.core.logging import logger
 from app.db.milvus import milvus_client
 from app.rag.get_embedding import get_embeddings_from_httpx
-from app.rag.utils import replace_image_content, sort_and_filter
+from app.rag.answer_cache import (
+    answer_cache_key,
+    get_cached_answer,
+    set_cached_answer,
+)
+from app.rag.context_planner import plan_context
+from app.rag.model_config_cache import model_config_cache
+from app.rag.utils import prefetch_images, replace_image_content, sort_and_filter
+from app.utils.sse import DeltaCoalescer, iter_with_timeout, sse_event
 
 # LiteLLM 相关导入
 try:
@@ -21,74 +31,178 @@ except ImportError:
     acompletion = None
 
 
+async def timed(timing: dict, stage: str, awaitable):
+    """等待 awaitable 并把耗时（毫秒）记入 timing[stage]"""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timing[stage] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def get_image_rendition(model_name):
+    """模型使用的页面图片规格，None 表示发送原图"""
+    rendition = settings.llm_image_model_renditions.get(
+        model_name, settings.llm_image_default_rendition
+    )
+    return rendition if rendition in settings.llm_image_renditions else None
+
+
+async def search_knowledge_base(db, knowledge_db_id, query_embedding, top_K, timing=None):
+    """在知识库当前的检索集合中搜索，Milvus 同步调用放到线程池执行"""
+    collection_name = await db.get_collection_name(knowledge_db_id)
+    loop = asyncio.get_event_loop()
+    if not await loop.run_in_executor(
+        None, milvus_client.check_collection, collection_name
+    ):
+        return []
+    return await loop.run_in_executor(
+        None, milvus_client.search, collection_name, query_embedding, top_K, timing
+    )
+
+
+async def search_knowledge_bases(db, knowledge_db_ids, query_embedding, top_K, timing=None):
+    """
+    并发搜索所有知识库，返回按分数排序的前 top_K 个结果
+
+    timing 不为 None 时在 timing[知识库ID] 中记录各知识库的检索耗时
+    """
+    results = await asyncio.gather(
+        *[
+            search_knowledge_base(
+                db,
+                knowledge_db_id,
+                query_embedding,
+                top_K,
+                None if timing is None else timing.setdefault(knowledge_db_id, {}),
+            )
+            for knowledge_db_id in knowledge_db_ids
+        ]
+    )
+    result_score = [score for scores in results for score in scores]
+    sorted_score = sort_and_filter(result_score, min_score=10)
+    return sorted_score[:top_K]
+
+
+async def retrieve(db, knowledge_db_ids, query_embedding, top_K, timing):
+    """
+    检索知识库并查询命中页面的文件和图片信息，返回按分数排序的页面列表
+
+    聊天和 /retrieve 接口共用；timing 中记录 search、metadata 耗时，
+    knowledge_bases 中记录各知识库的 ann / fetch / rerank 耗时
+    """
+    cut_score = await timed(
+        timing,
+        "search",
+        search_knowledge_bases(
+            db,
+            knowledge_db_ids,
+            query_embedding,
+            top_K,
+            timing.setdefault("knowledge_bases", {}),
+        ),
+    )
+    file_and_image_infos = await timed(
+        timing, "metadata", db.get_files_and_images_info(cut_score)
+    )
+    pages = []
+    for score in cut_score:
+        # 已标记删除、尚未清理的文件不在结果中
+        file_and_image_info = file_and_image_infos.get(score["image_id"])
+        if not file_and_image_info:
+            continue
+        pages.append(
+            {
+                **file_and_image_info,
+                "score": float(score["score"]),
+                "image_id": score["image_id"],
+                "page_number": score["page_number"],
+            }
+        )
+    return pages
+
+
 class ChatService:
 
     @staticmethod
     async def create_chat_stream(
         user_message_content: UserMessage, message_id: str
     ) -> AsyncGenerator[str, None]:
-        """创建聊天流并处理存储逻辑"""
+        """
+        创建聊天流并处理存储逻辑
+
+        调用模型前的准备按依赖关系并发执行：模型配置 ‖ 历史消息 ‖ 问题向量 → 并发检索各知识库
+        → 批量查询命中页面信息 ‖ 下载历史消息中的图片 → 在 token 预算内组装提示词；
+        结束时发送各阶段耗时、首字延迟和提示词估算结果（timing 事件）
+        """
+        start_time = time.perf_counter()
+        timing = {}
         db = await get_mongo()
 
-        # 获取system prompt
-        model_config = await db.get_conversation_model_config(
-            user_message_content.conversation_id
-        )
+        # 统一使用 LiteLLM 处理所有模型
+        if not LITELLM_AVAILABLE:
+            raise Exception("LiteLLM is required but not available. Please install with: pip install litellm")
+
+        def embed_query():
+            return asyncio.create_task(
+                timed(
+                    timing,
+                    "embed_query",
+                    get_embeddings_from_httpx(
+                        [user_message_content.user_message], endpoint="embed_text"
+                    ),
+                )
+            )
 
+        # 只在有知识库需要检索时计算问题向量：有临时知识库时立即开始，
+        # 否则在模型配置（通常来自进程内缓存）返回后与读取历史消息并发进行
+        embedding_task = embed_query() if user_message_content.temp_db else None
+
+        async def get_model_config():
+            nonlocal embedding_task
+            model_config = await timed(
+                timing,
+                "model_config",
+                model_config_cache.get(db, user_message_content.conversation_id),
+            )
+            if embedding_task is None and model_config and model_config["base_used"]:
+                embedding_task = embed_query()
+            return model_config
+
+        try:
+            # 获取system prompt
+            model_config, history_messages = await asyncio.gather(
+                get_model_config(),
+                timed(
+                    timing,
+                    "history",
+                    find_depth_parent_mesage(
+                        user_message_content.conversation_id,
+                        user_message_content.parent_id,
+                        MAX_PARENT_DEPTH=5,
+                    ),
+                ),
+            )
+        except BaseException:
+            if embedding_task is not None:
+                embedding_task.cancel()
+            raise
+
+        # 已截断到允许范围，见 resolve_model_config
         model_name = model_config["model_name"]
-        model_url = model_config["model_url"] 
-        api_key = model_config["api_key"]     
+        model_url = model_config["model_url"]
+        api_key = model_config["api_key"]
         base_used = model_config["base_used"]
-        provider_type = model_config.get("provider_type", "qwen")
+        provider_type = model_config["provider_type"]
 
         print(f"Provider: {provider_type}, Model: {model_name}")
-
-        # 统一使用 LiteLLM 处理所有模型
-        if not LITELLM_AVAILABLE:
-            raise Exception("LiteLLM is required but not available. Please install with: pip install litellm")
-        
         print(f"🚀 Using unified LiteLLM architecture for all models")
 
         system_prompt = model_config["system_prompt"]
-        if len(system_prompt) > 1048576:
-            system_prompt = system_prompt[0:1048576]
-
         temperature = model_config["temperature"]
-        if temperature < 0 and not temperature == -1:
-            temperature = 0
-        elif temperature > 1:
-            temperature = 1
-        else:
-            pass
-
         max_length = model_config["max_length"]
-        if max_length < 1024 and not max_length == -1:
-            max_length = 1024
-        elif max_length > 1048576:
-            max_length = 1048576
-        else:
-            pass
-
         top_P = model_config["top_P"]
-        if top_P < 0 and not top_P == -1:
-            top_P = 0
-        elif top_P > 1:
-            top_P = 1
-        else:
-            pass
-
         top_K = model_config["top_K"]
-        if top_K == -1:
-            top_K = 3
-        elif top_K < 1:
-            top_K = 1
-        elif top_K > 30:
-            top_K = 30
-        else:
-            pass
-
-        if not system_prompt:
-            system_prompt = "All outputs in Markdown format, especially mathematical formulas in Latex format($formula$)."
 
         # 组合内置提示词和自定义提示词
         built_in_prompt = """你是一个多模态AI助手，可以同时处理文本和图片信息。当用户提问时：重点关注图片中的关键信息：文字、图表、表格、数据等
@@ -113,17 +227,21 @@ class ChatService:
             }
         ]
 
-        history_messages = await find_depth_parent_mesage(
-            user_message_content.conversation_id,
-            user_message_content.parent_id,
-            MAX_PARENT_DEPTH=5,
-        )
+        history = [
+            history_messages[i - 1]
+            for i in range(len(history_messages), 0, -1)
+            if history_messages[i - 1]
+        ]
 
-        for i in range(len(history_messages), 0, -1):
-            messages.append(history_messages[i - 1])
+        # 历史消息中的图片与检索并发下载到缓存
+        rendition = get_image_rendition(model_name)
+        history_images_task = asyncio.create_task(
+            timed(timing, "history_images", prefetch_images(history, rendition))
+        )
 
         # 处理用户上传的文件
-        content = []
+        page_items = []
+        page_image_ids = []
         bases = []
         if user_message_content.temp_db:
             bases.append({"baseId": user_message_content.temp_db})
@@ -131,51 +249,62 @@ class ChatService:
         # 搜索知识库匹配内容
         bases.extend(base_used)
         file_used = []
-        if bases:
-            result_score = []
-            query_embedding = await get_embeddings_from_httpx(
-                [user_message_content.user_message], endpoint="embed_text"
-            )
-            for base in bases:
-                collection_name = f"colqwen{base['baseId'].replace('-', '_')}"
-                if milvus_client.check_collection(collection_name):
-                    scores = milvus_client.search(
-                        collection_name, data=query_embedding[0], topk=top_K
-                    )
-                    result_score.extend(scores)
-            sorted_score = sort_and_filter(result_score, min_score=10)
-            if len(sorted_score) >= top_K:
-                cut_score = sorted_score[:top_K]
-            else:
-                cut_score = sorted_score
-
-            # 获取minio name并转成URL，按分数排序
-            for idx, score in enumerate(cut_score):
-                file_and_image_info = await db.get_file_and_image_info(
-                    score["file_id"], score["image_id"]
-                )
-                
-                # 根据排名添加优先级标识
-                file_used.append(
-                    {
-                        "score": score["score"],
-                        "knowledge_db_id": file_and_image_info["knowledge_db_id"],
-                        "file_name": file_and_image_info["file_name"],
-                        "image_url": file_and_image_info["image_minio_url"],
-                        "file_url": file_and_image_info["file_minio_url"],
-                    }
-                )
-                
-                content.append(
-                    {
-                        "type": "image_url",
-                        "image_url": file_and_image_info["image_minio_filename"],
-                    }
+        try:
+            if bases:
+                query_embedding = await embedding_task
+                pages = await retrieve(
+                    db,
+                    [base["baseId"] for base in bases],
+                    query_embedding[0],
+                    top_K,
+                    timing,
                 )
-
-                print(file_and_image_info["image_minio_url"]) 
+                # 按分数排序，根据排名添加优先级标识
+                for page in pages:
+                    file_used.append(
+                        {
+                            "score": page["score"],
+                            "knowledge_db_id": page["knowledge_db_id"],
+                            "file_name": page["file_name"],
+                            "image_url": page["image_minio_url"],
+                            "file_url": page["file_minio_url"],
+                        }
+                    )
+                    page_items.append(
+                        {
+                            "type": "image_url",
+                            "image_url": page["image_minio_filename"],
+                            "renditions": page["image_renditions"],
+                        }
+                    )
+                    page_image_ids.append(page["image_id"])
+
+                    print(page["image_minio_url"])
+        except BaseException:
+            if embedding_task is not None:
+                embedding_task.cancel()
+            history_images_task.cancel()
+            raise
+
+        # 在 token 预算内按 当前问题 → 检索页面 → 最近的历史消息 的优先级组装提示词
+        context = plan_context(
+            messages[0],
+            history,
+            page_items,
+            user_message_content.user_message,
+            provider_type,
+            rendition,
+        )
+        file_used = file_used[: len(context["pages"])]
+        messages.extend(context["history"])
+        context_stats = {k: v for k, v in context.items() if k not in ("history", "pages")}
+        if context["dropped_pages"] or context["dropped_turns"] or context["dropped_images"]:
+            logger.info(
+                f"chat '{user_message_content.conversation_id}' context trimmed: {context_stats}"
+            )
 
         # 用户输入
+        content = context["pages"]
         content.append(
             {
                 "type": "text",
@@ -188,10 +317,38 @@ class ChatService:
             "content": content
         }
         messages.append(user_message)
-        send_messages = await replace_image_content(messages)
+
+        # 没有历史消息时查找相同问题的缓存答案，命中时直接回放，不再下载图片和调用模型
+        answer_key = None
+        cached_answer = None
+        if settings.answer_cache_enabled and bases and not context["history"]:
+            try:
+                answer_key = await answer_cache_key(
+                    [base["baseId"] for base in bases],
+                    page_image_ids[: len(context["pages"])],
+                    model_name,
+                    combined_system_prompt,
+                    user_message_content.user_message,
+                )
+                cached_answer = await timed(
+                    timing, "answer_cache", get_cached_answer(answer_key)
+                )
+            except Exception as e:
+                logger.warning(f"Answer cache lookup failed: {e}")
+                answer_key = None
+
+        if cached_answer:
+            history_images_task.cancel()
+            send_messages = []
+        else:
+            await history_images_task
+            send_messages = await timed(
+                timing, "images", replace_image_content(messages, rendition)
+            )
+        timing["setup"] = round((time.perf_counter() - start_time) * 1000, 1)
         
         # 发送 file_used 信息
-        file_used_payload = json.dumps(
+        yield sse_event(
             {
                 "type": "file_used",
                 "data": file_used,  # 这里直接使用已构建的 file_used 列表
@@ -199,16 +356,28 @@ class ChatService:
                 "model_name": model_name,
             }
         )
-        yield f"data: {file_used_payload}\n\n"
 
         # 根据模型支持情况选择调用方式
         full_response = []
         total_token = 0
         completion_tokens = 0
         prompt_tokens = 0
+        failed = False
+        coalescer = DeltaCoalescer(message_id)
         
         try:
-            if LITELLM_AVAILABLE:
+            if cached_answer:
+                # 按普通回答的事件格式分段回放缓存的答案
+                answer = cached_answer["answer"]
+                timing["ttft"] = round((time.perf_counter() - start_time) * 1000, 1)
+                step = settings.answer_cache_replay_chunk
+                for start in range(0, len(answer), step):
+                    content_chunk = answer[start : start + step]
+                    full_response.append(content_chunk)
+                    yield sse_event(
+                        {"type": "text", "data": content_chunk, "message_id": message_id}
+                    )
+            elif LITELLM_AVAILABLE:
                 print("🚀 Using LiteLLM for unified API call...")
                 
                 # 根据 provider_type 设置模型名称格式
@@ -243,38 +412,42 @@ class ChatService:
 
                 response = await acompletion(**litellm_params)
                 
-                # 处理 LiteLLM 流响应
-                async for chunk in response:
+                # 处理 LiteLLM 流响应，连续的小增量合并后发送，缓冲超时未满时也会发送
+                async for chunk in iter_with_timeout(response, coalescer.timeout):
+                    if chunk is None:
+                        for event in coalescer.flush():
+                            yield event
+                        continue
                     if hasattr(chunk, 'choices') and chunk.choices:
                         delta = chunk.choices[0].delta
+                        if "ttft" not in timing and (
+                            getattr(delta, "reasoning_content", None)
+                            or getattr(delta, "content", None)
+                        ):
+                            timing["ttft"] = round(
+                                (time.perf_counter() - start_time) * 1000, 1
+                            )
 
                         if (hasattr(delta, "reasoning_content") and delta.reasoning_content != None):
-                            # 用JSON封装内容，自动处理换行符等特殊字符
-                            payload = json.dumps(
-                                {
-                                    "type": "thinking",
-                                    "data": delta.reasoning_content,
-                                    "message_id": message_id,
-                                }
-                            )
-                            yield f"data: {payload}\n\n"
+                            for event in coalescer.add("thinking", delta.reasoning_content):
+                                yield event
 
                         if hasattr(delta, 'content') and delta.content:
                             content_chunk = delta.content
-                            payload = json.dumps(
-                                {"type": "text", "data": content_chunk, "message_id": message_id}
-                            )
                             full_response.append(content_chunk)
-                            yield f"data: {payload}\n\n"
+                            for event in coalescer.add("text", content_chunk):
+                                yield event
                             
                     # 处理 token 统计
                     if hasattr(chunk, 'usage') and chunk.usage:
+                        for event in coalescer.flush():
+                            yield event
                         usage = chunk.usage
                         total_token = getattr(usage, 'total_tokens', 0)
                         completion_tokens = getattr(usage, 'completion_tokens', 0)
                         prompt_tokens = getattr(usage, 'prompt_tokens', 0)
                         
-                        payload = json.dumps(
+                        yield sse_event(
                             {
                                 "type": "token",
                                 "total_token": total_token,
@@ -283,14 +456,40 @@ class ChatService:
                                 "message_id": message_id,
                             }
                         )
-                        yield f"data: {payload}\n\n"
+                for event in coalescer.flush():
+                    yield event
                         
         except Exception as e:
+            for event in coalescer.flush():
+                yield event
             error_msg = f"API call error (LiteLLM): {str(e)}"
             print(f"Error: {error_msg}")
             print(f"Exception details: {type(e).__name__}: {str(e)}")
             
-            yield f"data: {json.dumps({'type': 'error', 'data': error_msg})}\n\n"
+            yield sse_event({"type": "error", "data": error_msg})
+            failed = True
+
+        if answer_key and not cached_answer and not failed and full_response:
+            try:
+                await set_cached_answer(
+                    answer_key,
+                    user_message_content.user_message,
+                    "".join(full_response),
+                )
+            except Exception as e:
+                logger.warning(f"Save answer cache failed: {e}")
+
+        # 各阶段耗时（毫秒），ttft 为收到请求到模型输出第一个 token 的时间
+        logger.info(f"chat '{user_message_content.conversation_id}' timing: {timing}")
+        yield sse_event(
+            {
+                "type": "timing",
+                "data": timing,
+                "context": context_stats,
+                "answer_cache_hit": bool(cached_answer),
+                "message_id": message_id,
+            }
+        )
 
         ai_message = {"role": "assistant", "content": "".join(full_response)}
         # 保存AI响应到mongodb
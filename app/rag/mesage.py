@@ -1,40 +1,26 @@
 from app.db.mongo import get_mongo
 
 
-async def find_parent_mesage(conversation_id, message_id):
+async def find_depth_parent_mesage(conversation_id, message_id, MAX_PARENT_DEPTH=5):
+    """
+    从 message_id 开始沿父消息向上收集历史消息（由近到远，每轮先 AI 后用户）
 
+    一次查询取出会话所有轮次，按 message_id 建立索引后逐级查找
+    """
     db = await get_mongo()
+    turns = {
+        turn["message_id"]: turn
+        for turn in await db.get_conversation_turns(conversation_id)
+    }
 
-    message = None
-    conversation = await db.get_conversation(conversation_id)
-    if not conversation:
-        return message
-
-    for turn in conversation["turns"]:
-        if message_id == turn["message_id"]:
-            messages = {
-                    "message_id": turn["message_id"],
-                    "parent_message_id": turn["parent_message_id"],
-                    "user_message": turn["user_message"],
-                    "temp_db": turn["temp_db"],
-                    "ai_message": turn["ai_message"],
-                    "file_used": turn["file_used"],
-                    "status": turn["status"],
-                    "timestamp": turn["timestamp"].isoformat(),
-                }
-            
-            break
-    return messages
-
-
-async def find_depth_parent_mesage(conversation_id, message_id, MAX_PARENT_DEPTH=5):
-    
     parent_stack = []
 
     while message_id and len(parent_stack) < MAX_PARENT_DEPTH:
-        parent_messages = await find_parent_mesage(conversation_id, message_id)
-        message_id = parent_messages.get("parent_message_id","")
-        parent_stack.append(parent_messages.get("ai_message"))
-        parent_stack.append(parent_messages.get("user_message"))
+        turn = turns.get(message_id)
+        if not turn:
+            break
+        message_id = turn.get("parent_message_id", "")
+        parent_stack.append(turn.get("ai_message"))
+        parent_stack.append(turn.get("user_message"))
 
-    return parent_stack
\ No newline at end of file
+    return parent_stack
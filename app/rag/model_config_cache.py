@@ -0,0 +1,87 @@
+from app.core.config import settings
+from app.utils.cache import TTLCache
+from app.utils.cache_invalidation import InvalidationChannel
+
+DEFAULT_SYSTEM_PROMPT = "All outputs in Markdown format, especially mathematical formulas in Latex format($formula$)."
+
+
+def clamp(value, low, high):
+    # -1 表示使用模型默认值，保持不变
+    if value == -1:
+        return value
+    return min(max(value, low), high)
+
+
+def clamp_top_k(top_K):
+    """检索页数：-1 表示默认 3 页，其余截断到 1~30"""
+    if top_K == -1:
+        return 3
+    return min(max(top_K, 1), 30)
+
+
+def resolve_model_config(model_config):
+    """把会话保存的模型配置整理为聊天直接使用的参数，超出范围的值截断到允许范围"""
+    return {
+        "model_name": model_config["model_name"],
+        "model_url": model_config["model_url"],
+        "api_key": model_config["api_key"],
+        "base_used": model_config["base_used"],
+        "provider_type": model_config.get("provider_type", "qwen"),
+        "system_prompt": model_config["system_prompt"][0:1048576]
+        or DEFAULT_SYSTEM_PROMPT,
+        "temperature": clamp(model_config["temperature"], 0, 1),
+        "max_length": clamp(model_config["max_length"], 1024, 1048576),
+        "top_P": clamp(model_config["top_P"], 0, 1),
+        "top_K": clamp_top_k(model_config["top_K"]),
+    }
+
+
+class ModelConfigCache:
+    """
+    会话模型配置的进程内缓存，省去每轮聊天查询一次 MongoDB
+
+    修改会话配置或用户模型配置后调用 invalidate，通过 Redis 发布订阅通知所有实例删除缓存；
+    订阅中断期间由 ttl 兜底
+    """
+
+    def __init__(self):
+        self.cache = TTLCache(
+            settings.model_config_cache_size, settings.model_config_cache_ttl
+        )
+        self.invalidation = InvalidationChannel(
+            "model_config_invalidation", self.discard, self.cache.clear
+        )
+
+    async def get(self, db, conversation_id):
+        """返回整理后的模型配置，会话不存在时返回 None；返回值共享，不要修改"""
+        item = self.cache.get(conversation_id)
+        if item is not None:
+            return item[1]
+        generation = self.cache.generation
+        model_config = await db.get_conversation_model_config(conversation_id)
+        if model_config is None:
+            return None
+        resolved = resolve_model_config(model_config)
+        # 查询期间发生失效时不写入缓存，避免写回旧配置
+        if generation == self.cache.generation:
+            # 会话ID以用户名开头，按用户失效时使用
+            self.cache.set(conversation_id, (conversation_id.split("_")[0], resolved))
+        return resolved
+
+    def discard(self, conversation_id=None, username=None):
+        if conversation_id:
+            self.cache.discard(conversation_id)
+        if username:
+            self.cache.discard_if(lambda item: item[0] == username)
+
+    async def invalidate(self, conversation_id=None, username=None):
+        """删除指定会话或用户所有会话的缓存，并通知其他实例"""
+        await self.invalidation.publish(
+            conversation_id=conversation_id, username=username
+        )
+
+    async def run(self):
+        await self.invalidation.run()
+
+
+model_config_cache = ModelConfigCache()
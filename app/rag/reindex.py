@@ -0,0 +1,227 @@
+import asyncio
+import uuid
+from app.core.config import settings
+from app.core.logging import logger
+from app.db.milvus import default_collection_name, milvus_client
+from app.db.miniodb import async_minio_manager
+from app.db.mongo import get_mongo
+from app.rag.answer_cache import bump_knowledge_base_version
+from app.rag.convert_file import stored_image_to_embed_buffer
+from app.rag.embed_batcher import embedding_batcher
+from app.rag.utils import (
+    init_task_progress,
+    insert_to_milvus,
+    publish_task_progress,
+    update_task_progress,
+)
+from app.utils.kafka_producer import kafka_producer_manager
+
+
+def reindex_done_key(task_id):
+    # 已写入新集合的 image_id，任务重试时跳过
+    return f"reindex:{task_id}"
+
+
+async def start_reindex(redis, knowledge_db_id):
+    """
+    创建新集合并登记重建索引任务，返回任务信息
+
+    登记后该知识库新解析的文件会同时写入新集合
+    """
+    db = await get_mongo()
+    kb = await db.get_knowledge_base_reindex(knowledge_db_id)
+    if not kb:
+        return {"status": "failed", "message": "Knowledge base not found"}
+    if kb.get("reindex"):
+        return {
+            "status": "failed",
+            "message": "Reindex already running",
+            "task_id": kb["reindex"]["task_id"],
+        }
+
+    username = kb["username"]
+    task_id = f"{username}_{uuid.uuid4()}"
+    collection_name = (
+        f"{default_collection_name(knowledge_db_id)}_{uuid.uuid4().hex[:8]}"
+    )
+    await asyncio.get_event_loop().run_in_executor(
+        None, milvus_client.create_collection, collection_name
+    )
+    result = await db.start_knowledge_base_reindex(
+        knowledge_db_id, task_id, collection_name
+    )
+    if result["status"] != "success":
+        await asyncio.get_event_loop().run_in_executor(
+            None, milvus_client.delete_collection, collection_name
+        )
+        return {"status": "failed", "message": "Reindex already running"}
+
+    await init_task_progress(redis, task_id, username, 1, task_type="reindex")
+    await update_task_progress(redis, task_id, "processing", "Waiting for reindex...")
+    return {
+        "status": "success",
+        "task_id": task_id,
+        "username": username,
+        "collection_name": collection_name,
+    }
+
+
+async def cancel_reindex(redis, knowledge_db_id):
+    """取消重建索引并删除新集合，正在执行的任务会在下一批之前停止"""
+    db = await get_mongo()
+    reindex = await db.cancel_knowledge_base_reindex(knowledge_db_id)
+    if not reindex:
+        return {"status": "failed", "message": "No reindex running"}
+    await asyncio.get_event_loop().run_in_executor(
+        None, milvus_client.delete_collection, reindex["collection_name"]
+    )
+    await update_task_progress(redis, reindex["task_id"], "cancelled", "Reindex cancelled")
+    return {"status": "success", "task_id": reindex["task_id"]}
+
+
+async def reindex_page(collection_name, file_id, image):
+    """从MinIO读取已保存的页面图片，重新嵌入后写入新集合"""
+    image_bytes = await async_minio_manager.get_file_from_minio(
+        image["minio_filename"]
+    )
+    loop = asyncio.get_event_loop()
+    embed_buffer = await loop.run_in_executor(
+        None, stored_image_to_embed_buffer, image_bytes
+    )
+    embedding = await embedding_batcher.embed(embed_buffer, image["minio_filename"])
+    # 先清理该页在新集合中已有的向量（上次中断或解析时双写），保证重复执行不产生重复向量
+    await loop.run_in_executor(
+        None, milvus_client.delete_images, collection_name, [image["images_id"]]
+    )
+    await insert_to_milvus(
+        collection_name,
+        [embedding],
+        [image["images_id"]],
+        file_id,
+        page_numbers=[int(image["page_number"]) - 1],
+    )
+
+
+async def is_reindex_active(db, knowledge_db_id, task_id):
+    kb = await db.get_knowledge_base_reindex(knowledge_db_id)
+    reindex = (kb or {}).get("reindex")
+    return bool(reindex) and reindex["task_id"] == task_id
+
+
+async def run_reindex(redis, task_id, knowledge_db_id):
+    """
+    用当前嵌入模型重建知识库的向量索引
+
+    按批限速重新嵌入已保存的页面图片并写入新集合，全部完成后切换知识库的检索集合；
+    旧集合由延迟投递的消息在进行中的检索结束后删除，不占用当前消息的处理槽位
+    """
+    db = await get_mongo()
+    kb = await db.get_knowledge_base_reindex(knowledge_db_id)
+    reindex = (kb or {}).get("reindex")
+    if not reindex or reindex["task_id"] != task_id:
+        logger.info(f"task:{task_id}: reindex of {knowledge_db_id} not active, skip")
+        return
+    collection_name = reindex["collection_name"]
+    old_collection = kb.get("collection_name") or default_collection_name(
+        knowledge_db_id
+    )
+
+    done_key = reindex_done_key(task_id)
+    done = set(await redis.smembers(done_key))
+    file_ids = set()
+    # 第二轮补齐第一轮期间仍在解析的文件新增的页面
+    for _ in range(2):
+        files = await db.get_knowledge_base_images(knowledge_db_id)
+        file_ids.update(file["file_id"] for file in files)
+        pages = [
+            (file["file_id"], image)
+            for file in files
+            for image in file.get("images", [])
+            if image["images_id"] not in done
+        ]
+        if not pages:
+            break
+        await redis.hset(
+            f"task:{task_id}",
+            mapping={
+                "status": "processing",
+                "message": f"Reindexing {len(pages)} pages...",
+                "pages_total": len(done) + len(pages),
+                "pages_processed": len(done),
+            },
+        )
+        await publish_task_progress(redis, task_id)
+
+        for start in range(0, len(pages), settings.reindex_batch_size):
+            if not await is_reindex_active(db, knowledge_db_id, task_id):
+                logger.info(f"task:{task_id}: reindex of {knowledge_db_id} cancelled")
+                return
+            batch = pages[start : start + settings.reindex_batch_size]
+            await asyncio.gather(
+                *[
+                    reindex_page(collection_name, file_id, image)
+                    for file_id, image in batch
+                ]
+            )
+            image_ids = [image["images_id"] for _, image in batch]
+            done.update(image_ids)
+            await redis.sadd(done_key, *image_ids)
+            await redis.expire(done_key, settings.ingest_checkpoint_expire)
+            await redis.hincrby(f"task:{task_id}", "pages_processed", len(batch))
+            await publish_task_progress(redis, task_id)
+            await asyncio.sleep(settings.reindex_batch_interval)
+
+    # 重建期间被删除的文件可能在删除之后又被写入新集合
+    live_file_ids = {
+        file["file_id"] for file in await db.get_knowledge_base_images(knowledge_db_id)
+    }
+    deleted_file_ids = list(file_ids - live_file_ids)
+    if deleted_file_ids:
+        await asyncio.get_event_loop().run_in_executor(
+            None, milvus_client.delete_files, collection_name, deleted_file_ids
+        )
+
+    # 先登记删除旧集合，投递失败时整个任务重试；切换失败时旧集合仍在使用，不会被删除
+    await kafka_producer_manager.send_drop_collection_task(
+        task_id, knowledge_db_id, old_collection, settings.reindex_drop_delay
+    )
+    result = await db.switch_knowledge_base_collection(
+        knowledge_db_id, task_id, collection_name
+    )
+    if result["status"] != "success":
+        logger.info(f"task:{task_id}: reindex of {knowledge_db_id} cancelled")
+        return
+    await bump_knowledge_base_version(knowledge_db_id)
+    await redis.delete(done_key)
+    await redis.hset(f"task:{task_id}", "processed", 1)
+    await update_task_progress(
+        redis, task_id, "completed", "Knowledge base reindexed successfully"
+    )
+    logger.info(
+        f"task:{task_id}: {knowledge_db_id} switched to {collection_name}, "
+        f"drop {old_collection} in {settings.reindex_drop_delay}s"
+    )
+
+
+async def drop_old_collection(task_id, knowledge_db_id, collection_name):
+    """
+    删除重建索引前的旧集合，仍是知识库的检索集合时跳过
+
+    切换尚未完成（任务仍在进行）时抛出异常，由重试 topic 稍后再执行
+    """
+    db = await get_mongo()
+    kb = await db.get_knowledge_base_reindex(knowledge_db_id)
+    if kb:
+        current = kb.get("collection_name") or default_collection_name(knowledge_db_id)
+        if current == collection_name:
+            reindex = kb.get("reindex")
+            if reindex and reindex["task_id"] == task_id:
+                raise RuntimeError(
+                    f"Reindex {task_id} of {knowledge_db_id} not switched yet"
+                )
+            logger.info(f"task:{task_id}: {collection_name} still in use, skip drop")
+            return
+    await asyncio.get_event_loop().run_in_executor(
+        None, milvus_client.delete_collection, collection_name
+    )
+    logger.info(f"task:{task_id}: dropped {collection_name}")
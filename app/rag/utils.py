@@ -1,14 +1,30 @@
 import asyncio
 import copy
+import json
 import uuid
 import base64
 import requests
 from app.db.milvus import milvus_client
 from app.db.mongo import get_mongo
-from app.rag.convert_file import convert_file_to_images, save_image_to_minio
-from app.rag.get_embedding import get_embeddings_from_httpx
+from app.rag.answer_cache import bump_knowledge_base_version
+from app.rag.checkpoint import IngestCheckpoint
+from app.rag.convert_file import (
+    build_image_name,
+    compute_file_hash,
+    convert_file_to_images,
+    get_page_count,
+    image_mime_type,
+    rendition_image_name,
+    save_file_to_minio,
+    save_image_to_minio,
+)
+from app.rag.embed_batcher import embedding_batcher
 from app.db.miniodb import async_minio_manager
+from app.core.config import settings
 from app.core.logging import logger
+from app.utils.cache import ByteLRUCache, DiskCache
+from app.utils.kafka_producer import kafka_producer_manager
+from app.utils.stage_timer import stage_timer
 import httpx
 
 
@@ -23,96 +39,530 @@ def sort_and_filter(data, min_score=None, max_score=None):
     return sorted_data
 
 
+# 任务不再变化的状态；进入死信的任务标记为 failed
+TERMINAL_TASK_STATUSES = ("completed", "failed", "cancelled")
+
+
+def task_event_channel(username):
+    return f"task_events:{username}"
+
+
+def format_task_progress(task_id, task_data):
+    """将任务 hash 转换为推送给前端的进度事件"""
+    total = int(task_data.get("total", 0))
+    processed = int(task_data.get("processed", 0))
+    return {
+        "event": "progress",
+        "task_id": task_id,
+        "status": task_data.get("status", "unknown"),
+        "progress": f"{(processed/total)*100:.1f}" if total > 0 else 0,
+        "processed": processed,
+        "total": total,
+        "pages_processed": int(task_data.get("pages_processed", 0)),
+        "pages_total": int(task_data.get("pages_total", 0)),
+        "message": task_data.get("message", ""),
+        "task_type": task_data.get("type", "ingest"),
+    }
+
+
+async def publish_task_progress(redis, task_id):
+    """读取任务最新状态并发布到任务所属用户的频道"""
+    task_data = await redis.hgetall(f"task:{task_id}")
+    if not task_data:
+        return
+    username = task_id.rsplit("_", 1)[0]  # task_id 为 {username}_{uuid}
+    await redis.publish(
+        task_event_channel(username),
+        json.dumps(format_task_progress(task_id, task_data)),
+    )
+
+
+async def init_task_progress(redis, task_id, username, total_files, task_type="ingest"):
+    # 初始化任务状态，task_type 区分文件解析（ingest）、重建索引（reindex）和删除清理（cleanup）
+    await redis.hset(
+        f"task:{task_id}",
+        mapping={
+            "status": "processing",
+            "total": total_files,
+            "processed": 0,
+            "message": "Initializing file processing...",
+            "type": task_type,
+        },
+    )
+    await redis.expire(f"task:{task_id}", 3600)  # 1小时过期
+    # 记录用户的进行中任务，供多路复用的进度流发送初始状态
+    await redis.sadd(f"user_tasks:{username}", task_id)
+    await redis.expire(f"user_tasks:{username}", 3600)
+    await publish_task_progress(redis, task_id)
+
+
 async def update_task_progress(redis, task_id, status, message):
     await redis.hset(f"task:{task_id}", mapping={"status": status, "message": message})
+    await publish_task_progress(redis, task_id)
 
 
 async def handle_processing_error(redis, task_id, error_msg):
     await redis.hset(
         f"task:{task_id}", mapping={"status": "failed", "message": error_msg}
     )
+    await publish_task_progress(redis, task_id)
 
 
-async def process_file(redis, task_id, username, knowledge_db_id, file_meta):
+async def handle_enqueue_failures(redis, db, task_id, failed_files):
+    """投递失败的文件不会被解析：从任务总数中扣除并标记文件解析失败"""
+    await db.mark_files_ingest_failed([file["file_id"] for file in failed_files])
+    total = await redis.hincrby(f"task:{task_id}", "total", -len(failed_files))
+    processed = int(await redis.hget(f"task:{task_id}", "processed") or 0)
+    if total <= 0:
+        await redis.hset(
+            f"task:{task_id}",
+            mapping={"status": "failed", "message": "Failed to queue files"},
+        )
+    elif processed >= total:
+        await redis.hset(
+            f"task:{task_id}",
+            mapping={
+                "status": "completed",
+                "message": f"{len(failed_files)} file(s) failed to queue",
+            },
+        )
+    await publish_task_progress(redis, task_id)
+
+
+async def count_processed_file(redis, task_id, checkpoint):
+    """更新处理进度（同一文件只计数一次），全部文件处理完成时标记任务完成"""
+    if await checkpoint.mark_counted():
+        await redis.hincrby(f"task:{task_id}", "processed", 1)
+    current = int(await redis.hget(f"task:{task_id}", "processed") or 0)
+    total = int(await redis.hget(f"task:{task_id}", "total") or 0)
+    logger.info(f"task:{task_id} files processed + 1!")
+
+    if current == total:
+        await redis.hset(f"task:{task_id}", "status", "completed")
+        await redis.hset(
+            f"task:{task_id}", "message", "All files processed successfully"
+        )
+        logger.info(f"task:{task_id} All files processed successfully")
+    await publish_task_progress(redis, task_id)
+
+
+async def process_file(
+    redis, task_id, username, knowledge_db_id, file_meta, priority=1
+):
+    file_id = file_meta["file_id"]
+    filename = file_meta["original_filename"]
     try:
+        db = await get_mongo()
+
+        # 读取断点状态，已完成的文件直接跳过
+        checkpoint = await IngestCheckpoint(redis, task_id, file_id).load()
+        if checkpoint.completed:
+            logger.info(f"task:{task_id}: {filename} already processed, skip")
+            return
+
+        # 没有断点（首次解析或断点已过期）时清除之前保存的页面和向量
+        if not checkpoint.pages:
+            await discard_stale_pages(db, task_id, knowledge_db_id, file_id)
+
         # 从MinIO获取文件内容
         file_content = await async_minio_manager.get_file_from_minio(
             file_meta["minio_filename"]
         )
 
-        # 解析为图片
-        images_buffer = await convert_file_to_images(file_content)
+        total_pages = checkpoint.total_pages
+        if not total_pages:
+            total_pages = await get_page_count(file_content)
+            await checkpoint.set_meta(total_pages=total_pages)
+            await redis.hincrby(f"task:{task_id}", "pages_total", total_pages)
 
-        # 保存图片并生成嵌入
-        image_ids = []
-        for i, image_buffer in enumerate(images_buffer):
-            # 保存图片到MinIO
-            minio_imagename, image_url = await save_image_to_minio(
-                username, file_meta["original_filename"], image_buffer
+        # 从第一个未完成的页开始解析为图片
+        start_page = checkpoint.first_incomplete_page(total_pages)
+        if start_page > 1:
+            logger.info(
+                f"task:{task_id}: resume {filename} from page {start_page}/{total_pages}"
+            )
+        images_buffer = []
+        if start_page <= total_pages:
+            images_buffer = await convert_file_to_images(
+                file_content, first_page=start_page, last_page=total_pages
             )
 
-            # 保存图片元数据
-            image_id = f"{username}_{uuid.uuid4()}"
-            db = await get_mongo()
-            await db.add_images(
-                file_id=file_meta["file_id"],
-                images_id=image_id,
-                minio_filename=minio_imagename,
-                minio_url=image_url,
-                page_number=i + 1,
+        # 逐页保存图片，保存完成的页立即提交到嵌入队列，与其他文件的页面一起批量嵌入后写入Milvus
+        # 知识库重建索引期间同时写入新集合
+        collection_names = await db.get_write_collection_names(knowledge_db_id)
+        page_tasks = []
+        try:
+            for page_number, (embed_buffer, llm_buffer, renditions) in enumerate(
+                images_buffer, start=start_page
+            ):
+                if checkpoint.reached(page_number, "indexed"):
+                    continue
+                page = await save_page(
+                    db, checkpoint, username, file_meta, page_number, llm_buffer, renditions
+                )
+                page_tasks.append(
+                    asyncio.create_task(
+                        embed_and_index_page(
+                            redis,
+                            task_id,
+                            checkpoint,
+                            collection_names,
+                            file_meta,
+                            page_number,
+                            page,
+                            embed_buffer,
+                            priority,
+                        )
+                    )
+                )
+            logger.info(
+                f"task:{task_id}: save images of {filename} to minio and mongodb"
             )
-            image_ids.append(image_id)
+            await asyncio.gather(*page_tasks)
+        except BaseException:
+            for page_task in page_tasks:
+                page_task.cancel()
+            raise
         logger.info(
-            f"task:{task_id}: save images of {file_meta['original_filename']} to minio and mongodb"
+            f"task:{task_id}: images of {filename} insert to milvus {collection_names}!"
         )
 
-        # 生成嵌入向量
-        embeddings = await generate_embeddings(
-            images_buffer, file_meta["original_filename"]
-        )
-        logger.info(
-            f"task:{task_id}: {file_meta['original_filename']} generate_embeddings!"
+        # 先计入进度（只计一次）再标记完成：两者之间崩溃时重新投递的消息会重新执行，
+        # 反过来则会被当作已完成跳过，任务进度永远到不了 100%
+        await count_processed_file(redis, task_id, checkpoint)
+        await db.mark_file_processed(file_id, task_id)
+        await bump_knowledge_base_version(knowledge_db_id)
+        await checkpoint.mark_completed()
+
+    except Exception as e:
+        # 是否重试或标记失败由消费者根据已处理次数决定
+        logger.error(f"task:{task_id}: process {filename} failed: {e}")
+        raise
+
+
+async def discard_stale_pages(db, task_id, knowledge_db_id, file_id):
+    """
+    删除文件已保存的页面、页面图片和向量
+
+    断点过期后重放的消息会为每页分配新的 image_id，不先删除会留下重复的页面和向量；
+    未完成解析的文件不会被上传去重引用，页面图片可以直接删除
+    """
+    images = await db.reset_file_images(file_id)
+    if not images:
+        return
+    for collection_name in await db.get_write_collection_names(knowledge_db_id):
+        if await asyncio.to_thread(milvus_client.check_collection, collection_name):
+            await asyncio.to_thread(milvus_client.delete_files, collection_name, [file_id])
+    minio_files = [image["minio_filename"] for image in images]
+    minio_files.extend(
+        name for image in images for name in (image.get("renditions") or {}).values()
+    )
+    try:
+        await async_minio_manager.bulk_delete(minio_files)
+    except Exception as e:
+        logger.error(f"task:{task_id}: delete stale images of {file_id} failed: {e}")
+    logger.info(f"task:{task_id}: discarded {len(images)} stale pages of {file_id}")
+
+
+async def cleanup_deleted_file(redis, task_id, knowledge_db_id, file_id):
+    """文件在解析过程中被删除：删除其已写入的向量以及断点中记录的页面图片"""
+    db = await get_mongo()
+    checkpoint = await IngestCheckpoint(redis, task_id, file_id).load()
+    try:
+        for collection_name in await db.get_write_collection_names(knowledge_db_id):
+            if await asyncio.to_thread(milvus_client.check_collection, collection_name):
+                await asyncio.to_thread(
+                    milvus_client.delete_files, collection_name, [file_id]
+                )
+        minio_files = [
+            page["minio_filename"]
+            for page in checkpoint.pages.values()
+            if page.get("minio_filename")
+        ]
+        minio_files.extend(
+            name
+            for page in checkpoint.pages.values()
+            for name in page.get("renditions", {}).values()
         )
+        if minio_files:
+            await async_minio_manager.bulk_delete(minio_files)
+    except Exception as e:
+        logger.error(f"task:{task_id}: cleanup deleted file {file_id} failed: {e}")
+    # 删除的文件不再解析，计入任务进度使任务可以完成
+    await count_processed_file(redis, task_id, checkpoint)
+    logger.info(f"task:{task_id}: file {file_id} deleted during processing, cleaned up")
 
-        # 插入Milvus
-        collection_name = f"colqwen{knowledge_db_id.replace('-', '_')}"
-        await insert_to_milvus(
-            collection_name, embeddings, image_ids, file_meta["file_id"]
+
+async def link_duplicate_file(db, username, knowledge_db_id, source_file, filename):
+    """
+    复用已解析完成的相同文件：引用其原文件和页面图片，并把向量复制到目标知识库
+
+    返回与普通上传相同结构的文件信息
+    """
+    file_id = f"{username}_{uuid.uuid4()}"
+    image_id_map = {}
+    images = []
+    for image in source_file.get("images", []):
+        new_image_id = f"{username}_{uuid.uuid4()}"
+        image_id_map[image["images_id"]] = new_image_id
+        images.append({**image, "images_id": new_image_id})
+
+    source_collection = await db.get_collection_name(source_file["knowledge_db_id"])
+    target_collections = await db.get_write_collection_names(knowledge_db_id)
+    loop = asyncio.get_event_loop()
+    try:
+        for target_collection in target_collections:
+            await loop.run_in_executor(
+                None,
+                milvus_client.copy_file_vectors,
+                source_collection,
+                target_collection,
+                source_file["file_id"],
+                file_id,
+                image_id_map,
+            )
+
+        await db.create_files(
+            file_id=file_id,
+            username=username,
+            filename=filename,
+            minio_filename=source_file["minio_filename"],
+            minio_url=source_file["minio_url"],
+            knowledge_db_id=knowledge_db_id,
+            content_hash=source_file.get("content_hash", ""),
+            images=images,
+            ingest_status="completed",
         )
-        logger.info(
-            f"task:{task_id}: images of {file_meta['original_filename']} insert to milvus {collection_name}!"
+        await bump_knowledge_base_version(knowledge_db_id)
+        await db.knowledge_base_add_file(
+            knowledge_base_id=knowledge_db_id,
+            file_id=file_id,
+            original_filename=filename,
+            minio_filename=source_file["minio_filename"],
+            minio_url=source_file["minio_url"],
         )
+    except BaseException:
+        # 调用方会回退到完整解析，删除已复制的向量，避免检索到孤儿向量
+        for target_collection in target_collections:
+            try:
+                await loop.run_in_executor(
+                    None, milvus_client.delete_files, target_collection, [file_id]
+                )
+            except Exception as e:
+                logger.error(f"Delete copied vectors of {file_id} failed: {e}")
+        raise
+    return {
+        "id": file_id,
+        "minio_filename": source_file["minio_filename"],
+        "filename": filename,
+        "url": source_file["minio_url"],
+    }
 
-        # 更新处理进度
-        await redis.hincrby(f"task:{task_id}", "processed", 1)
-        current = int(await redis.hget(f"task:{task_id}", "processed"))
-        total = int(await redis.hget(f"task:{task_id}", "total"))
-        logger.info(f"task:{task_id} files processed + 1!")
 
-        if current == total:
-            await redis.hset(f"task:{task_id}", "status", "completed")
+async def add_uploaded_files(
+    redis, db, task_id, username, knowledge_db_id, files, priority
+):
+    """
+    保存上传的文件并投递解析消息，返回 {"files", "deduplicated", "failed"}
+
+    相同内容的文件已解析过时直接复用其图片和向量，计入任务进度；
+    投递失败的文件从任务中扣除并在返回的文件信息中附带错误
+    """
+    return_files = []
+    file_meta_list = []
+    deduplicated = 0
+    for file in files:
+        content_hash = await compute_file_hash(file)
+        source_file = await db.find_processed_file_by_hash(username, content_hash)
+        if source_file:
+            try:
+                linked_file = await link_duplicate_file(
+                    db, username, knowledge_db_id, source_file, file.filename
+                )
+                return_files.append({**linked_file, "deduplicated": True})
+                deduplicated += 1
+                continue
+            except Exception as e:
+                logger.warning(
+                    f"Deduplicate {file.filename} from {source_file['file_id']} failed, "
+                    f"fall back to full processing: {e}"
+                )
+
+        # 保存文件到MinIO
+        minio_filename, minio_url = await save_file_to_minio(username, file)
+
+        # 生成文件ID并保存元数据
+        file_id = f"{username}_{uuid.uuid4()}"
+        await db.create_files(
+            file_id=file_id,
+            username=username,
+            filename=file.filename,
+            minio_filename=minio_filename,
+            minio_url=minio_url,
+            knowledge_db_id=knowledge_db_id,
+            content_hash=content_hash,
+        )
+        await db.knowledge_base_add_file(
+            knowledge_base_id=knowledge_db_id,
+            file_id=file_id,
+            original_filename=file.filename,
+            minio_filename=minio_filename,
+            minio_url=minio_url,
+        )
+        file_meta_list.append(
+            {
+                "file_id": file_id,
+                "minio_filename": minio_filename,
+                "original_filename": file.filename,
+            }
+        )
+        return_files.append(
+            {
+                "id": file_id,
+                "minio_filename": minio_filename,
+                "filename": file.filename,
+                "url": minio_url,
+                "deduplicated": False,
+            }
+        )
+
+    # 去重的文件无需解析，直接计入任务进度
+    if deduplicated:
+        processed = await redis.hincrby(f"task:{task_id}", "processed", deduplicated)
+        if processed == len(files):
             await redis.hset(
-                f"task:{task_id}", "message", "All files processed successfully"
+                f"task:{task_id}",
+                mapping={
+                    "status": "completed",
+                    "message": "All files processed successfully",
+                },
             )
-            logger.info(f"task:{task_id} All files processed successfully")
+        await publish_task_progress(redis, task_id)
 
-    except Exception as e:
-        await handle_processing_error(
-            redis, task_id, f"File processing failed: {str(e)}"
+    # 并发发送Kafka消息（每个文件一个消息），投递失败的文件返回给调用方
+    failed_files = []
+    if file_meta_list:
+        failed_files = await kafka_producer_manager.send_embedding_tasks(
+            task_id=task_id,
+            username=username,
+            knowledge_db_id=knowledge_db_id,
+            file_metas=file_meta_list,
+            priority=priority,
         )
-        raise
+    if failed_files:
+        await handle_enqueue_failures(redis, db, task_id, failed_files)
+        errors = {file["file_id"]: file["error"] for file in failed_files}
+        for return_file in return_files:
+            if return_file["id"] in errors:
+                return_file["error"] = errors[return_file["id"]]
 
+    return {"files": return_files, "deduplicated": deduplicated, "failed": failed_files}
 
-async def generate_embeddings(images_buffer, filename):
-    # 将同步函数包装到线程池执行
-    images_request = [
-        ("images", (f"{filename}_{i}.png", img, "image/png"))
-        for i, img in enumerate(images_buffer)
-    ]
-    return await get_embeddings_from_httpx(images_request, endpoint="embed_image")
+
+async def save_page(
+    db, checkpoint, username, file_meta, page_number, image_buffer, renditions=None
+):
+    """保存单页图片及其各规格的LLM图片到MinIO和mongodb，已上传的页直接复用断点中的记录"""
+    renditions = renditions or {}
+    if not checkpoint.reached(page_number, "rendered"):
+        # 先记录分配的 image_id 和对象名，重试时沿用，避免产生孤儿对象
+        minio_filename = build_image_name(username, file_meta["original_filename"])
+        await checkpoint.set_page(
+            page_number,
+            "rendered",
+            image_id=f"{username}_{uuid.uuid4()}",
+            minio_filename=minio_filename,
+            renditions={
+                name: rendition_image_name(minio_filename, name) for name in renditions
+            },
+        )
+    page = checkpoint.pages[page_number]
+    if checkpoint.reached(page_number, "uploaded"):
+        return page
+
+    # 只上传断点中记录过对象名的规格（重试前配置可能已变更）
+    rendition_names = {
+        name: file_name
+        for name, file_name in page.get("renditions", {}).items()
+        if name in renditions
+    }
+    with stage_timer.measure("upload"):
+        (minio_imagename, image_url), *_ = await asyncio.gather(
+            save_image_to_minio(
+                username,
+                file_meta["original_filename"],
+                image_buffer,
+                file_name=page["minio_filename"],
+            ),
+            *[
+                async_minio_manager.upload_image(
+                    file_name, renditions[name], image_mime_type(file_name)
+                )
+                for name, file_name in rendition_names.items()
+            ],
+        )
+    with stage_timer.measure("metadata"):
+        await db.add_images(
+            file_id=file_meta["file_id"],
+            images_id=page["image_id"],
+            minio_filename=minio_imagename,
+            minio_url=image_url,
+            page_number=page_number,
+            renditions=rendition_names,
+        )
+        return await checkpoint.set_page(page_number, "uploaded", minio_url=image_url)
 
 
-async def insert_to_milvus(collection_name, embeddings, image_ids, file_id):
+async def embed_and_index_page(
+    redis,
+    task_id,
+    checkpoint,
+    collection_names,
+    file_meta,
+    page_number,
+    page,
+    embed_buffer,
+    priority=1,
+):
+    """通过嵌入队列获取单页向量并写入该文件所属知识库的Milvus集合"""
+    # 包含在嵌入队列中等待组批的时间
+    with stage_timer.measure("embed"):
+        embedding = await embedding_batcher.embed(
+            embed_buffer, f"{file_meta['original_filename']}_{page_number}.png", priority
+        )
+    with stage_timer.measure("insert"):
+        await index_page(
+            checkpoint, collection_names, file_meta["file_id"], page_number, page, embedding
+        )
+    await redis.hincrby(f"task:{task_id}", "pages_processed", 1)
+    await publish_task_progress(redis, task_id)
+
+
+async def index_page(checkpoint, collection_names, file_id, page_number, page, embedding):
+    """写入单页向量，上次中断在写入过程中时先清理该页残留的向量"""
+    resumed = checkpoint.reached(page_number, "embedded")
+    if not resumed:
+        await checkpoint.set_page(page_number, "embedded")
+    for collection_name in collection_names:
+        if resumed:
+            await asyncio.get_event_loop().run_in_executor(
+                None, milvus_client.delete_images, collection_name, [page["image_id"]]
+            )
+        await insert_to_milvus(
+            collection_name,
+            [embedding],
+            [page["image_id"]],
+            file_id,
+            page_numbers=[page_number - 1],
+        )
+    await checkpoint.set_page(page_number, "indexed")
+
+
+async def insert_to_milvus(
+    collection_name, embeddings, image_ids, file_id, page_numbers=None
+):
+    if page_numbers is None:
+        page_numbers = list(range(len(embeddings)))
     loop = asyncio.get_event_loop()
     await loop.run_in_executor(
         None,
@@ -120,7 +570,7 @@ async def insert_to_milvus(collection_name, embeddings, image_ids, file_id):
             milvus_client.insert(
                 {
                     "colqwen_vecs": emb,
-                    "page_number": i,
+                    "page_number": page_numbers[i],
                     "image_id": image_ids[i],
                     "file_id": file_id,
                 },
@@ -131,31 +581,110 @@ async def insert_to_milvus(collection_name, embeddings, image_ids, file_id):
     )
 
 
-async def replace_image_content(messages):
+def image_data_url(file_name, image_bytes):
+    encoded = base64.b64encode(image_bytes).decode("utf-8")
+    return f"data:{image_mime_type(file_name)};base64,{encoded}"
+
+
+# 同一 worker 内各请求共用的页面图片缓存，MinIO 对象写入后不再修改，无需失效
+image_data_url_cache = ByteLRUCache(settings.llm_image_cache_bytes)
+image_disk_cache = (
+    DiskCache(settings.llm_image_cache_dir, settings.llm_image_cache_disk_bytes)
+    if settings.llm_image_cache_dir
+    else None
+)
+
+
+async def get_image_data_urls(file_names):
+    """
+    获取 MinIO 中页面图片的 data URL，返回 file_name -> data URL
+
+    依次查找进程内缓存、磁盘缓存，剩余的复用同一客户端限流并发下载
+    """
+    data_urls = {}
+    missing = []
+    for file_name in set(file_names):
+        data_url = image_data_url_cache.get(file_name)
+        if data_url is None:
+            missing.append(file_name)
+        else:
+            data_urls[file_name] = data_url
+
+    if missing and image_disk_cache:
+        cached = await asyncio.gather(
+            *[asyncio.to_thread(image_disk_cache.get, name) for name in missing]
+        )
+        for file_name, image_bytes in zip(missing, cached):
+            if image_bytes is not None:
+                data_urls[file_name] = image_data_url(file_name, image_bytes)
+                image_data_url_cache.set(file_name, data_urls[file_name])
+        missing = [name for name in missing if name not in data_urls]
+
+    if missing:
+        images = await async_minio_manager.download_images(
+            missing, concurrency=settings.llm_image_fetch_concurrency
+        )
+        for file_name, image_bytes in images.items():
+            data_urls[file_name] = image_data_url(file_name, image_bytes)
+            image_data_url_cache.set(file_name, data_urls[file_name])
+        if image_disk_cache:
+            for file_name, image_bytes in images.items():
+                try:
+                    await asyncio.to_thread(image_disk_cache.set, file_name, image_bytes)
+                except OSError as e:
+                    logger.warning(f"Write image cache of {file_name} failed: {e}")
+    return data_urls
+
+
+def select_image_name(item, rendition=None):
+    """图片内容项实际发送的对象名：有该规格的图片时使用规格图片，否则使用原图"""
+    return (item.get("renditions") or {}).get(rendition, item["image_url"])
+
+
+def message_image_names(messages, rendition=None):
+    return [
+        select_image_name(item, rendition)
+        for message in messages
+        if isinstance(message.get("content"), list)
+        for item in message["content"]
+        if item.get("type") == "image_url" and item.get("image_url")
+    ]
+
+
+async def prefetch_images(messages, rendition=None):
+    """提前下载消息中的图片到缓存，失败时只记录日志，组装提示词时会重新下载"""
+    try:
+        await get_image_data_urls(message_image_names(messages, rendition))
+    except Exception as e:
+        logger.warning(f"Prefetch images failed: {e}")
+
+
+async def replace_image_content(messages, rendition=None):
     """
     替换消息中的图片内容
     
-    将 image_minio_url 类型转换为 image_url 类型，保持URL格式
+    将 image_minio_url 类型转换为 image_url 类型，保持URL格式；图片经缓存获取，未命中的并发下载。
+    指定 rendition 时使用解析时生成的该规格图片，没有该规格的（旧文件）使用原图
     """
     logger.info("🔄 Processing image content in messages...")
     
     try:
         processed_messages = copy.deepcopy(messages)
-        
-        for message in processed_messages:
-            if isinstance(message.get("content"), list):
-                for item in message["content"]:
-                    if item.get("type") == "image_url":
-                        # 获取MinIO URL
-                        image_url = item.get("image_url")
-                        if image_url:
-                            logger.info(f"📥 Processing image URL: {image_url[:80]}...")
-                            image_base64 = (
-                                 await async_minio_manager.download_image_and_convert_to_base64(item["image_url"])
-                            )
-                            item["image_url"] = {"url": f"data:image/png;base64,{image_base64}"}
-                            logger.info(f"✅ URL converted to image_url format")
-        logger.info("✅ Image content processing completed")
+        items = [
+            item
+            for message in processed_messages
+            if isinstance(message.get("content"), list)
+            for item in message["content"]
+            if item.get("type") == "image_url" and item.get("image_url")
+        ]
+        for item in items:
+            # renditions 只用于选择图片，不发送给模型
+            item["image_url"] = select_image_name(item, rendition)
+            item.pop("renditions", None)
+        data_urls = await get_image_data_urls([item["image_url"] for item in items])
+        for item in items:
+            item["image_url"] = {"url": data_urls[item["image_url"]]}
+        logger.info(f"✅ {len(items)} image URLs converted to image_url format")
         return processed_messages
         
     except Exception as e:
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    进程内的 LRU 缓存，条目在 ttl 秒后过期
+
+    只在事件循环中使用，不加锁；超过 maxsize 时淘汰最久未使用的条目
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()  # key -> (过期时间, value)
+        # 每次删除条目时加一，查询期间发生删除时调用方不应写回查询结果
+        self.generation = 0
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def discard(self, key):
+        self.generation += 1
+        self.data.pop(key, None)
+
+    def discard_if(self, predicate):
+        """删除 value 满足 predicate 的条目"""
+        self.generation += 1
+        for key in [key for key, (_, value) in self.data.items() if predicate(value)]:
+            del self.data[key]
+
+    def clear(self):
+        self.generation += 1
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ByteLRUCache:
+    """
+    按总字节数限制容量的进程内 LRU 缓存，value 为 str 或 bytes
+
+    只在事件循环中使用，不加锁；单个超过容量的条目不缓存
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        value = self.data.get(key)
+        if value is None:
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        if key in self.data:
+            self.size -= len(self.data.pop(key))
+        self.data[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.data.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self.data.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.data)
+
+
+class DiskCache:
+    """
+    本地磁盘上按总字节数限制容量的缓存，超出时删除最早写入的文件
+
+    方法为同步阻塞调用，在事件循环中通过 asyncio.to_thread 调用；
+    多个进程共用同一目录时各自统计容量，写入使用临时文件加重命名保证不会读到半个文件
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(
+            entry.stat().st_size
+            for entry in os.scandir(directory)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        )
+
+    def path(self, key: str) -> str:
+        return os.path.join(
+            self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest()
+        )
+
+    def get(self, key: str):
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        path = self.path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += len(value)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        # 删到容量的 90% 以下，避免每次写入都扫描目录
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,44 @@
+import asyncio
+import json
+from app.core.logging import logger
+from app.db.redis import redis
+
+
+class InvalidationChannel:
+    """
+    通过 Redis 发布订阅通知所有实例删除进程内缓存
+
+    publish 先在本进程执行 handler 再广播；run 订阅频道，对收到的消息执行 handler。
+    (重新)订阅时调用 on_subscribe 清空缓存，未订阅期间可能漏掉消息
+    """
+
+    def __init__(self, channel, handler, on_subscribe):
+        self.channel = channel
+        self.handler = handler
+        self.on_subscribe = on_subscribe
+
+    async def publish(self, **message):
+        self.handler(**message)
+        try:
+            connection = await redis.get_cache_connection()
+            await connection.publish(self.channel, json.dumps(message))
+        except Exception as e:
+            # 其他实例的缓存由 ttl 兜底
+            logger.warning(f"Publish {self.channel} failed: {e}")
+
+    async def run(self):
+        """订阅失效消息，连接断开后重新订阅"""
+        while True:
+            connection = await redis.get_cache_connection()
+            pubsub = connection.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                self.on_subscribe()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.handler(**json.loads(message["data"]))
+            except Exception as e:
+                logger.error(f"Error subscribing {self.channel}: {e}")
+                await asyncio.sleep(5)
+            finally:
+                await pubsub.reset()
@@ -1,34 +1,127 @@
+import asyncio
 import json
-from aiokafka import AIOKafkaConsumer, ConsumerRecord
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from aiokafka import (
+    AIOKafkaConsumer,
+    ConsumerRebalanceListener,
+    ConsumerRecord,
+    TopicPartition,
+)
+from aiokafka.errors import KafkaError
 from app.core.config import settings
 from app.core.logging import logger
-from asyncio import Lock
+from redis.exceptions import LockError
+from app.db.mongo import get_mongo
 from app.db.redis import redis
-from app.rag.utils import process_file, update_task_progress
+from app.rag.cleanup import run_cleanup
+from app.rag.reindex import drop_old_collection, run_reindex
+from app.rag.utils import (
+    cleanup_deleted_file,
+    handle_processing_error,
+    process_file,
+    update_task_progress,
+)
+from app.utils.kafka_producer import (
+    KAFKA_ATTEMPTS_HEADER,
+    KAFKA_ORIGIN_TOPIC_HEADER,
+    CLEANUP_MESSAGE_TYPE,
+    DROP_COLLECTION_MESSAGE_TYPE,
+    REINDEX_MESSAGE_TYPE,
+    get_header,
+    kafka_producer_manager,
+)
 
 KAFKA_TOPIC = settings.kafka_topic
+KAFKA_PRIORITY_TOPIC = settings.kafka_priority_topic
 KAFKA_BOOTSTRAP_SERVERS = settings.kafka_broker_url
 KAFKA_PRIORITY_HEADER = "priority"
 KAFKA_GROUP_ID = settings.kafka_group_id
+KAFKA_POLL_TIMEOUT_MS = 500
 
 
-class KafkaConsumerManager:
+class PartitionOffsetTracker:
+    """记录单个分区内正在处理的消息，只有更早的消息全部完成后才推进可提交的偏移量"""
+
+    def __init__(self):
+        self.pending = deque()  # 按拉取顺序排列的偏移量
+        self.done = set()
+
+    def add(self, offset: int):
+        self.pending.append(offset)
+
+    def complete(self, offset: int):
+        """标记消息完成，返回新的可提交偏移量（无推进时返回 None）"""
+        self.done.add(offset)
+        commit_offset = None
+        while self.pending and self.pending[0] in self.done:
+            finished = self.pending.popleft()
+            self.done.discard(finished)
+            commit_offset = finished + 1
+        return commit_offset
+
+
+class KeyState:
+    """同一知识库（消息 key）的处理状态：解析消息可以并发处理，清理消息需等之前的解析完成"""
+
     def __init__(self):
+        self.running = 0  # 正在处理的解析消息数
+        self.cleanup = False  # 是否有清理消息正在处理
+        # 从第一条等待的清理消息开始按拉取顺序排队的 (TopicPartition, 消息, 是否为清理消息)
+        self.waiting = deque()
+
+
+class OffsetTrackingRebalanceListener(ConsumerRebalanceListener):
+    """分区被回收后丢弃其偏移量记录，未提交的消息会由新的消费者重新处理"""
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    async def on_partitions_revoked(self, revoked):
+        for tp in revoked:
+            self.manager.trackers.pop(tp, None)
+        self.manager.drop_backlog(set(revoked))
+
+    async def on_partitions_assigned(self, assigned):
+        pass
+
+
+class KafkaConsumerManager:
+    def __init__(self, max_in_flight: int = None):
         self.consumer = None
-        self.lock = Lock()  # 初始化锁
-        self.lock_name = "kafka_message_lock"  # Redis锁的名称
+        self.lock_name = "ingest_lock"  # Redis锁的名称，按 task_id 和 file_id 加锁
+        self.max_in_flight = max_in_flight or settings.kafka_consumer_max_in_flight
+        # 普通通道最多占用的槽位，其余保留给高优先级通道
+        self.normal_max_in_flight = max(
+            1, self.max_in_flight - settings.kafka_priority_reserved_slots
+        )
+        self.trackers = {}  # TopicPartition -> PartitionOffsetTracker
+        self.tasks = set()  # 消息处理任务
+        self.key_states = {}  # 消息 key（知识库） -> KeyState
+        self.in_flight = 0  # 已派发未完成（正在处理或排在清理消息之后）的消息数
+        self.normal_in_flight = 0  # 其中来自普通通道的消息数
 
     async def start(self):
         if not self.consumer:
             self.consumer = AIOKafkaConsumer(
-                KAFKA_TOPIC,
                 bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
                 group_id=KAFKA_GROUP_ID,
                 enable_auto_commit=False,  # 手动提交消息、
             )
+            self.consumer.subscribe(
+                [KAFKA_PRIORITY_TOPIC, KAFKA_TOPIC],
+                listener=OffsetTrackingRebalanceListener(self),
+            )
             await self.consumer.start()
 
     async def stop(self):
+        # 未完成的消息不会提交偏移量，重新投递后从断点继续
+        for state in self.key_states.values():
+            state.waiting.clear()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
         if self.consumer:
             await self.consumer.stop()
 
@@ -40,6 +133,7 @@ class KafkaConsumerManager:
         username = message["username"]
         knowledge_db_id = message["knowledge_db_id"]
         file_meta = message["file_meta"]
+        priority = get_message_priority(msg)
         redis_connection = await redis.get_task_connection()
         # 更新任务状态
         await update_task_progress(redis_connection, task_id, "processing", 
@@ -51,50 +145,375 @@ class KafkaConsumerManager:
             task_id=task_id,
             username=username,
             knowledge_db_id=knowledge_db_id,
-            file_meta=file_meta
+            file_meta=file_meta,
+            priority=priority,
         )
 
+    async def keep_lock_alive(self, lock):
+        """处理期间定期续期锁，实例崩溃后锁在 ingest_lock_timeout 后自动过期"""
+        while True:
+            await asyncio.sleep(settings.ingest_lock_timeout / 3)
+            await lock.reacquire()
+
+    async def process_with_lock(self, msg: ConsumerRecord):
+        """
+        以 (task_id, file_id) 为幂等键处理消息
+
+        同一文件同一时间只由一个实例处理；其他实例等待锁释放后检查完成状态，
+        已完成的直接跳过，未完成的（例如持锁实例崩溃）从断点继续
+        """
+        message = json.loads(msg.value.decode("utf-8"))
+        if message.get("type") == REINDEX_MESSAGE_TYPE:
+            await self.process_reindex(message)
+        elif message.get("type") == CLEANUP_MESSAGE_TYPE:
+            await self.process_cleanup(message)
+        elif message.get("type") == DROP_COLLECTION_MESSAGE_TYPE:
+            # 删除不存在的集合是安全的，无需加锁
+            await drop_old_collection(
+                message["task_id"], message["knowledge_db_id"], message["collection_name"]
+            )
+        else:
+            await self.process_file_message(msg, message)
+
+    async def process_reindex(self, message: dict):
+        # 按知识库加锁，是否仍需执行由 run_reindex 检查
+        async with self.redis_lock(f"reindex_lock:{message['knowledge_db_id']}"):
+            redis_connection = await redis.get_task_connection()
+            await run_reindex(
+                redis_connection, message["task_id"], message["knowledge_db_id"]
+            )
+
+    async def process_cleanup(self, message: dict):
+        # 按知识库加锁，已清理的记录不再带删除标记，重复执行是安全的
+        async with self.redis_lock(f"cleanup_lock:{message['knowledge_db_id']}"):
+            redis_connection = await redis.get_task_connection()
+            await run_cleanup(
+                redis_connection,
+                message["task_id"],
+                message["knowledge_db_id"],
+                message.get("file_ids"),
+                message.get("drop_knowledge_base", False),
+            )
+
+    async def process_file_message(self, msg: ConsumerRecord, message: dict):
+        task_id = message["task_id"]
+        file_id = message["file_meta"]["file_id"]
+        async with self.redis_lock(f"{self.lock_name}:{task_id}:{file_id}"):
+            db = await get_mongo()
+            state = await db.get_file_ingest_state(file_id, task_id)
+            if state == "completed":
+                logger.info(f"Skip message of task {task_id} file {file_id}: completed")
+                return
+            if state == "pending":
+                try:
+                    await self.process_message(msg)  # 处理每条消息
+                except Exception:
+                    # 处理期间文件被删除导致的失败无需重试
+                    if await db.get_file_ingest_state(file_id, task_id) != "missing":
+                        raise
+                state = await db.get_file_ingest_state(file_id, task_id)
+            # 文件在解析前或解析过程中被删除，清理删除之后写入的向量和页面图片
+            if state == "missing":
+                redis_connection = await redis.get_task_connection()
+                await cleanup_deleted_file(
+                    redis_connection, task_id, message["knowledge_db_id"], file_id
+                )
+
+    @asynccontextmanager
+    async def redis_lock(self, name: str):
+        """跨实例的互斥锁，处理期间定期续期"""
+        lock_connection = await redis.get_lock_connection()
+        lock = lock_connection.lock(name, timeout=settings.ingest_lock_timeout)
+        await lock.acquire()
+        heartbeat = asyncio.create_task(self.keep_lock_alive(lock))
+        try:
+            yield
+        finally:
+            heartbeat.cancel()
+            try:
+                await lock.release()  # 释放锁
+            except LockError as e:
+                logger.warning(f"Release lock {name}: {e}")
+
+    async def handle_message(self, tp: TopicPartition, msg: ConsumerRecord):
+        """处理单条消息，完成后按分区顺序提交偏移量（被取消的消息不提交）"""
+        try:
+            await self.process_with_lock(msg)
+        except Exception as e:
+            logger.error(f"Error processing message: {e}")
+            try:
+                await self.handle_failure(msg, e)
+            except Exception as failure_error:
+                # 已记录的偏移量必须完成，否则该分区之后的偏移量都无法提交
+                logger.error(
+                    f"Handle failure of task {get_message_task_id(msg)} failed: "
+                    f"{failure_error}"
+                )
+        await self.commit_completed(tp, msg.offset)
+
+    async def handle_failure(self, msg: ConsumerRecord, error: Exception):
+        """
+        处理失败的消息：未超过最大次数时按指数退避发送到重试 topic，
+        否则写入死信并把任务标记为失败
+        """
+        attempts = int(get_header(msg.headers, KAFKA_ATTEMPTS_HEADER) or 0) + 1
+        origin_topic = get_header(msg.headers, KAFKA_ORIGIN_TOPIC_HEADER) or msg.topic
+        error_msg = f"{type(error).__name__}: {error}"
+        task_id = get_message_task_id(msg)
+
+        if attempts < settings.ingest_max_attempts:
+            delay = min(
+                settings.ingest_retry_base_delay * 2 ** (attempts - 1),
+                settings.ingest_retry_max_delay,
+            )
+            try:
+                await kafka_producer_manager.send_retry(
+                    msg.key, msg.value, msg.headers, origin_topic, attempts, delay, error_msg
+                )
+                logger.info(
+                    f"Retry message of task {task_id} in {delay}s (attempt {attempts})"
+                )
+                if task_id:
+                    redis_connection = await redis.get_task_connection()
+                    await update_task_progress(
+                        redis_connection,
+                        task_id,
+                        "retrying",
+                        f"Attempt {attempts} failed, retry in {int(delay)}s: {error_msg}",
+                    )
+                return
+            except KafkaError as e:
+                logger.error(f"Send message of task {task_id} to retry topic failed: {e}")
+
+        await self.dead_letter(msg, origin_topic, attempts, error_msg)
+
+    async def dead_letter(
+        self, msg: ConsumerRecord, origin_topic: str, attempts: int, error_msg: str
+    ):
+        task_id = get_message_task_id(msg)
+        try:
+            db = await get_mongo()
+            await db.add_dead_letter(
+                dead_letter_id=str(uuid.uuid4()),
+                origin_topic=origin_topic,
+                value=msg.value.decode("utf-8", errors="replace"),
+                headers=[
+                    [key, value.decode("utf-8", errors="replace")]
+                    for key, value in msg.headers or []
+                ],
+                attempts=attempts,
+                error=error_msg,
+            )
+        except Exception as e:
+            logger.error(f"Save dead letter of task {task_id} failed: {e}")
+        try:
+            await kafka_producer_manager.send_dead_letter(
+                msg.key, msg.value, msg.headers, origin_topic, attempts, error_msg
+            )
+        except KafkaError as e:
+            logger.error(f"Send message of task {task_id} to dead letter topic failed: {e}")
+        logger.error(f"Message of task {task_id} dead after {attempts} attempts")
+        if task_id:
+            redis_connection = await redis.get_task_connection()
+            await handle_processing_error(
+                redis_connection,
+                task_id,
+                f"File processing failed after {attempts} attempts: {error_msg}",
+            )
+
+    async def commit_completed(self, tp: TopicPartition, offset: int):
+        tracker = self.trackers.get(tp)
+        if tracker is None:  # 分区已被回收
+            return
+        commit_offset = tracker.complete(offset)
+        if commit_offset is None:
+            return
+        try:
+            await self.consumer.commit({tp: commit_offset})
+        except KafkaError as e:
+            logger.warning(f"Commit offset {commit_offset} of {tp} failed: {e}")
+
+    def dispatch(self, batches: dict) -> int:
+        """
+        为拉取到的每条消息安排处理，返回消息数
+
+        每条消息派发时占用一个槽位。同一知识库（消息 key）的解析消息并发处理；
+        清理消息等该 key 之前拉取的解析消息全部完成后才开始，之后的消息排在清理消息后面。
+        消息按 key 分区，同一分区内的顺序即生产顺序。重建索引耗时较长且与解析双写，不参与排队
+        """
+        count = 0
+        for tp, messages in batches.items():
+            for msg in messages:
+                logger.info("kafka start consume")
+                self.trackers.setdefault(tp, PartitionOffsetTracker()).add(msg.offset)
+                self.acquire_slot(tp)
+                message_type = get_message_type(msg)
+                if msg.key is None or message_type == REINDEX_MESSAGE_TYPE:
+                    self.spawn(self.run_message(tp, msg))
+                else:
+                    state = self.key_states.setdefault(msg.key, KeyState())
+                    state.waiting.append((tp, msg, message_type == CLEANUP_MESSAGE_TYPE))
+                    self.release_key(msg.key)
+                count += 1
+        return count
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def acquire_slot(self, tp: TopicPartition):
+        self.in_flight += 1
+        self.normal_in_flight += tp.topic != KAFKA_PRIORITY_TOPIC
+
+    def release_slot(self, tp: TopicPartition):
+        self.in_flight -= 1
+        self.normal_in_flight -= tp.topic != KAFKA_PRIORITY_TOPIC
+
+    async def run_message(self, tp: TopicPartition, msg: ConsumerRecord):
+        """处理一条消息，完成后释放派发时占用的槽位"""
+        try:
+            await self.handle_message(tp, msg)
+        finally:
+            self.release_slot(tp)
+
+    async def run_key_message(
+        self, key: bytes, tp: TopicPartition, msg: ConsumerRecord, cleanup: bool
+    ):
+        try:
+            await self.run_message(tp, msg)
+        finally:
+            state = self.key_states[key]
+            if cleanup:
+                state.cleanup = False
+            else:
+                state.running -= 1
+            self.release_key(key)
+
+    def release_key(self, key: bytes):
+        """按顺序启动该 key 可以开始的消息，没有待处理的消息时移除其状态"""
+        state = self.key_states[key]
+        while state.waiting and not state.cleanup:
+            tp, msg, cleanup = state.waiting[0]
+            if cleanup:
+                if state.running:
+                    break  # 等待之前的解析消息完成
+                state.cleanup = True
+            else:
+                state.running += 1
+            state.waiting.popleft()
+            self.spawn(self.run_key_message(key, tp, msg, cleanup))
+        if not (state.running or state.cleanup or state.waiting):
+            del self.key_states[key]
+
+    def drop_backlog(self, partitions: set):
+        """丢弃已回收分区中尚未开始处理的消息，由新的消费者重新处理"""
+        for key in list(self.key_states):
+            state = self.key_states[key]
+            waiting = deque()
+            for item in state.waiting:
+                if item[0] in partitions:
+                    self.release_slot(item[0])
+                else:
+                    waiting.append(item)
+            state.waiting = waiting
+            self.release_key(key)
+
+    def toggle_partitions(self, partitions: list, enabled: bool):
+        if not partitions:
+            return
+        if enabled:
+            self.consumer.resume(*partitions)
+        else:
+            self.consumer.pause(*partitions)
+
     # @retry(stop=stop_after_attempt(5), wait=wait_fixed(2))
     async def consume_messages(self):
-        """持续消费Kafka消息."""
+        """
+        持续消费Kafka消息，最多同时处理 max_in_flight 条.
+
+        先拉取高优先级通道，高优先级消息可以使用全部槽位；
+        普通通道最多使用 normal_max_in_flight 个槽位，剩余槽位始终留给高优先级消息
+        """
         await self.start()
         try:
-            async for msg in self.consumer:  # 异步循环消费消息
-                logger.info("kafka start consume")
-                message_id = msg.offset  # 使用消息的偏移量作为唯一标识
-                redis_connection = (
-                    await redis.get_task_connection()
-                )  # 获取 Redis 连接实例
-
-                lock_key = f"{self.lock_name}:{message_id}"  # 使用偏移量创建唯一的锁名
-
-                # 检查锁是否存在
-                is_locked = await redis_connection.exists(lock_key)
-                if is_locked:
-                    # 如果锁存在，直接进入 else 分支
-                    logger.info(
-                        f"Message {message_id} is already being processed by another instance."
+            while True:
+                assignment = self.consumer.assignment()
+                high_partitions = [
+                    tp for tp in assignment if tp.topic == KAFKA_PRIORITY_TOPIC
+                ]
+                normal_partitions = [
+                    tp for tp in assignment if tp.topic != KAFKA_PRIORITY_TOPIC
+                ]
+                free_slots = self.max_in_flight - self.in_flight
+                normal_slots = min(
+                    free_slots, self.normal_max_in_flight - self.normal_in_flight
+                )
+
+                # 处理槽位已满时暂停拉取，但仍需定期调用 getmany 以保持在消费组中；
+                # 排在清理消息之后的消息也占用槽位，内存中缓冲的消息不超过 max_in_flight
+                self.toggle_partitions(high_partitions, free_slots > 0)
+                self.toggle_partitions(normal_partitions, normal_slots > 0)
+
+                polled = False
+                dispatched = 0
+                if high_partitions and free_slots > 0:
+                    # 普通通道也可拉取时不在高优先级通道上阻塞等待
+                    batches = await self.consumer.getmany(
+                        *high_partitions,
+                        timeout_ms=0
+                        if normal_partitions and normal_slots > 0
+                        else KAFKA_POLL_TIMEOUT_MS,
+                        max_records=free_slots,
                     )
-                    continue  # 直接跳过此消息，继续处理下一个消息
-
-                lock = redis_connection.lock(lock_key, timeout=100)  # 创建锁
-
-                if await lock.acquire(blocking=False):  # 尝试非阻塞获取锁
-                    try:
-                        await self.consumer.commit()  # 手动提交消息，确保处理成功才提交
-                        await self.process_message(msg)  # 处理每条消息
-                    except Exception as e:
-                        logger.error(f"Error processing message: {e}")
-                    finally:
-                        await lock.release()  # 释放锁
-                else:
-                    logger.info(
-                        f"Message {message_id} is already being processed by another instance."
+                    dispatched = self.dispatch(batches)
+                    polled = True
+
+                normal_slots = min(normal_slots, free_slots - dispatched)
+                if normal_partitions and normal_slots > 0:
+                    batches = await self.consumer.getmany(
+                        *normal_partitions,
+                        timeout_ms=0 if dispatched else KAFKA_POLL_TIMEOUT_MS,
+                        max_records=normal_slots,
+                    )
+                    self.dispatch(batches)
+                    polled = True
+
+                if not polled:
+                    batches = await self.consumer.getmany(
+                        timeout_ms=KAFKA_POLL_TIMEOUT_MS,
+                        max_records=max(free_slots, 1),
                     )
+                    self.dispatch(batches)
 
         except Exception as e:
             logger.error(f"Error consuming messages: {e}")
             raise e
 
 
+def get_message_priority(msg: ConsumerRecord) -> int:
+    """读取消息头中的优先级，没有时按所在 topic 判断"""
+    for key, value in msg.headers or []:
+        if key == KAFKA_PRIORITY_HEADER:
+            try:
+                return int(value.decode("utf-8"))
+            except ValueError:
+                break
+    return 0 if msg.topic == KAFKA_PRIORITY_TOPIC else 1
+
+
+def get_message_type(msg: ConsumerRecord) -> str:
+    try:
+        return json.loads(msg.value.decode("utf-8")).get("type", "")
+    except ValueError:
+        return ""
+
+
+def get_message_task_id(msg: ConsumerRecord) -> str:
+    try:
+        return json.loads(msg.value.decode("utf-8")).get("task_id", "")
+    except ValueError:
+        return ""
+
+
 kafka_consumer_manager = KafkaConsumerManager()
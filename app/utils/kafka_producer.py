@@ -1,4 +1,7 @@
+import asyncio
 import json
+import time
+from typing import Optional
 from aiokafka import AIOKafkaProducer
 from aiokafka.errors import KafkaError
 from app.core.config import settings
@@ -6,7 +9,52 @@ from app.core.logging import logger
 
 KAFKA_TOPIC = settings.kafka_topic
 KAFKA_BOOTSTRAP_SERVERS = settings.kafka_broker_url
+KAFKA_PRIORITY_TOPIC = settings.kafka_priority_topic
 KAFKA_PRIORITY_HEADER = "priority"
+KAFKA_RETRY_TOPIC = settings.kafka_retry_topic
+KAFKA_DEAD_LETTER_TOPIC = settings.kafka_dead_letter_topic
+KAFKA_ATTEMPTS_HEADER = "attempts"  # 已处理失败的次数
+KAFKA_NOT_BEFORE_HEADER = "not_before"  # 重试消息最早可以重新投递的时间戳（秒）
+KAFKA_ORIGIN_TOPIC_HEADER = "origin_topic"  # 重试/死信消息原本所在的 topic
+KAFKA_ERROR_HEADER = "error"
+REINDEX_MESSAGE_TYPE = "reindex"  # 知识库重建索引任务，其余消息为文件解析任务
+CLEANUP_MESSAGE_TYPE = "cleanup"  # 清理已标记删除的知识库或文件
+DROP_COLLECTION_MESSAGE_TYPE = "drop_collection"  # 重建索引切换集合后延迟删除旧集合
+PRIORITY_HIGH = 0  # 聊天中上传的临时文件，需要尽快可用
+PRIORITY_NORMAL = 1  # 知识库批量导入
+
+
+def get_priority_topic(priority) -> str:
+    """按优先级选择解析任务的 topic，0 为最高"""
+    return KAFKA_PRIORITY_TOPIC if int(priority) <= PRIORITY_HIGH else KAFKA_TOPIC
+
+
+def get_knowledge_base_priority(knowledge_db_id: str) -> int:
+    """知识库解析任务的优先级：聊天上传的临时知识库为高优先级"""
+    return PRIORITY_HIGH if knowledge_db_id.startswith("temp_") else PRIORITY_NORMAL
+
+
+def get_message_key(knowledge_db_id: str) -> bytes:
+    """按知识库分区：同一知识库的消息进入同一分区，由同一个消费者按顺序处理"""
+    return knowledge_db_id.encode("utf-8") if knowledge_db_id else None
+
+
+def get_header(headers, key: str):
+    for header_key, value in headers or []:
+        if header_key == key:
+            return value.decode("utf-8")
+    return None
+
+
+def merge_headers(headers, **updates) -> list:
+    """替换或追加消息头，值为 None 时删除该消息头"""
+    merged = [(key, value) for key, value in headers or [] if key not in updates]
+    merged.extend(
+        (key, str(value).encode("utf-8"))
+        for key, value in updates.items()
+        if value is not None
+    )
+    return merged
 
 
 class KafkaProducerManager:
@@ -15,7 +63,12 @@ class KafkaProducerManager:
 
     async def start(self):
         if not self.producer:
-            self.producer = AIOKafkaProducer(bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS)
+            self.producer = AIOKafkaProducer(
+                bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+                linger_ms=settings.kafka_producer_linger_ms,
+                max_batch_size=settings.kafka_producer_max_batch_size,
+                compression_type=settings.kafka_producer_compression_type or None,
+            )
             await self.producer.start()
 
     async def stop(self):
@@ -23,34 +76,189 @@ class KafkaProducerManager:
             await self.producer.stop()
 
     # @retry(stop=stop_after_attempt(5), wait=wait_fixed(2))
-    async def send_embedding_task(
+    async def send_embedding_tasks(
         self,
         task_id: str,
         username: str,
         knowledge_db_id: str,
-        file_meta: dict,
-        priority: str,
+        file_metas: list,
+        priority: int,
+    ) -> list:
+        """
+        并发发送一次上传的所有解析任务（每个文件一个消息），等待全部投递完成
+
+        消息先进入生产者缓冲区，按 linger_ms 合并为批次压缩发送；
+        返回投递失败的文件列表（file_id / filename / error），全部成功时为空
+        """
+        topic = get_priority_topic(priority)
+        headers = [(KAFKA_PRIORITY_HEADER, str(priority).encode("utf-8"))]  # 消息头包含优先级
+        await self.start()
+
+        deliveries = []
+        failed = []
+        for file_meta in file_metas:
+            message = {
+                "task_id": task_id,
+                "username": username,
+                "knowledge_db_id": knowledge_db_id,
+                "file_meta": file_meta,
+            }
+            try:
+                # send 只等待缓冲区空间，返回投递结果的 future
+                delivery = await self.producer.send(
+                    topic,
+                    json.dumps(message).encode("utf-8"),
+                    key=get_message_key(knowledge_db_id),
+                    headers=headers,
+                )
+                deliveries.append((file_meta, delivery))
+            except KafkaError as e:
+                failed.append((file_meta, e))
+
+        results = await asyncio.gather(
+            *[delivery for _, delivery in deliveries], return_exceptions=True
+        )
+        for (file_meta, _), result in zip(deliveries, results):
+            if isinstance(result, Exception):
+                failed.append((file_meta, result))
+
+        for file_meta, error in failed:
+            logger.error(
+                f"Error sending task {task_id} file {file_meta['file_id']} to Kafka: {error}"
+            )
+        logger.info(
+            f"Task {task_id}: {len(file_metas) - len(failed)}/{len(file_metas)} "
+            f"messages sent to Kafka topic {topic} with priority: {priority}"
+        )
+        return [
+            {
+                "file_id": file_meta["file_id"],
+                "filename": file_meta["original_filename"],
+                "error": str(error),
+            }
+            for file_meta, error in failed
+        ]
+
+    async def send_reindex_task(self, task_id: str, username: str, knowledge_db_id: str):
+        message = {
+            "type": REINDEX_MESSAGE_TYPE,
+            "task_id": task_id,
+            "username": username,
+            "knowledge_db_id": knowledge_db_id,
+        }
+        await self.start()
+        await self.producer.send_and_wait(
+            KAFKA_TOPIC,
+            json.dumps(message).encode("utf-8"),
+            key=get_message_key(knowledge_db_id),
+            headers=[(KAFKA_PRIORITY_HEADER, str(PRIORITY_NORMAL).encode("utf-8"))],
+        )
+        logger.info(f"Task {task_id} message sent to Kafka: {message}")
+
+    async def send_cleanup_task(
+        self,
+        task_id: str,
+        username: str,
+        knowledge_db_id: str,
+        file_ids: Optional[list],
+        drop_knowledge_base: bool,
     ):
+        """
+        与该知识库的解析消息使用相同的 topic 和 key，排在已发送的解析任务之后执行
 
+        正在重试（经过重试 topic）的解析消息不保证在清理之前，由 process_file 检查文件是否已删除兜底
+        """
+        priority = get_knowledge_base_priority(knowledge_db_id)
         message = {
+            "type": CLEANUP_MESSAGE_TYPE,
             "task_id": task_id,
             "username": username,
             "knowledge_db_id": knowledge_db_id,
-            "file_meta": file_meta,
+            "file_ids": file_ids,
+            "drop_knowledge_base": drop_knowledge_base,
         }
+        await self.start()
+        await self.producer.send_and_wait(
+            get_priority_topic(priority),
+            json.dumps(message).encode("utf-8"),
+            key=get_message_key(knowledge_db_id),
+            headers=[(KAFKA_PRIORITY_HEADER, str(priority).encode("utf-8"))],
+        )
+        logger.info(f"Task {task_id} cleanup message sent to Kafka: {knowledge_db_id}")
 
-        try:
-            await self.start()
-            await self.producer.send(
-                KAFKA_TOPIC,
-                json.dumps(message).encode("utf-8"),
-                headers=[
-                    (KAFKA_PRIORITY_HEADER, str(priority).encode("utf-8"))
-                ],  # 消息头包含优先级
-            )
-            logger.info(f"Task {task_id} message sent to Kafka: {message} with priority: {priority}")
-        except KafkaError as e:
-            logger.error(f"Error sending message to Kafka: {e}")
+    async def send_drop_collection_task(
+        self, task_id: str, knowledge_db_id: str, collection_name: str, delay: float
+    ):
+        """经重试 topic 延迟 delay 秒后投递，等待进行中的检索结束后再删除旧集合"""
+        message = {
+            "type": DROP_COLLECTION_MESSAGE_TYPE,
+            "task_id": task_id,
+            "knowledge_db_id": knowledge_db_id,
+            "collection_name": collection_name,
+        }
+        await self.start()
+        await self.producer.send_and_wait(
+            KAFKA_RETRY_TOPIC,
+            json.dumps(message).encode("utf-8"),
+            key=get_message_key(knowledge_db_id),
+            headers=[
+                (KAFKA_PRIORITY_HEADER, str(PRIORITY_NORMAL).encode("utf-8")),
+                (KAFKA_NOT_BEFORE_HEADER, str(time.time() + delay).encode("utf-8")),
+                (KAFKA_ORIGIN_TOPIC_HEADER, KAFKA_TOPIC.encode("utf-8")),
+            ],
+        )
+        logger.info(f"Task {task_id} drop {collection_name} scheduled in {delay}s")
+
+    async def send_retry(
+        self,
+        key: bytes,
+        value: bytes,
+        headers,
+        origin_topic: str,
+        attempts: int,
+        delay: float,
+        error: str,
+    ):
+        """发送到重试 topic，由重试调度器在 delay 秒后投递回原 topic"""
+        await self.start()
+        await self.producer.send_and_wait(
+            KAFKA_RETRY_TOPIC,
+            value,
+            key=key,
+            headers=merge_headers(
+                headers,
+                **{
+                    KAFKA_ATTEMPTS_HEADER: attempts,
+                    KAFKA_NOT_BEFORE_HEADER: time.time() + delay,
+                    KAFKA_ORIGIN_TOPIC_HEADER: origin_topic,
+                    KAFKA_ERROR_HEADER: error[:1000],
+                },
+            ),
+        )
+
+    async def send_dead_letter(
+        self, key: bytes, value: bytes, headers, origin_topic: str, attempts: int, error: str
+    ):
+        await self.start()
+        await self.producer.send_and_wait(
+            KAFKA_DEAD_LETTER_TOPIC,
+            value,
+            key=key,
+            headers=merge_headers(
+                headers,
+                **{
+                    KAFKA_ATTEMPTS_HEADER: attempts,
+                    KAFKA_NOT_BEFORE_HEADER: None,
+                    KAFKA_ORIGIN_TOPIC_HEADER: origin_topic,
+                    KAFKA_ERROR_HEADER: error[:1000],
+                },
+            ),
+        )
+
+    async def republish(self, topic: str, key: bytes, value: bytes, headers):
+        """投递回解析 topic（重试到期或死信重放）"""
+        await self.start()
+        await self.producer.send_and_wait(topic, value, key=key, headers=headers)
 
 
 kafka_producer_manager = KafkaProducerManager()
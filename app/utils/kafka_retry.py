@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import time
+from aiokafka import AIOKafkaConsumer, ConsumerRecord, TopicPartition
+from aiokafka.errors import KafkaError
+from app.core.config import settings
+from app.core.logging import logger
+from app.utils.kafka_consumer import (
+    OffsetTrackingRebalanceListener,
+    PartitionOffsetTracker,
+)
+from app.utils.kafka_producer import (
+    KAFKA_NOT_BEFORE_HEADER,
+    KAFKA_ORIGIN_TOPIC_HEADER,
+    KAFKA_RETRY_TOPIC,
+    KAFKA_TOPIC,
+    get_header,
+    kafka_producer_manager,
+    merge_headers,
+)
+
+KAFKA_BOOTSTRAP_SERVERS = settings.kafka_broker_url
+KAFKA_RETRY_GROUP_ID = f"{settings.kafka_group_id}_retry"
+KAFKA_POLL_TIMEOUT_MS = 1000
+
+
+class RetryScheduler:
+    """
+    消费重试 topic，等到消息头中的 not_before 时间后再投递回原 topic
+
+    拉取到的消息放入按 not_before 排序的堆，到期后投递，退避时间长的消息不阻塞其后到期更早的消息；
+    堆中消息达到 max_pending 时暂停拉取。投递成功且同一分区更早的消息都已投递后才提交偏移量，
+    重复投递由解析消费者的幂等检查兜底
+    """
+
+    def __init__(self, max_pending: int = None):
+        self.consumer = None
+        self.max_pending = max_pending or settings.kafka_retry_max_pending
+        self.heap = []  # (not_before, 序号, TopicPartition, 消息)
+        self.sequence = itertools.count()
+        self.trackers = {}  # TopicPartition -> PartitionOffsetTracker
+
+    async def start(self):
+        if not self.consumer:
+            self.consumer = AIOKafkaConsumer(
+                bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
+                group_id=KAFKA_RETRY_GROUP_ID,
+                enable_auto_commit=False,
+            )
+            self.consumer.subscribe(
+                [KAFKA_RETRY_TOPIC],
+                listener=OffsetTrackingRebalanceListener(self),
+            )
+            await self.consumer.start()
+
+    async def stop(self):
+        if self.consumer:
+            await self.consumer.stop()
+            self.consumer = None
+        self.heap = []
+        self.trackers = {}
+
+    def drop_backlog(self, partitions: set):
+        """丢弃已回收分区中尚未投递的消息，由新的消费者重新调度"""
+        self.heap = [item for item in self.heap if item[2] not in partitions]
+        heapq.heapify(self.heap)
+
+    def add(self, tp: TopicPartition, msg: ConsumerRecord):
+        self.trackers.setdefault(tp, PartitionOffsetTracker()).add(msg.offset)
+        not_before = float(get_header(msg.headers, KAFKA_NOT_BEFORE_HEADER) or 0)
+        heapq.heappush(self.heap, (not_before, next(self.sequence), tp, msg))
+
+    async def republish(self, msg: ConsumerRecord):
+        origin_topic = get_header(msg.headers, KAFKA_ORIGIN_TOPIC_HEADER) or KAFKA_TOPIC
+        await kafka_producer_manager.republish(
+            origin_topic,
+            msg.key,
+            msg.value,
+            merge_headers(msg.headers, **{KAFKA_NOT_BEFORE_HEADER: None}),
+        )
+
+    async def commit_completed(self, tp: TopicPartition, offset: int):
+        tracker = self.trackers.get(tp)
+        if tracker is None:  # 分区已被回收
+            return
+        commit_offset = tracker.complete(offset)
+        if commit_offset is None:
+            return
+        try:
+            await self.consumer.commit({tp: commit_offset})
+        except KafkaError as e:
+            logger.warning(f"Commit retry offset of {tp} failed: {e}")
+
+    async def republish_due(self):
+        """投递所有已到期的消息"""
+        while self.heap and self.heap[0][0] <= time.time():
+            _, _, tp, msg = heapq.heappop(self.heap)
+            try:
+                await self.republish(msg)
+            except KafkaError as e:
+                # 未提交，稍后重新投递
+                logger.error(f"Republish retry message failed: {e}")
+                retry_at = time.time() + KAFKA_POLL_TIMEOUT_MS / 1000
+                heapq.heappush(self.heap, (retry_at, next(self.sequence), tp, msg))
+                return
+            await self.commit_completed(tp, msg.offset)
+
+    async def run(self):
+        await self.start()
+        try:
+            while True:
+                await self.republish_due()
+
+                # 堆已满时暂停拉取，但仍需定期调用 getmany 以保持在消费组中
+                free_slots = self.max_pending - len(self.heap)
+                partitions = list(self.consumer.assignment())
+                if free_slots > 0:
+                    self.consumer.resume(*partitions)
+                else:
+                    self.consumer.pause(*partitions)
+
+                timeout_ms = KAFKA_POLL_TIMEOUT_MS
+                if self.heap:
+                    timeout_ms = min(
+                        timeout_ms, max(0, int((self.heap[0][0] - time.time()) * 1000))
+                    )
+                batches = await self.consumer.getmany(
+                    timeout_ms=timeout_ms, max_records=max(free_slots, 1)
+                )
+                for tp, messages in batches.items():
+                    for msg in messages:
+                        self.add(tp, msg)
+        except Exception as e:
+            logger.error(f"Error scheduling retry messages: {e}")
+            raise e
+
+
+kafka_retry_scheduler = RetryScheduler()
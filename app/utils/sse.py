@@ -0,0 +1,106 @@
+import asyncio
+import json
+import time
+from app.core.config import settings
+
+# orjson 随 fastapi[all] 安装，不可用时退回标准库
+try:
+    import orjson
+
+    def dumps(payload) -> str:
+        # 检索分数等字段是 numpy 标量
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+
+except ImportError:
+
+    def dumps(payload) -> str:
+        return json.dumps(payload, ensure_ascii=False)
+
+
+def sse_event(payload) -> str:
+    return f"data: {dumps(payload)}\n\n"
+
+
+class DeltaCoalescer:
+    """
+    合并连续的同类型（text / thinking）增量后再序列化为一个 SSE 事件
+
+    第一个增量立即发送；之后的增量在缓冲超过 max_bytes、距缓冲开始超过 window 秒
+    或类型变化时发送。window 为 0 时不合并
+    """
+
+    def __init__(self, message_id: str, window: float = None, max_bytes: int = None):
+        self.message_id = message_id
+        self.window = (
+            settings.sse_coalesce_window_ms / 1000 if window is None else window
+        )
+        self.max_bytes = (
+            settings.sse_coalesce_max_bytes if max_bytes is None else max_bytes
+        )
+        self.first = True
+        self.type = None
+        self.parts = []
+        self.size = 0
+        self.started_at = 0.0
+
+    def timeout(self):
+        """距离缓冲内容需要发送的剩余时间，没有缓冲时返回 None"""
+        if not self.parts:
+            return None
+        return max(0.0, self.started_at + self.window - time.monotonic())
+
+    def add(self, event_type: str, data: str) -> list:
+        """加入一个增量，返回需要立即发送的事件"""
+        if not data:
+            return []
+        events = []
+        if self.parts and event_type != self.type:
+            events.extend(self.flush())
+        if not self.parts:
+            self.type = event_type
+            self.started_at = time.monotonic()
+        self.parts.append(data)
+        self.size += len(data.encode("utf-8"))
+        if self.first or not self.window or self.size >= self.max_bytes:
+            self.first = False
+            events.extend(self.flush())
+        elif self.timeout() == 0:
+            events.extend(self.flush())
+        return events
+
+    def flush(self) -> list:
+        if not self.parts:
+            return []
+        event = sse_event(
+            {"type": self.type, "data": "".join(self.parts), "message_id": self.message_id}
+        )
+        self.parts = []
+        self.size = 0
+        return [event]
+
+
+async def iter_with_timeout(stream, get_timeout):
+    """
+    逐个产出 stream 的元素，get_timeout() 秒内没有新元素时产出 None
+
+    等待中的 __anext__ 不会被取消，超时后继续等待同一个元素
+    """
+    iterator = stream.__aiter__()
+    next_item = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({next_item}, timeout=get_timeout())
+            if not done:
+                yield None
+                continue
+            task, next_item = next_item, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if next_item is not None:
+            next_item.cancel()
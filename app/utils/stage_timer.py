@@ -0,0 +1,50 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    累计文件解析各阶段（render / encode / upload / metadata / embed / insert）的耗时
+
+    默认关闭，由 ingest_benchmark.py 等分析工具开启；渲染阶段在线程池中执行，累加时加锁。
+    并发处理时各阶段耗时会重叠，总和可能大于实际运行时间
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def measure(self, stage: str, count: int = 1):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, count)
+
+    def add(self, stage: str, seconds: float, count: int = 1):
+        with self.lock:
+            self.totals[stage] += seconds
+            self.counts[stage] += count
+
+    def reset(self):
+        with self.lock:
+            self.totals.clear()
+            self.counts.clear()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                stage: {"seconds": self.totals[stage], "count": self.counts[stage]}
+                for stage in self.totals
+            }
+
+
+stage_timer = StageTimer()
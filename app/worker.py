@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import signal
+
+from app.core.config import settings
+from app.core.logging import logger
+from app.db.mongo import mongodb
+from app.db.redis import redis
+from app.db.miniodb import async_minio_manager
+from app.rag.cleanup import tombstone_sweeper
+from app.rag.embed_batcher import embedding_batcher
+from app.utils.kafka_consumer import KafkaConsumerManager
+from app.utils.kafka_producer import kafka_producer_manager
+from app.utils.kafka_retry import kafka_retry_scheduler
+
+
+async def run_worker(consumers: int, max_in_flight: int):
+    """独立运行文件解析消费者，不提供 HTTP 服务"""
+    await mongodb.connect()  # 连接 MongoDB
+    await async_minio_manager.init_minio()
+
+    managers = [KafkaConsumerManager(max_in_flight) for _ in range(consumers)]
+    tasks = [asyncio.create_task(manager.consume_messages()) for manager in managers]
+    tasks.append(asyncio.create_task(kafka_retry_scheduler.run()))  # 重试调度
+    tasks.append(asyncio.create_task(tombstone_sweeper.run()))  # 遗留删除标记的清理
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    stop_task = asyncio.create_task(stop_event.wait())
+    logger.info(
+        f"Ingestion worker started with {consumers} consumer(s), "
+        f"{max_in_flight} file(s) in flight each"
+    )
+
+    try:
+        # 收到退出信号或任一消费者异常退出时停止
+        await asyncio.wait([stop_task, *tasks], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in [stop_task, *tasks]:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for manager in managers:
+            await manager.stop()  # 停止Kafka消费者
+        await embedding_batcher.stop()  # 等待进行中的嵌入请求
+        await kafka_retry_scheduler.stop()
+        await kafka_producer_manager.stop()  # 重试/死信消息使用的生产者
+        await mongodb.close()  # 关闭 MongoDB 连接
+        await redis.close()  # 关闭 Redis 连接
+        logger.info("Ingestion worker stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KVisualRAG ingestion worker")
+    parser.add_argument(
+        "--consumers",
+        type=int,
+        default=settings.ingest_worker_consumers,
+        help="number of Kafka consumers in this process",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=settings.kafka_consumer_max_in_flight,
+        help="number of files each consumer processes concurrently",
+    )
+    args = parser.parse_args()
+    asyncio.run(run_worker(max(1, args.consumers), max(1, args.max_in_flight)))
+
+
+if __name__ == "__main__":
+    main()
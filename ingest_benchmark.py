@@ -0,0 +1,376 @@
+"""
+文件解析吞吐量基准测试
+
+用真实的 Kafka 消费者和 process_file 代码处理生成的 PDF，外部服务替换为本地实现：
+- Kafka：内存中的单分区消费者，驱动 KafkaConsumerManager.consume_messages
+- MinIO：本地目录对象存储
+- MongoDB：mongomock-motor（未安装时使用配置中的 MongoDB，数据库名加 _benchmark 后缀）
+- Redis：fakeredis（需要 lupa 支持锁脚本，未安装时使用配置中的 Redis）
+- Milvus：Milvus Lite 本地文件（pymilvus 在 Linux/macOS 上自带）
+- 嵌入服务：确定性的假向量，请求延迟可配置
+
+输出各阶段耗时（render / encode / upload / metadata / embed / insert）、pages/s 和峰值内存。
+
+    pip install "fakeredis[lua]" mongomock-motor
+    python ingest_benchmark.py --files 8 --pages 20 --max-in-flight 4 --embed-latency 0.2
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="KVisualRAG ingestion benchmark")
+    parser.add_argument("--files", type=int, default=8, help="number of generated PDFs")
+    parser.add_argument("--pages", type=int, default=10, help="pages per PDF")
+    parser.add_argument(
+        "--knowledge-bases",
+        type=int,
+        default=1,
+        help="spread the files over this many knowledge bases",
+    )
+    parser.add_argument(
+        "--max-in-flight", type=int, default=4, help="files processed concurrently"
+    )
+    parser.add_argument(
+        "--priority",
+        action="store_true",
+        help="send messages to the high priority topic",
+    )
+    parser.add_argument(
+        "--embed-latency",
+        type=float,
+        default=0.1,
+        help="fixed latency of each embedding request (seconds)",
+    )
+    parser.add_argument(
+        "--embed-page-latency",
+        type=float,
+        default=0.02,
+        help="additional embedding latency per page in a request (seconds)",
+    )
+    parser.add_argument(
+        "--embed-vectors", type=int, default=256, help="vectors per page embedding"
+    )
+    parser.add_argument("--workdir", default=None, help="keep stand-in data here")
+    return parser.parse_args()
+
+
+def generate_pdf(path: Path, pages: int, seed: int):
+    """生成 A4 大小、带文字和色块的 PDF（72 DPI 下像素数等于 pt）"""
+    from PIL import Image, ImageDraw
+
+    images = []
+    for page in range(pages):
+        image = Image.new("RGB", (595, 842), "white")
+        draw = ImageDraw.Draw(image)
+        for line in range(40):
+            draw.text(
+                (40, 40 + line * 18),
+                f"file {seed} page {page + 1} line {line} " * 3,
+                fill="black",
+            )
+        draw.rectangle(
+            (60, 600, 60 + (seed * 37 + page * 53) % 400, 780),
+            fill=((seed * 50) % 255, (page * 30) % 255, 120),
+        )
+        images.append(image)
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=72)
+
+
+class FilesystemObjectStore:
+    """以本地目录代替 MinIO"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    async def upload_image(self, file_name, image_stream, content_type="image/png"):
+        image_stream.seek(0)
+        data = image_stream.read()
+        await asyncio.to_thread((self.root / file_name).write_bytes, data)
+
+    async def create_presigned_url(self, file_name):
+        return (self.root / file_name).as_uri()
+
+    async def get_file_from_minio(self, minio_filename):
+        return await asyncio.to_thread((self.root / minio_filename).read_bytes)
+
+
+class InMemoryKafkaConsumer:
+    """单分区的内存消息队列，实现 KafkaConsumerManager 用到的 AIOKafkaConsumer 接口"""
+
+    def __init__(self, topic, values):
+        from aiokafka import ConsumerRecord, TopicPartition
+
+        self.tp = TopicPartition(topic, 0)
+        self.records = [
+            ConsumerRecord(
+                topic=topic,
+                partition=0,
+                offset=offset,
+                timestamp=int(time.time() * 1000),
+                timestamp_type=0,
+                key=key,
+                value=value,
+                checksum=None,
+                serialized_key_size=len(key or b""),
+                serialized_value_size=len(value),
+                headers=headers,
+            )
+            for offset, (key, value, headers) in enumerate(values)
+        ]
+        self.position = 0
+        self.paused = set()
+        self.all_committed = asyncio.Event()
+
+    def assignment(self):
+        return {self.tp}
+
+    def pause(self, *partitions):
+        self.paused.update(partitions)
+
+    def resume(self, *partitions):
+        self.paused.difference_update(partitions)
+
+    async def getmany(self, *partitions, timeout_ms=0, max_records=None):
+        partitions = partitions or (self.tp,)
+        if (
+            self.tp in partitions
+            and self.tp not in self.paused
+            and self.position < len(self.records)
+        ):
+            end = len(self.records)
+            if max_records:
+                end = min(end, self.position + max_records)
+            batch = self.records[self.position : end]
+            self.position = end
+            return {self.tp: batch}
+        await asyncio.sleep(timeout_ms / 1000)
+        return {}
+
+    async def commit(self, offsets):
+        if offsets.get(self.tp, 0) >= len(self.records):
+            self.all_committed.set()
+
+    async def stop(self):
+        pass
+
+
+def make_fake_embedder(args):
+    import numpy as np
+
+    async def get_embeddings_from_httpx(data, endpoint):
+        """确定性的假嵌入：按图片内容生成固定向量，延迟 = 固定延迟 + 每页延迟 * 页数"""
+        await asyncio.sleep(args.embed_latency + args.embed_page_latency * len(data))
+        embeddings = []
+        for _, (_, image_buffer, _) in data:
+            seed = zlib.crc32(image_buffer.getvalue())
+            rng = np.random.default_rng(seed)
+            vectors = rng.standard_normal((args.embed_vectors, 128)).astype("float32")
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            embeddings.append(vectors)
+        return embeddings
+
+    return get_embeddings_from_httpx
+
+
+async def connect_mongo(mongodb, settings):
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+
+        mongodb.client = AsyncMongoMockClient()
+        mongodb.db = mongodb.client[settings.mongodb_db]
+        await mongodb._create_indexes()
+        return "mongomock-motor"
+    except ImportError:
+        settings.mongodb_db = f"{settings.mongodb_db}_benchmark"
+        await mongodb.connect()
+        await mongodb.client.drop_database(settings.mongodb_db)
+        await mongodb._create_indexes()
+        return f"MongoDB {settings.mongodb_url}/{settings.mongodb_db}"
+
+
+def install_redis(redis):
+    try:
+        import fakeredis
+        import fakeredis.aioredis
+        import lupa  # noqa: F401  锁的续期和释放依赖 Lua 脚本
+    except ImportError:
+        return "Redis from settings"
+
+    server = fakeredis.FakeServer()
+    connections = {}
+
+    async def get_redis_connection(db: int = 0):
+        if db not in connections:
+            connections[db] = fakeredis.aioredis.FakeRedis(
+                server=server, db=db, decode_responses=True
+            )
+        return connections[db]
+
+    redis.get_redis_connection = get_redis_connection
+    return "fakeredis"
+
+
+def print_report(args, stages, wall, pages, peak_rss_mb, backends):
+    print()
+    print("Backends: " + ", ".join(f"{k}={v}" for k, v in backends.items()))
+    print(
+        f"{args.files} files x {args.pages} pages, "
+        f"{args.knowledge_bases} knowledge base(s), max in flight {args.max_in_flight}"
+        + ("" if args.priority else " (minus slots reserved for high priority)")
+    )
+    print()
+    print(f"{'stage':<10}{'busy (s)':>12}{'count':>8}{'avg (ms)':>12}")
+    for stage in ("render", "encode", "upload", "metadata", "embed", "insert"):
+        stat = stages.get(stage, {"seconds": 0.0, "count": 0})
+        avg = stat["seconds"] / stat["count"] * 1000 if stat["count"] else 0.0
+        print(f"{stage:<10}{stat['seconds']:>12.2f}{stat['count']:>8}{avg:>12.1f}")
+    print()
+    print(f"wall time   {wall:.2f}s")
+    print(f"throughput  {pages / wall:.2f} pages/s ({pages / wall * 60:.0f} pages/min)")
+    print(f"peak RSS    {peak_rss_mb:.0f} MiB")
+
+
+async def run(args, workdir: Path):
+    import json
+    import uuid
+
+    from app.core.config import settings
+    from app.db.milvus import default_collection_name, milvus_client
+    from app.db.miniodb import async_minio_manager
+    from app.db.mongo import mongodb
+    from app.db.redis import redis
+    from app.rag import embed_batcher
+    from app.rag.utils import init_task_progress
+    from app.utils.kafka_consumer import KafkaConsumerManager
+    from app.utils.kafka_producer import (
+        KAFKA_PRIORITY_HEADER,
+        PRIORITY_HIGH,
+        PRIORITY_NORMAL,
+        get_priority_topic,
+    )
+    from app.utils.stage_timer import stage_timer
+
+    assert settings.milvus_uri == str(workdir / "milvus.db"), (
+        f"benchmark must use a local Milvus Lite file, got {settings.milvus_uri}"
+    )
+
+    store = FilesystemObjectStore(workdir / "objects")
+    async_minio_manager.upload_image = store.upload_image
+    async_minio_manager.create_presigned_url = store.create_presigned_url
+    async_minio_manager.get_file_from_minio = store.get_file_from_minio
+    embed_batcher.get_embeddings_from_httpx = make_fake_embedder(args)
+    backends = {
+        "kafka": "in-memory",
+        "minio": str(store.root),
+        "mongo": await connect_mongo(mongodb, settings),
+        "redis": install_redis(redis),
+        "milvus": settings.milvus_uri,
+    }
+
+    # 准备知识库、文件和消息，与上传接口写入的数据一致
+    username = "benchmark"
+    priority = PRIORITY_HIGH if args.priority else PRIORITY_NORMAL
+    knowledge_db_ids = [
+        f"{username}_{uuid.uuid4()}" for _ in range(max(1, args.knowledge_bases))
+    ]
+    for knowledge_db_id in knowledge_db_ids:
+        await mongodb.create_knowledge_base(
+            username, knowledge_db_id, knowledge_db_id, False
+        )
+        milvus_client.create_collection(default_collection_name(knowledge_db_id))
+
+    task_id = f"{username}_{uuid.uuid4()}"
+    task_redis = await redis.get_task_connection()
+    await init_task_progress(task_redis, task_id, username, args.files)
+    messages = []
+    for index in range(args.files):
+        filename = f"benchmark_{index}.pdf"
+        generate_pdf(store.root / filename, args.pages, index)
+        knowledge_db_id = knowledge_db_ids[index % len(knowledge_db_ids)]
+        file_id = f"{username}_{uuid.uuid4()}"
+        await mongodb.create_files(
+            file_id=file_id,
+            username=username,
+            filename=filename,
+            minio_filename=filename,
+            minio_url=(store.root / filename).as_uri(),
+            knowledge_db_id=knowledge_db_id,
+        )
+        message = {
+            "task_id": task_id,
+            "username": username,
+            "knowledge_db_id": knowledge_db_id,
+            "file_meta": {
+                "file_id": file_id,
+                "minio_filename": filename,
+                "original_filename": filename,
+            },
+        }
+        messages.append(
+            (
+                knowledge_db_id.encode("utf-8"),
+                json.dumps(message).encode("utf-8"),
+                [(KAFKA_PRIORITY_HEADER, str(priority).encode("utf-8"))],
+            )
+        )
+
+    manager = KafkaConsumerManager(args.max_in_flight)
+    manager.consumer = InMemoryKafkaConsumer(get_priority_topic(priority), messages)
+    stage_timer.reset()
+    stage_timer.enabled = True
+
+    start = time.perf_counter()
+    consume_task = asyncio.create_task(manager.consume_messages())
+    done_task = asyncio.create_task(manager.consumer.all_committed.wait())
+    await asyncio.wait([consume_task, done_task], return_when=asyncio.FIRST_COMPLETED)
+    wall = time.perf_counter() - start
+
+    consume_task.cancel()
+    done_task.cancel()
+    await asyncio.gather(consume_task, done_task, return_exceptions=True)
+    await manager.stop()
+
+    task = await task_redis.hgetall(f"task:{task_id}")
+    if task.get("status") != "completed":
+        print(f"Task did not complete: {task}")
+    pages = int(task.get("pages_processed", 0))
+    # ru_maxrss 在 Linux 上单位为 KiB，macOS 上为字节
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+    print_report(args, stage_timer.snapshot(), wall, pages, peak_rss_mb, backends)
+
+    for knowledge_db_id in knowledge_db_ids:
+        milvus_client.delete_collection(default_collection_name(knowledge_db_id))
+    await mongodb.close()
+    await redis.close()
+
+
+def main():
+    args = parse_args()
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="kvisualrag_benchmark_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    # 必须在导入 app.core.config 之前设置：Settings 和 Milvus 客户端在导入时创建，
+    # 环境变量需带 APP_ 前缀；始终使用临时文件，避免写入真实的 Milvus
+    os.environ["APP_MILVUS_URI"] = str(workdir / "milvus.db")
+    os.environ.setdefault("APP_LOG_LEVEL", "WARNING")  # 每页的 info 日志会影响测量结果
+
+    try:
+        asyncio.run(run(args, workdir))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
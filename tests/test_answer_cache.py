@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from app.rag import answer_cache
+
+
+class FakeConnection:
+    def __init__(self):
+        self.data = {}
+
+    async def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+
+
+class FakeRedis:
+    def __init__(self):
+        self.connection = FakeConnection()
+
+    async def get_cache_connection(self):
+        return self.connection
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(answer_cache, "redis", fake)
+    return fake
+
+
+def cache_key(question, image_ids=("page_1", "page_2")):
+    return answer_cache.answer_cache_key(
+        ["kb_1"], list(image_ids), "model", "system prompt", question
+    )
+
+
+def test_normalize_question_ignores_case_punctuation_and_whitespace():
+    assert answer_cache.normalize_question("  What is  RAG? ") == "what is rag"
+    assert answer_cache.normalize_question("什么是ＲＡＧ？") == answer_cache.normalize_question(
+        "什么是rag"
+    )
+
+
+def test_distinct_questions_with_same_pages_do_not_hit(fake_redis):
+    async def run():
+        key = await cache_key("What is the revenue in 2023?")
+        await answer_cache.set_cached_answer(key, "What is the revenue in 2023?", "10M")
+        other_key = await cache_key("What is the revenue in 2024?")
+        return key, other_key, await answer_cache.get_cached_answer(other_key)
+
+    key, other_key, cached = asyncio.run(run())
+    assert key != other_key
+    assert cached is None
+
+
+def test_same_question_with_same_pages_hits(fake_redis):
+    async def run():
+        key = await cache_key("What is the revenue in 2023?")
+        await answer_cache.set_cached_answer(key, "What is the revenue in 2023?", "10M")
+        return await answer_cache.get_cached_answer(
+            await cache_key("what is the revenue in 2023")
+        )
+
+    assert asyncio.run(run())["answer"] == "10M"
+
+
+def test_same_question_with_different_pages_does_not_hit(fake_redis):
+    async def run():
+        key = await cache_key("What is RAG?")
+        await answer_cache.set_cached_answer(key, "What is RAG?", "answer")
+        return await answer_cache.get_cached_answer(
+            await cache_key("What is RAG?", image_ids=("page_3",))
+        )
+
+    assert asyncio.run(run()) is None
@@ -0,0 +1,67 @@
+import asyncio
+
+from app.rag.model_config_cache import ModelConfigCache
+from app.utils.cache import TTLCache
+
+MODEL_CONFIG = {
+    "model_name": "model",
+    "model_url": "http://model",
+    "api_key": "key",
+    "base_used": [],
+    "system_prompt": "prompt",
+    "temperature": 0.5,
+    "max_length": 4096,
+    "top_P": 0.9,
+    "top_K": 3,
+}
+
+
+def test_generation_changes_on_every_removal():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    generation = cache.generation
+    cache.set("b", 2)
+    assert cache.generation == generation
+    cache.discard("missing")
+    assert cache.generation == generation + 1
+    cache.discard_if(lambda value: value == 1)
+    assert cache.generation == generation + 2
+    cache.clear()
+    assert cache.generation == generation + 3
+
+
+def test_entries_expire_after_ttl():
+    cache = TTLCache(maxsize=10, ttl=0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+class FakeDB:
+    def __init__(self, cache, discard_during_lookup):
+        self.cache = cache
+        self.discard_during_lookup = discard_during_lookup
+        self.lookups = 0
+
+    async def get_conversation_model_config(self, conversation_id):
+        self.lookups += 1
+        await asyncio.sleep(0)
+        if self.discard_during_lookup:
+            # 查询期间其他请求修改了配置并使缓存失效
+            self.cache.discard(conversation_id=conversation_id)
+        return MODEL_CONFIG
+
+
+def test_lookup_result_is_cached():
+    cache = ModelConfigCache()
+    db = FakeDB(cache, discard_during_lookup=False)
+    asyncio.run(cache.get(db, "user_conversation"))
+    asyncio.run(cache.get(db, "user_conversation"))
+    assert db.lookups == 1
+
+
+def test_lookup_racing_an_invalidation_is_not_written_back():
+    cache = ModelConfigCache()
+    db = FakeDB(cache, discard_during_lookup=True)
+    resolved = asyncio.run(cache.get(db, "user_conversation"))
+    assert resolved["model_name"] == "model"
+    assert cache.cache.get("user_conversation") is None
@@ -0,0 +1,67 @@
+import pytest
+
+from app.core.config import settings
+from app.rag.context_planner import IMAGE_PLACEHOLDER, plan_context
+
+SYSTEM_MESSAGE = {"role": "system", "content": ""}
+
+
+@pytest.fixture(autouse=True)
+def image_tokens(monkeypatch):
+    # 每张图片 100 token，每 4 个字母 1 token
+    monkeypatch.setattr(settings, "chat_image_tokens", {"test": 100})
+
+
+def image(url):
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def turn(text):
+    return [
+        {"role": "user", "content": text},
+        {"role": "assistant", "content": text},
+    ]
+
+
+def plan(history, pages, budget):
+    return plan_context(SYSTEM_MESSAGE, history, pages, "", "test", None, budget)
+
+
+def test_pages_beyond_budget_are_dropped_in_rank_order():
+    pages = [image("page_1"), image("page_2"), image("page_3")]
+    result = plan([], pages, budget=250)
+    assert result["pages"] == pages[:2]
+    assert result["dropped_pages"] == 1
+    assert result["tokens"] == 200
+
+
+def test_older_turns_are_dropped_first():
+    old, recent = turn("a" * 80), turn("b" * 80)
+    result = plan(old + recent, [], budget=50)
+    assert result["history"] == recent
+    assert result["dropped_turns"] == 1
+
+
+def test_history_images_are_replaced_before_the_turn_is_dropped():
+    history = [
+        {"role": "user", "content": [{"type": "text", "text": "a" * 40}, image("old")]},
+        {"role": "assistant", "content": "ok"},
+    ]
+    result = plan(history, [image("page_1")], budget=150)
+    assert result["pages"] == [image("page_1")]
+    assert result["dropped_turns"] == 0
+    assert result["dropped_images"] == 1
+    assert result["history"][0]["content"][1] == {
+        "type": "text",
+        "text": IMAGE_PLACEHOLDER,
+    }
+    # 不修改调用方的历史消息
+    assert history[0]["content"][1] == image("old")
+
+
+def test_zero_budget_keeps_everything():
+    history = turn("a" * 4000)
+    pages = [image(f"page_{index}") for index in range(10)]
+    result = plan(history, pages, budget=0)
+    assert result["history"] == history
+    assert result["pages"] == pages
@@ -0,0 +1,76 @@
+import asyncio
+import io
+
+from app.rag import embed_batcher
+from app.rag.embed_batcher import EmbeddingBatcher
+
+
+def fill(batcher, high, normal):
+    loop = asyncio.get_running_loop()
+    for index in range(high):
+        batcher.high_lane.append((f"high_{index}", io.BytesIO(), loop.create_future()))
+    for index in range(normal):
+        batcher.normal_lane.append(
+            (f"normal_{index}", io.BytesIO(), loop.create_future())
+        )
+
+
+def collect(high, normal, batch_size=8, priority_weight=3):
+    async def run():
+        batcher = EmbeddingBatcher(
+            batch_size=batch_size, max_wait=0, priority_weight=priority_weight
+        )
+        batcher.has_items = asyncio.Event()
+        fill(batcher, high, normal)
+        batch = await batcher._collect_batch()
+        return [name.split("_")[0] for name, _, _ in batch]
+
+    return asyncio.run(run())
+
+
+def test_normal_lane_keeps_its_share_under_high_priority_load():
+    lanes = collect(high=10, normal=10)
+    assert lanes.count("high") == 6
+    assert lanes.count("normal") == 2
+
+
+def test_unused_share_goes_to_the_other_lane():
+    assert collect(high=10, normal=1).count("high") == 7
+    assert collect(high=0, normal=10) == ["normal"] * 8
+    assert collect(high=10, normal=0) == ["high"] * 8
+
+
+def test_failed_page_does_not_fail_the_rest_of_its_batch(monkeypatch):
+    requests = []
+
+    async def get_embeddings(images_request, endpoint):
+        names = [name for _, (name, _, _) in images_request]
+        requests.append(names)
+        if "bad" in names:
+            raise RuntimeError("embedding service error")
+        return [[name] for name in names]
+
+    monkeypatch.setattr(embed_batcher, "get_embeddings_from_httpx", get_embeddings)
+
+    async def run():
+        batcher = EmbeddingBatcher(
+            batch_size=3, max_wait=0.05, max_concurrent_batches=1
+        )
+        try:
+            return await asyncio.gather(
+                *[
+                    batcher.embed(io.BytesIO(b"page"), name)
+                    for name in ("page_1", "bad", "page_2")
+                ],
+                return_exceptions=True,
+            )
+        finally:
+            await batcher.stop()
+
+    first, bad, second = asyncio.run(run())
+    assert first == ["page_1"]
+    assert second == ["page_2"]
+    assert isinstance(bad, RuntimeError)
+    # 整批失败后逐页重试
+    assert requests[0] == ["page_1", "bad", "page_2"]
+    assert sorted(requests[1:]) == [["bad"], ["page_1"], ["page_2"]]
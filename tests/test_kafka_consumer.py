@@ -0,0 +1,74 @@
+import asyncio
+import json
+from collections import namedtuple
+
+from aiokafka import TopicPartition
+
+from app.utils.kafka_consumer import KafkaConsumerManager, PartitionOffsetTracker
+
+Message = namedtuple("Message", "key value offset topic headers")
+
+
+def test_offset_tracker_commits_in_order():
+    tracker = PartitionOffsetTracker()
+    for offset in (10, 11, 12):
+        tracker.add(offset)
+    # 后面的消息先完成时不能越过未完成的消息提交
+    assert tracker.complete(12) is None
+    assert tracker.complete(11) is None
+    assert tracker.complete(10) == 13
+
+
+def test_offset_tracker_advances_over_contiguous_prefix():
+    tracker = PartitionOffsetTracker()
+    for offset in (0, 1, 2, 3):
+        tracker.add(offset)
+    assert tracker.complete(0) == 1
+    assert tracker.complete(2) is None
+    assert tracker.complete(1) == 3
+    assert tracker.complete(3) == 4
+    assert not tracker.pending and not tracker.done
+
+
+def message(offset, name, delay, message_type=""):
+    value = {"name": name, "delay": delay, "type": message_type}
+    return Message(b"kb", json.dumps(value).encode("utf-8"), offset, "topic", [])
+
+
+def test_cleanup_waits_for_earlier_ingests_of_same_key():
+    events = []
+
+    async def run():
+        manager = KafkaConsumerManager(max_in_flight=8)
+
+        async def handle_message(tp, msg):
+            value = json.loads(msg.value)
+            events.append(("start", value["name"]))
+            await asyncio.sleep(value["delay"])
+            events.append(("end", value["name"]))
+
+        manager.handle_message = handle_message
+        tp = TopicPartition("topic", 0)
+        manager.dispatch(
+            {
+                tp: [
+                    message(0, "ingest_1", 0.02),
+                    message(1, "ingest_2", 0.01),
+                    message(2, "cleanup", 0.01, "cleanup"),
+                    message(3, "ingest_3", 0.01),
+                ]
+            }
+        )
+        # 同一知识库的解析消息并发处理，排在清理之后的消息也占用槽位
+        assert manager.in_flight == 4
+        assert manager.key_states[b"kb"].running == 2
+        while manager.tasks:
+            await asyncio.gather(*list(manager.tasks))
+        assert manager.in_flight == 0
+        assert not manager.key_states
+
+    asyncio.run(run())
+    assert events[:2] == [("start", "ingest_1"), ("start", "ingest_2")]
+    cleanup_start = events.index(("start", "cleanup"))
+    assert cleanup_start > events.index(("end", "ingest_1"))
+    assert events.index(("start", "ingest_3")) > events.index(("end", "cleanup"))
@@ -0,0 +1,52 @@
+import json
+import time
+
+from app.utils.sse import DeltaCoalescer
+
+
+def parse(events):
+    return [json.loads(event[len("data: ") :]) for event in events]
+
+
+def test_first_delta_is_sent_immediately_and_later_ones_are_buffered():
+    coalescer = DeltaCoalescer("message", window=10, max_bytes=100)
+    assert parse(coalescer.add("text", "a")) == [
+        {"type": "text", "data": "a", "message_id": "message"}
+    ]
+    assert coalescer.add("text", "b") == []
+    assert coalescer.add("text", "c") == []
+    assert [event["data"] for event in parse(coalescer.flush())] == ["bc"]
+    assert coalescer.flush() == []
+
+
+def test_buffer_is_flushed_when_max_bytes_is_reached():
+    coalescer = DeltaCoalescer("message", window=10, max_bytes=4)
+    coalescer.add("text", "a")
+    assert coalescer.add("text", "bc") == []
+    assert [event["data"] for event in parse(coalescer.add("text", "de"))] == ["bcde"]
+
+
+def test_type_change_flushes_the_previous_type():
+    coalescer = DeltaCoalescer("message", window=10, max_bytes=100)
+    coalescer.add("thinking", "a")
+    coalescer.add("thinking", "b")
+    events = parse(coalescer.add("text", "c"))
+    assert [(event["type"], event["data"]) for event in events] == [("thinking", "b")]
+    assert parse(coalescer.flush())[0]["type"] == "text"
+
+
+def test_buffer_is_flushed_after_window():
+    coalescer = DeltaCoalescer("message", window=0.01, max_bytes=100)
+    coalescer.add("text", "a")
+    assert coalescer.add("text", "b") == []
+    assert 0 < coalescer.timeout() <= 0.01
+    time.sleep(0.02)
+    assert coalescer.timeout() == 0
+    assert [event["data"] for event in parse(coalescer.add("text", "c"))] == ["bc"]
+
+
+def test_zero_window_disables_coalescing():
+    coalescer = DeltaCoalescer("message", window=0, max_bytes=100)
+    for data in ("a", "b", "c"):
+        assert len(coalescer.add("text", data)) == 1
+    assert coalescer.timeout() is None